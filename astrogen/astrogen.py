@@ -13,30 +13,55 @@ Scalably solve astrometry for image files in FITS format to produce
 configuration files for Astrometrica.
 """
 import getpass
+import itertools
 import os
 import re
-import subprocess
 import tempfile
+import threading
 import logging
 import shutil
 import time
-from irods.exception import CAT_UNKNOWN_COLLECTION, UserInputException
+from irods.exception import CAT_UNKNOWN_COLLECTION
 import makeflow_gen
 import pdb
 from glob import glob
 from datetime import datetime
-from zipfile import ZipFile
+from zipfile import BadZipfile
+from zlib import error as ZlibError
 from config import Config
 from astropy.io import fits
 from irods.session import iRODSSession
-from configuration_gen import ConfigFile
+from downloader import ParallelDownloader
+from irods_listing import list_data_objects, name_patterns, unique_names
+from irods_pool import SessionPool
+from batching import plan_batches
+from catalog import Catalog
+from compression import GZIP, ZIP, compress, compression_of, decompress, \
+    frame_base, uncompressed_name
+from autoscaler import PbsWorkerPool, WorkerAutoscaler
+from executors import SolveJob, make_executor
+from extraction import BatchExtractor, SolutionLog, OK as EXTRACT_OK, WCS
+from fits_header import update_primary_header
+from fits_hints import HintReport, hints_from_solution, probe_hints
+from index_bundle import field_width, find_index_files
+from journal import Journal, DOWNLOADED, SOLVED, EXTRACTED, UPLOADED, \
+    FAILED, TRIAGE_DETAIL
+from leases import LeaseHeartbeat, LeaseStore, default_node_id, node_path, \
+    slice_of
+from pipeline import Batch, Pipeline
+from retention import ARCHIVE_SUFFIX, ARTIFACT_TYPES, DROP, KEEP, PACK, \
+    RetentionPolicy, artifact_type, pack
+from sequence_planner import plan_sequences
+from solve_cache import SolveCache, cache_key
+from triage import Triage, has_fits_extension, triage_data_objects
+from upload_planner import UploadPlanner, source_key
+from uploader import BulkUploader
 
 __pkg_root__ = os.path.dirname(__file__)
 __resources_dir__ = os.path.join(__pkg_root__, os.pardir, 'resources')
 __output_dir__ = os.path.join(__pkg_root__, os.pardir, 'output')
 __batch_dir__ = os.path.join(__resources_dir__, 'fits_files')
 
-
 class Astrogen(object):
     """
     Preprocesses image files in FITS format, filtering bad files.
@@ -52,19 +77,151 @@ class Astrogen(object):
         with open(config_path) as f:
             cfg = Config(f)
             self.iplant_params = dict(cfg.iplant_login_details)
+            listing_details = cfg.listing_details
+            self.recursive_listing = listing_details.recursive
+            self.listing_name_pattern = listing_details.name_pattern
             self.max_batch_size = cfg.batch_details.max_batch_size
+            self.max_batch_files = cfg.batch_details.max_batch_files
+            self.pipeline_queue_size = cfg.batch_details.pipeline_queue_size
             self.path_to_solve_field = cfg.solve_field_details.path_to_solve_field
             self.path_to_netpbm = cfg.solve_field_details.path_to_netpbm
+            self.extraction_workers = \
+                cfg.extraction_details.extraction_workers
+            self.solution_log_path = os.path.join(
+                __output_dir__, cfg.extraction_details.solution_log)
+            self.extraction_mode = cfg.extraction_details.extraction_mode
+            self.update_fits_headers = \
+                cfg.extraction_details.update_fits_headers
+            self.mmap_fits_headers = cfg.extraction_details.mmap_fits_headers
+            hint_details = cfg.solve_hint_details
+            self.use_header_hints = hint_details.use_header_hints
+            self.hint_params = {
+                'search_radius': hint_details.search_radius,
+                'scale_tolerance': hint_details.scale_tolerance,
+                'default_pixel_size': hint_details.default_pixel_size or None,
+                'pixel_size_includes_binning':
+                    hint_details.pixel_size_includes_binning,
+            }
+            self.assumed_blind_solve_time = \
+                hint_details.assumed_blind_solve_time
+            self.seed_sequences = hint_details.seed_sequences
+            self.seed_radius = hint_details.seed_radius
+            self.seed_scale_tolerance = hint_details.seed_scale_tolerance
+            self.download_workers = cfg.transfer_details.download_workers
+            self.session_pool_size = cfg.transfer_details.session_pool_size
+            self.chunk_size = cfg.transfer_details.chunk_size
+            self.compress_outputs = cfg.transfer_details.compress_outputs
+            self.upload_workers = cfg.transfer_details.upload_workers
+            self.upload_attempts = cfg.transfer_details.upload_attempts
+            self.upload_backoff = cfg.transfer_details.upload_backoff
+            self.skip_unchanged_uploads = \
+                cfg.transfer_details.skip_unchanged_uploads
+            self.upload_dry_run = cfg.transfer_details.upload_dry_run
+            retention_details = cfg.retention_details
+            self.retention_policy = RetentionPolicy(dict(
+                (kind, getattr(retention_details, kind))
+                for kind, _ in ARTIFACT_TYPES))
+            self.solve_cache_dir = os.path.join(
+                __resources_dir__, cfg.solve_cache_details.cache_dir)
+            self.max_solve_cache_size = \
+                cfg.solve_cache_details.max_cache_size
+            self.journal_path = os.path.join(
+                __resources_dir__, cfg.journal_details.journal_path)
+            triage_details = cfg.triage_details
+            self.triage_frames = triage_details.triage_frames
+            self.triage_workers = triage_details.triage_workers
+            self.rejected_image_types = \
+                list(triage_details.rejected_image_types)
+            self.reject_closed_shutter = triage_details.reject_closed_shutter
+            self.rejection_report_path = os.path.join(
+                __output_dir__, triage_details.rejection_report)
+            self.update_catalog = cfg.catalog_details.update_catalog
+            self.catalog_path = os.path.join(
+                __resources_dir__, cfg.catalog_details.catalog_path)
+            coordination_details = cfg.coordination_details
+            self.coordinate_nodes = coordination_details.coordinate
+            self.node_id = \
+                coordination_details.node_id or default_node_id()
+            self.lease_store_path = os.path.join(
+                __resources_dir__, coordination_details.lease_store)
+            self.num_slices = coordination_details.num_slices
+            self.lease_seconds = coordination_details.lease_seconds
+            self.heartbeat_seconds = coordination_details.heartbeat_seconds
+            executor_details = cfg.executor_details
+            self.executor_backend = executor_details.backend
+            self.local_workers = executor_details.local_workers
+            self.job_timeout = executor_details.job_timeout
+            self.makeflow_project_name = executor_details.project_name
+            self.num_pbs_workers = executor_details.num_pbs_workers
+            self.makeflow_shard_size = executor_details.makeflow_shard_size
+            self.quick_cpulimit = executor_details.quick_cpulimit
+            self.blind_cpulimit = executor_details.blind_cpulimit
+            self.bundle_index_files = executor_details.bundle_index_files
+            self.index_dir = executor_details.index_dir
+            self.makeflow_resources = {
+                makeflow_gen.HINTED: makeflow_gen.Resources(
+                    executor_details.hinted_cores,
+                    executor_details.hinted_memory,
+                    executor_details.hinted_disk),
+                makeflow_gen.BLIND: makeflow_gen.Resources(
+                    executor_details.blind_cores,
+                    executor_details.blind_memory,
+                    executor_details.blind_disk),
+            }
+            self.autoscale_workers = executor_details.autoscale_workers
+            self.min_pbs_workers = executor_details.min_pbs_workers
+            self.max_pbs_workers = executor_details.max_pbs_workers
+            self.worker_cores = executor_details.worker_cores
+            self.target_drain_time = executor_details.target_drain_time
+            self.initial_solve_time = executor_details.initial_solve_time
+            self.cooldown_solves = executor_details.cooldown_solves
+            self.pbs_params = {
+                'group_list': executor_details.pbs_group_list,
+                'queue': executor_details.pbs_queue,
+                'select': executor_details.pbs_select,
+                'walltime': executor_details.pbs_walltime,
+                'cput': executor_details.pbs_cput,
+            }
+
+        # nodes sharing a run keep their own journals, solve caches, logs and
+        # reports
+        log_path = 'astrogen.log'
+        if self.coordinate_nodes:
+            self.journal_path = node_path(self.journal_path, self.node_id)
+            self.solve_cache_dir = \
+                node_path(self.solve_cache_dir, self.node_id)
+            self.catalog_path = node_path(self.catalog_path, self.node_id)
+            self.solution_log_path = \
+                node_path(self.solution_log_path, self.node_id)
+            self.rejection_report_path = \
+                node_path(self.rejection_report_path, self.node_id)
+            log_path = node_path(log_path, self.node_id)
 
         # uname and pword are given at command line
         self.user = raw_input("Enter iPlant username: ")
         self.password = getpass.getpass("Enter iPlant password: ")
 
+        # sessions are opened lazily, and shared by the transfer workers
+        self.session_pool = \
+            SessionPool(self._get_irods_session, self.session_pool_size)
+        self.downloader = \
+            ParallelDownloader(self.session_pool, self.download_workers,
+                               self.chunk_size)
+        self.uploader = \
+            BulkUploader(self.session_pool, self.upload_workers,
+                         self.chunk_size, self.upload_attempts,
+                         self.upload_backoff)
+        # set per run, since it records uploads in the run's journal
+        self.upload_planner = None
+
+        # runs solve-field, through makeflow or locally
+        self.executor = self._make_executor()
+
         # set up temporary local file directory for batches
         tempfile.tempdir = os.path.join(__pkg_root__, 'resources', 'fits_files')
 
         # set up logging
-        logging.basicConfig(filename='astrogen.log', level=logging.INFO)
+        logging.basicConfig(filename=log_path, level=logging.INFO)
         t = time.localtime()
         logging.info(
             "Astrogen run started {day}-{mo}-{year} at {hour}:{min}:{sec}".format(
@@ -73,64 +230,559 @@ class Astrogen(object):
 
     # PUBLIC ##################################################################
 
-    def get_astrometry(self):
+    def get_astrometry(self, resume=False):
         """
         Gets the astrometry data for the FITS files in this iPlant directory.
 
         Note: Nothing but .fits and .arch files are allowed.
-        """
-        # get data objects from iPlant
-        cleaned_data_objects = self._get_data_objects()
-
-        current_batch_size = 0
-        for data_object in cleaned_data_objects:
-            if current_batch_size < self.max_batch_size:
-                self._add_to_local_batch(data_object)
-                #current_batch_size = os.path.getsize(__batch_dir__) / 1024. ** 2
-                current_batch_size = \
-                   sum(
-                         [os.path.getsize(f) for f in os.listdir(__batch_dir__) 
-                            if os.path.isfile(f)]
-                   ) / 1024. ** 2
-            else:
-                # call astronomy.net stuff on this batch
-                self._solve_batch_astrometry()
 
-                # clear this batch from directory
-                all_batched_fits_files = glob(os.path.join(__batch_dir__, '*'))
-                os.remove(all_batched_fits_files)
-                current_batch_size = 0
+        :param bool resume: Pick up where the last run stopped, according to
+            its journal. Uploaded frames are skipped, and batches left on
+            disk re-enter the pipeline after their last completed stage.
+            Otherwise the journal is cleared and the run starts over.
+
+        With coordinate (in astrogen.cfg), the run is shared with the other
+        nodes using the same lease store: this node takes slices of the
+        collection as it needs them, until none are left to lease or to
+        steal from nodes that died. A fresh shared run needs a fresh lease
+        store (see leases.py).
+        """
+        # a coordinated node's stores sit on the disk the nodes share
+        self.journal = Journal(self.journal_path,
+                               shared_disk=self.coordinate_nodes)
+        if self.skip_unchanged_uploads or self.upload_dry_run:
+            self.upload_planner = UploadPlanner(self.session_pool,
+                                                self.journal)
+        if resume:
+            resumed_batches = self._resumed_batches()
+            skipped_paths = self.journal.paths_in_state(UPLOADED)
+            for batch in resumed_batches:
+                skipped_paths.update(batch.irods_paths.values())
+            logging.info("Resuming: {} batches recovered, {} frames skipped.".
+                         format(len(resumed_batches), len(skipped_paths)))
+        else:
+            self.journal.clear()
+            resumed_batches = []
+            skipped_paths = set()
+
+        if self.coordinate_nodes:
+            self.leases = LeaseStore(self.lease_store_path, self.node_id,
+                                     self.num_slices, self.lease_seconds)
+            self._listed_slices = {}
+            self._slices_lock = threading.Lock()
+            self.heartbeat = LeaseHeartbeat(
+                self.leases, self.heartbeat_seconds, self._settle_slices)
+            self.heartbeat.start()
+            listings = self._leased_passes()
+        else:
+            self.leases = None
+            listings = [self._get_data_objects()]
+
+        # frames not worth solving never reach a batch
+        self.triage = Triage(self.rejected_image_types,
+                             self.reject_closed_shutter)
+
+        # frames solved in earlier runs are restored rather than re-solved
+        self.solve_cache = SolveCache(
+            self.solve_cache_dir, int(self.max_solve_cache_size * 1024 ** 2))
+
+        # fetch, solve, extract and upload run concurrently, each batch in
+        # its own working directory
+        pipeline = Pipeline(self.pipeline_queue_size)
+        self.hint_report = HintReport()
+        self.extractor = BatchExtractor(
+            os.path.join(__resources_dir__, 'config_template.txt'),
+            self.extraction_workers,
+            self.extraction_mode)
+        self.solution_log = SolutionLog(self.solution_log_path)
+        # solved frames are added to the catalog as they are extracted
+        self.catalog = \
+            Catalog(self.catalog_path, shared_disk=self.coordinate_nodes) \
+            if self.update_catalog else None
+        pipeline.add_stage('probe', self._probe_batch)
+        pipeline.add_stage('solve', self._solve_batch)
+        pipeline.add_stage('extract', self._extract_batch)
+        pipeline.add_stage('upload', self._upload_batch)
+        # each listing is batched on its own, so that its last, partial
+        # batch is not held back by the next
+        fetched_batches = itertools.chain.from_iterable(
+            self._fetch_batches(self._cleaned(data_objects, skipped_paths))
+            for data_objects in listings)
+        finished = pipeline.run(itertools.chain(
+            resumed_batches, fetched_batches))
+
+        logging.info("Finished {} batches.".format(len(finished)))
+        if self.leases is not None:
+            self.heartbeat.stop()
+            self._settle_slices(release=True)
+            logging.info("Slices: {}.".format(', '.join(
+                '{} {}'.format(count, state)
+                for state, count in sorted(self.leases.summary().items()))))
+            self.leases.close()
+        count, nbytes = self.journal.remaining()
+        logging.info("{} frames ({:.2f} MB) not uploaded.".
+                     format(count, nbytes / 1024. ** 2))
+        if self.triage_frames:
+            count, nbytes = self.journal.rejected()
+            logging.info("{} frames ({:.2f} MB) rejected by triage.".
+                         format(count, nbytes / 1024. ** 2))
+        self.journal.close()
+        self.solve_cache.report()
+        self.solve_cache.close()
+        self.hint_report.report(self.assumed_blind_solve_time)
+        if self.triage_frames:
+            self.triage.report(self.rejection_report_path)
+        if self.catalog is not None:
+            logging.info("Catalog {} holds {} frames.".
+                         format(self.catalog_path, len(self.catalog)))
+            self.catalog.close()
+        self.executor.close()
+        self.session_pool.cleanup()
 
     # PRIVATE #################################################################
 
-    def _unzipper(self, data_object):
+    def _leased_passes(self):
+        """Get the data objects of the slices this node leases, one stream
+        per pass, until no slice is left to lease or steal.
+
+        A pass takes slices until there are none to take, then ends, so
+        that the frames it listed can all be solved. Between passes the node
+        waits, and tries again, while another node's leases go unrenewed
+        (that node has likely died, and its slices can be stolen once the
+        leases expire) or while its own slices are being finished, in case
+        a node dies meanwhile. Its own slices stop holding it once its
+        journal has not moved for a lease's length.
         """
-        Checks if file can be unzip and if it can sends it to resources/fit_files
+        progress, progressed = None, time.time()
+        while True:
+            yield self._leased_data_objects()
+
+            summary = self.journal.summary()
+            if summary != progress:
+                progress, progressed = summary, time.time()
+            working = self.leases.renew() and \
+                time.time() - progressed < self.lease_seconds
+            if not working and \
+                    not self.leases.others_stalled(2 * self.heartbeat_seconds):
+                return
+            time.sleep(self.heartbeat_seconds)
+
+    def _leased_data_objects(self):
+        """Get the data objects of the slices of the collection this node
+        can lease now (or steal), a slice at a time.
+
+        Each slice is listed as it is leased (again if it is leased again),
+        so that only its own data objects are held, and a slice is only
+        completed once all of those listed are done.
+
+        A slice whose lease is lost to another node is left to that node.
         """
-        with ZipFile(data_object, 'w') as myzip:
-            testZip = myzip.testzip()
-            if testZip == None:  # if testZip is None then there are no bad files
+        while True:
+            slice_number = self.leases.acquire()
+            if slice_number is None:
+                return
+
+            paths = set()
+            for data_object in self._get_data_objects(slice_number):
+                if slice_number in self.leases.lost:
+                    break
+                paths.add(data_object.path)
+                yield data_object
+            else:
+                with self._slices_lock:
+                    self._listed_slices[slice_number] = paths
+
+    def _settle_slices(self, release=False):
+        """Complete the slices whose frames were all uploaded (or failed).
 
-                path_to_unzipper_outputs = \
-                    os.path.join(__resources_dir__, 'fits_files')
-                myzip.write(tempfile.NamedTemporaryFile())
+        :param bool release: Whether to give up the slices that are not
+            complete, e.g. as the run ends, for another node to lease.
+        """
+        finished = self.journal.paths_in_state(UPLOADED, FAILED)
+        with self._slices_lock:
+            listed = self._listed_slices.items()
+        for slice_number, paths in listed:
+            if paths <= finished:
+                self.leases.complete(slice_number)
+                with self._slices_lock:
+                    del self._listed_slices[slice_number]
+        if release:
+            for slice_number in self.leases.renew():
+                self.leases.release(slice_number)
+
+    def _resumed_batches(self):
+        """Rebuild the batches of an interrupted run from the journal.
+
+        Only frames whose local files survived are recovered; the rest are
+        fetched again.
+        """
+        batches = {}
+        for path, name, state, local_path in self.journal.in_progress():
+            if local_path is None or not os.path.exists(local_path):
+                continue
+            work_dir = os.path.dirname(local_path)
+            if work_dir not in batches:
+                batches[work_dir] = \
+                    Batch(len(batches), __batch_dir__, work_dir=work_dir)
+            batch = batches[work_dir]
+            batch.irods_paths[name] = path
+            if state in (SOLVED, EXTRACTED):
+                batch.solved.add(name)
+            if state == EXTRACTED:
+                batch.extracted.add(name)
+        return sorted(batches.values(), key=lambda b: b.work_dir)
+
+    def _cleaned(self, data_objects, skipped_paths):
+        """Record listed data objects in the journal, passing on those not
+        already handled (skipped_paths) and, with triage, worth solving.
+        """
+        cleaned_data_objects = (
+            data_object
+            for data_object in self.journal.listed(data_objects)
+            if data_object.path not in skipped_paths
+        )
+        if self.triage_frames:
+            cleaned_data_objects = self._triaged(cleaned_data_objects)
+        return cleaned_data_objects
 
+    def _triaged(self, data_objects):
+        """Pass on the data objects worth solving, marking the rest failed
+        in the journal.
+        """
+        for data_object, reason in triage_data_objects(
+                data_objects, self.session_pool, self.triage,
+                self.triage_workers):
+            if reason is None:
+                yield data_object
             else:
-                myzip.moveFileToDirectory("Unusable") #move to non working folder
+                self.journal.mark([data_object.path], FAILED,
+                                  detail='{} ({})'.format(TRIAGE_DETAIL,
+                                                          reason))
+
+    def _fetch_batches(self, data_objects):
+        """Download data objects into per-batch directories, yielding each
+        batch once its files are local.
+
+        Batches are planned from the sizes in the iRODS metadata, so no
+        batch directory is listed or measured along the way.
+        """
+        planned_batches = plan_batches(
+            data_objects,
+            max_files=self.max_batch_files,
+            max_bytes=int(self.max_batch_size * 1024 ** 2)
+        )
+        for batch_id, batch_objects in enumerate(planned_batches):
+            batch = Batch(batch_id, __batch_dir__)
+            downloaded = self.downloader.download(batch_objects, batch.work_dir)
+            logging.info("Batch {}: {} of {} files, {:.2f} MB downloaded.".
+                         format(batch.name, len(downloaded), len(batch_objects),
+                                self.downloader.meter.total_bytes / 1024. ** 2))
+
+            downloaded_names = set(os.path.basename(p) for p in downloaded)
+            for data_object in batch_objects:
+                if data_object.name in downloaded_names:
+                    batch.irods_paths[data_object.name] = data_object.path
+            names = list(batch.irods_paths)
+            self.journal.mark(
+                [batch.irods_paths[name] for name in names], DOWNLOADED,
+                local_paths=[os.path.join(batch.work_dir, name)
+                             for name in names])
+            self.journal.mark(
+                [obj.path for obj in batch_objects
+                 if obj.name not in downloaded_names],
+                FAILED, detail='download')
+
+            if batch.is_empty():
+                batch.remove()
+                continue
+
+            for data_object in batch_objects:
+                digest = self.downloader.digests.get(data_object.name)
+                batch.cache_keys[data_object.name] = cache_key(
+                    getattr(data_object, 'checksum', None), digest)
+                if digest is not None:
+                    batch.digests[data_object.name] = digest
+            yield batch
+
+    def _probe_batch(self, batch):
+        """Pipeline stage: read the primary header of each frame still to be
+        solved, for hints that narrow solve-field's search.
+        """
+        if not self.use_header_hints:
+            return batch
+
+        unsolved = [os.path.join(batch.work_dir, filename)
+                    for filename in batch.irods_paths
+                    if filename not in batch.solved]
+        headers = {}
+        for fits_path, hints in \
+                probe_hints(unsolved, headers, **self.hint_params).items():
+            batch.hints[os.path.basename(fits_path)] = hints
+        for fits_path, header in headers.items():
+            batch.headers[os.path.basename(fits_path)] = header
+        logging.info("Batch {}: hints for {} of {} frames.".
+                     format(batch.name, len(batch.hints), len(unsolved)))
+        return batch
+
+    def _solve_batch(self, batch):
+        """Pipeline stage: solve a batch with the configured executor.
+
+        Frames found in the solve cache are restored instead, and only the
+        misses are sent to the executor. Unless seed_sequences is off, one
+        frame of each sequence (target and night) is solved first, and the
+        rest are hinted with its solution.
+        """
+        fits_filenames = []
+        cache_hits = []
+        for filename in batch.irods_paths:
+            if filename in batch.solved:
+                continue
+            basename = frame_base(filename)
+            key = batch.cache_keys.get(filename)
+            if self.solve_cache.get(key, batch.work_dir, basename):
+                cache_hits.append(filename)
+            else:
+                fits_filenames.append(filename)
+        batch.solved.update(cache_hits)
+        batch.cache_misses = fits_filenames
+        self._mark_frames(batch, cache_hits, SOLVED)
+
+        if not fits_filenames:
+            logging.info("Batch {} already solved, not running executor.".
+                         format(batch.name))
+            return batch
+
+        if not self.seed_sequences:
+            self._run_solve_jobs(batch, fits_filenames)
+            return batch
+
+        # solve one frame of each sequence, then the rest of the sequence
+        # seeded from its solution
+        plan = plan_sequences(sorted(batch.irods_paths), batch.headers)
+        misses = set(fits_filenames)
+        self._run_solve_jobs(batch, [sequence.representative
+                                     for sequence in plan
+                                     if sequence.representative in misses])
+        followers = []
+        for sequence in plan:
+            frames = [f for f in sequence.followers if f in misses]
+            followers.extend(frames)
+            solution = self._solution(batch, sequence.representative)
+            if solution is None:
+                continue
+            seed = hints_from_solution(solution, self.seed_radius,
+                                       self.seed_scale_tolerance)
+            for filename in frames:
+                batch.hints[filename] = seed
+        self._run_solve_jobs(batch, followers, tag='seeded')
+        return batch
+
+    def _run_solve_jobs(self, batch, fits_filenames, tag=None):
+        """Solve frames of a batch with the configured executor, using
+        whatever hints the batch has for them.
+        """
+        if not fits_filenames:
+            return
+
+        jobs = [
+            SolveJob(filename,
+                     os.path.join(batch.work_dir, filename),
+                     os.path.join(batch.work_dir,
+                                  frame_base(filename) + '.out'),
+                     batch.hints.get(filename),
+                     field_width(batch.headers.get(filename),
+                                 batch.hints.get(filename)))
+            for filename in fits_filenames
+        ]
+
+        # record each frame as its job completes, and extract its parameters
+        # right away rather than waiting for the rest of the batch
+        for result in self.executor.run(jobs, batch.work_dir, tag=tag):
+            if result.succeeded:
+                self.hint_report.record(result.name in batch.hints,
+                                        result.runtime)
+                batch.solved.add(result.name)
+                self._mark_frames(batch, [result.name], SOLVED)
+                self._extract_frames(batch, [result.name])
+            else:
+                self._mark_frames(batch, [result.name], FAILED,
+                                  detail='solve (exit status {})'.
+                                  format(result.exit_status))
+
+    def _solution(self, batch, fits_filename):
+        """The (ra, dec, scale) of a solved frame of a batch, or None."""
+        if fits_filename not in batch.solved:
+            return None
+        base_path = os.path.join(batch.work_dir, frame_base(fits_filename))
+        try:
+            solution = self.extractor.read_solution(base_path)
+            return solution['ra'], solution['dec'], solution['pixel_scale']
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def _extract_batch(self, batch):
+        """Pipeline stage: extract parameters for the solved frames of a batch
+        that were not already extracted as they finished solving.
+        """
+        self._extract_frames(batch, batch.solved - batch.extracted)
+        return batch
+
+    def _extract_frames(self, batch, filenames):
+        """Generate the Astrometrica configurations for solved frames of a
+        batch, caching the results of those newly solved, and add their
+        parameters to the run's solution log.
+        """
+        filenames = dict((frame_base(filename), filename)
+                         for filename in filenames)
+        if not filenames:
+            return
+
+        table = self.extractor.extract(
+            os.path.join(batch.work_dir, name + '.out') for name in filenames)
+        self.extractor.write_configs(table, batch.work_dir)
+        self.solution_log.append(table)
+        if self.catalog is not None:
+            self.catalog.add(
+                table,
+                headers=dict((name, batch.headers.get(filename))
+                             for name, filename in filenames.items()),
+                paths=dict((name, batch.irods_paths.get(filename))
+                           for name, filename in filenames.items()))
+
+        for row in table.rows():
+            filename = filenames[row['name']]
+            if row['status'] != EXTRACT_OK:
+                logging.info("Parameters not extracted for {}: {}".
+                             format(filename, row['status']))
+                self._mark_frames(batch, [filename], FAILED,
+                                  detail='extract ({})'.format(row['status']))
+                continue
+
+            if self.update_fits_headers:
+                # a compressed frame's headers are set in its decompressed
+                # copy, which replaces it before upload
+                batch.header_cards[filename] = self._set_solution_headers(
+                    self._decompressed_path(batch, filename), row)
+            batch.extracted.add(filename)
+            if filename in batch.cache_misses:
+                base_path = os.path.join(batch.work_dir, row['name'])
+                self.solve_cache.put(batch.cache_keys.get(filename),
+                                     base_path + '.out', base_path + '.cfg',
+                                     base_path + '.wcs')
+            self._mark_frames(batch, [filename], EXTRACTED)
+
+    @staticmethod
+    def _decompressed_path(batch, filename):
+        """The path of a frame of a batch as a plain FITS file. A compressed
+        frame restored from the solve cache never went through an executor,
+        so it is decompressed here.
+        """
+        fits_path = os.path.join(batch.work_dir, uncompressed_name(filename))
+        if compression_of(filename) is not None and \
+                not os.path.exists(fits_path):
+            try:
+                decompress(os.path.join(batch.work_dir, filename), fits_path)
+            except (EnvironmentError, EOFError, BadZipfile, ZlibError) as e:
+                logging.info("{} not decompressed: {}".format(filename, e))
+        return fits_path
+
+    def _set_solution_headers(self, fits_path, row):
+        """Record a frame's solved center in its OBJCTRA and OBJCTDEC
+        headers, rewriting only the header.
+
+        :return: The cards written, or None if the header was not updated.
+        """
+        cards = [('OBJCTRA', row['ra_hms']), ('OBJCTDEC', row['dec_dms'])]
+        try:
+            update_primary_header(fits_path, cards,
+                                  use_mmap=self.mmap_fits_headers)
+        except (EnvironmentError, ValueError) as e:
+            logging.info("Headers of {} not updated: {}".format(fits_path, e))
+            return None
+        return cards
+
+    def _upload_batch(self, batch):
+        """Pipeline stage: upload a batch's solutions, then delete its
+        working directory.
+
+        If any file is not uploaded, the directory is kept, holding just the
+        files that were not, and their frames are left extracted in the
+        journal so that a resumed run tries them again.
+        """
+        self._recompress_frames(batch)
+        results = self._move_makeflow_solutions(
+            batch.work_dir, source_keys=self._source_keys(batch))
+        failed = [os.path.basename(result.local_path)
+                  for result in results if not result.succeeded]
+        self._mark_frames(batch, [
+            filename for filename in batch.extracted
+            if not any(name.startswith(frame_base(filename) + '.')
+                       for name in failed)], UPLOADED)
+        if failed:
+            logging.info("Batch {}: {} files not uploaded, kept in {}.".
+                         format(batch.name, len(failed), batch.work_dir))
+        else:
+            batch.remove()
+        return batch
+
+    def _mark_frames(self, batch, filenames, state, detail=None):
+        """Record a state change in the journal for frames of a batch."""
+        self.journal.mark([batch.irods_paths[filename] for filename in filenames
+                           if filename in batch.irods_paths],
+                          state, detail=detail)
 
-            ZipFile.close()
+    @staticmethod
+    def _has_output(batch, fits_filename, extension):
+        """Whether solve-field (or extraction) left a non-empty output file
+        with this extension for a frame.
+        """
+        output_path = os.path.join(
+            batch.work_dir, frame_base(fits_filename) + extension)
+        return os.path.exists(output_path) and os.path.getsize(output_path) > 0
+
+    def _recompress_frames(self, batch):
+        """Put the decompressed copies of a batch's compressed frames back
+        in their compression, so that they are uploaded as they came.
+
+        A frame whose headers were updated is recompressed over the original;
+        otherwise the original is kept and the copy just deleted. With
+        compress_outputs, solve-field's copy of each such frame (.new) is
+        compressed too, with gzip for zipped frames, unless it is to be
+        dropped.
+        """
+        compress_new = self.compress_outputs and \
+            self.retention_policy.actions['new'] != DROP
+        for filename in batch.irods_paths:
+            compression = compression_of(filename)
+            if compression is None:
+                continue
+            fits_path = os.path.join(batch.work_dir,
+                                     uncompressed_name(filename))
+            new_path = os.path.join(batch.work_dir,
+                                    frame_base(filename) + '.new')
+            try:
+                if os.path.exists(fits_path):
+                    if self.update_fits_headers and \
+                            filename in batch.extracted:
+                        compress(fits_path,
+                                 os.path.join(batch.work_dir, filename))
+                    os.remove(fits_path)
+                if compress_new and os.path.exists(new_path):
+                    output_compression = \
+                        GZIP if compression == ZIP else compression
+                    compress(new_path,
+                             '{}.{}'.format(new_path, output_compression))
+                    os.remove(new_path)
+            except EnvironmentError as e:
+                logging.info("{} not recompressed: {}".format(filename, e))
 
     def _file_extension_validation(self, fits_directory):
         """
         Parses filenames in a directory to determine which files are valid solve-field candidates
         Files that do not meet criteria are removed
         """
-        valid_extensions = [
-            "fit", "fits", "FIT", "FITS", "fts"
-        ]
-
         for fits_file_candidate in os.listdir(fits_directory):
-            if fits_file_candidate.split(".")[1] not in valid_extensions:
+            if not has_fits_extension(fits_file_candidate):
                 os.remove(fits_directory + "/" + fits_file_candidate)
                 print("Removing invalid file \"" + fits_file_candidate + "\"...")
 
@@ -156,109 +808,131 @@ class Astrogen(object):
         self._move_makeflow_solutions()
 
     @staticmethod
-    def _run_parameter_extraction():
+    def _run_parameter_extraction(batch_dir=None):
         """Runs parameter extraction using stored output of solve-field in the
             batch directory.
+
+        :param batch_dir: The directory holding the solve-field outputs.
+            Defaults to resources/fits_files.
+        :return: The extracted parameters, as a SolutionTable.
         """
-        path_to_solve_field_outputs = \
-            os.path.join(__resources_dir__, 'fits_files')
+        if batch_dir is None:
+            batch_dir = os.path.join(__resources_dir__, 'fits_files')
+        path_to_solve_field_outputs = batch_dir
 
         # where stdout was redirected in call to makeflow
         all_stdout_files = os.path.join(path_to_solve_field_outputs, '*.out')
 
-        for output_filename in glob(all_stdout_files):
-            is_not_empty = os.path.getsize(output_filename)
-            if is_not_empty:
-                dir_name = os.path.dirname(output_filename)
-                fits_basename = os.path.basename(output_filename)
-                fits_filename = os.path.splitext(fits_basename)[0] + '.fit'
-                fits_path = os.path.join(dir_name, fits_filename)
-                ConfigFile().process(fits_path, output_filename)
+        extractor = BatchExtractor(
+            os.path.join(__resources_dir__, 'config_template.txt'))
+        table = extractor.extract(
+            output_filename for output_filename in glob(all_stdout_files)
+            if os.path.getsize(output_filename))
+        extractor.write_configs(table, path_to_solve_field_outputs)
+        return table
 
-    @staticmethod
-    def _run_makeflow(makeflow_script_name):
-        """Runs a makeflow.
+    def _run_makeflow(self, makeflow_script_name, batch_dir=None):
+        """Runs a makeflow, returning once it has finished.
 
         Side-effects by generating several files for each fits file in the
-        batch directory (resources/fits_files).
-
-        WARNING: Clears previous runs from the makeflows directory.
+        batch directory (resources/fits_files by default).
 
         :param makeflow_script_name: The absolute path of the makeflow script
             to run.
+        :param batch_dir: The directory holding the batch's fits files.
         """
-        # self._clear_generated_files()
-
-        # TODO factor the sections into methods
-        makeflow_project_name = 'SONORAN'
-        path_to_solve_field_outputs = \
-            os.path.join(__resources_dir__, 'fits_files')
-
-        ##
-        # Get the shell, stand on head so that `module load` works
-        #
-        echo_out = subprocess.check_output('echo $SHELL', shell=True)
-        shell = os.path.basename(echo_out.strip())
-
-        # edge case: if shell is ksh93, use 'ksh'
-        if shell.startswith('ksh'):
-            shell = 'ksh'
-
-        # called for this particular shell
-        module_init = '/usr/share/Modules/init/' + shell
-
-        ##
-        # build makeflow, pbs_submit_workers commands
-        #
-        #TODO modify temp files locations
-        makeflow_cmd = 'cd {outputs_dir} && ' \
-              'makeflow --wrapper \'. {shell_module}\' ' \
-                  '-T wq ' \
-                  '-a ' \
-                  '-N {project_name} ' \
-              '{makeflow_script_name}'.\
-            format(outputs_dir=path_to_solve_field_outputs,
-                   shell_module=module_init,
-                   project_name=makeflow_project_name,
-                   makeflow_script_name=makeflow_script_name)
-
-        pbs_submit_cmd = 'pbs_submit_workers ' \
-                         '-d all ' \
-                         '-N {project_name} ' \
-                         '-p "-N {project_name} ' \
-                             '-W group_list=nirav ' \
-                             '-q standard ' \
-                             '-l jobtype=serial ' \
-                             '-l select=1:ncpus=3:mem=4gb ' \
-                             '-l place=pack:shared ' \
-                             '-l walltime=01:00:00 ' \
-                             '-l cput=01:00:00" ' \
-                         '3'.format(project_name=makeflow_project_name)
-
-        ##
-        # call commands
-        #
-        print ('Now calling makeflow and pbs_submit_workers (you may want to '
-              'watch the resources/fits_files directory for .out files in a '
-              'couple of minutes) ...')
-        pbs_output_dst = os.path.join(__resources_dir__, 'pbs_output')  # TODO add date to fn
-        makeflow_output_dst = os.path.join(__resources_dir__, 'makeflow_output')  # TODO add date
-        
-
-        with open(pbs_output_dst, 'w') as f1, open(makeflow_output_dst, 'w') as f2:
-           subprocess.Popen(pbs_submit_cmd, shell=True, stdout=f1)
-           subprocess.Popen(makeflow_cmd, shell=True, stdout=f2)
-
-        print ('... batch complete.')
-        t = time.localtime()
-        logging.info('finished a batch on {day}-{mo}-{year} at {hour}:{min}:{sec}'.format(
-                day=t.tm_mday, mo=t.tm_mon, year=t.tm_year, hour=t.tm_hour,
-                min=t.tm_min, sec=t.tm_sec))
+        if batch_dir is None:
+            batch_dir = os.path.join(__resources_dir__, 'fits_files')
+        return self._make_executor('makeflow').\
+            run_makeflow(makeflow_script_name, batch_dir)
+
+    def _make_executor(self, backend=None):
+        """Build the solve-field executor configured in astrogen.cfg (or the
+        given backend).
+        """
+        if backend is None:
+            backend = self.executor_backend
+        if backend == 'local':
+            kwargs = {
+                'num_workers': self.local_workers,
+                'job_timeout': self.job_timeout,
+                'write_wcs': self.extraction_mode == WCS,
+                'quick_cpulimit': self.quick_cpulimit or None,
+                'cpulimit': self.blind_cpulimit,
+            }
+        else:
+            kwargs = {
+                'makeflows_dir': os.path.join(__output_dir__, 'makeflows'),
+                'project_name': self.makeflow_project_name,
+                'pbs_params': self.pbs_params,
+                'num_workers': self.num_pbs_workers,
+                'shard_size': self.makeflow_shard_size or None,
+                'resources': self.makeflow_resources,
+                'quick_cpulimit': self.quick_cpulimit or None,
+                'cpulimit': self.blind_cpulimit,
+                'index_files': self._find_index_files(),
+                'write_wcs': self.extraction_mode == WCS,
+            }
+        executor = make_executor(backend, self.path_to_solve_field,
+                                 self.path_to_netpbm, **kwargs)
+        if backend == 'makeflow' and self.autoscale_workers:
+            executor.autoscaler = WorkerAutoscaler(
+                PbsWorkerPool(executor.pbs_submit_command),
+                self.min_pbs_workers,
+                self.max_pbs_workers,
+                self.target_drain_time,
+                jobs_per_worker=self.worker_cores,
+                initial_solve_time=self.initial_solve_time,
+                cooldown_solves=self.cooldown_solves)
+        return executor
+
+    def _find_index_files(self):
+        """The index files to bundle with makeflow jobs, or None to have
+        workers read them from the shared filesystem.
+        """
+        if not self.bundle_index_files:
+            return None
+        if not os.path.isdir(self.index_dir):
+            logging.info("Index directory {} not found; not bundling index "
+                         "files.".format(self.index_dir))
+            return None
+        index_files = find_index_files(self.index_dir)
+        logging.info("Bundling from {} index files in {}.".format(
+            sum(len(paths) for paths in index_files.values()), self.index_dir))
+        return index_files
+
+    @staticmethod
+    def _source_keys(batch):
+        """Source keys (see upload_planner.source_key) of a batch's frames
+        downloaded in this run, by local path: a frame is its download with
+        the header cards written into it, so an unchanged frame is known
+        without reading it again.
+        """
+        return dict(
+            (os.path.join(batch.work_dir, filename),
+             source_key(batch.digests[filename],
+                        batch.header_cards.get(filename)))
+            for filename in batch.irods_paths if filename in batch.digests)
 
-    def _move_makeflow_solutions(self):
+    def _move_makeflow_solutions(self, batch_dir=None, source_keys=None):
         """Move makeflow solution files to their directory
         Issuing shell commands like `imv` is not done because it is not
          portable (even though it would be simpler).
+
+        Which files are sent is up to the retention policy: each kind of
+        file is sent as it is, packed with the batch's other small files into
+        one archive, or deleted unsent.
+
+        Files are sent concurrently by the uploader, and each local file is
+        deleted once its upload is verified. Files unchanged since they were
+        last uploaded are not sent again, unless skipping is off (or only
+        being tried, as a dry run).
+
+        :param batch_dir: The directory holding the solution files. Defaults
+            to resources/fits_files.
+        :param dict source_keys: Optionally, source keys of the files by
+            local path, to plan their uploads without reading them.
+        :return: A list of UploadResults.
         """
         def mk_irods_path(leaf_dir):
             return os.path.join(
@@ -270,32 +944,80 @@ class Astrogen(object):
         logging.info("Writing data to {} as {} ...".
                      format(iplant_params['host'], self.user))
 
-        sess = self._get_irods_session()
-        output_src = os.path.join(__resources_dir__, 'fits_files')
-
-        fits_file_paths = glob(os.path.join(output_src, '*.fit'))
-        cfg_file_paths = glob(os.path.join(output_src, '*.cfg'))
-        other_soln_file_paths = \
-            glob(os.path.join(output_src, '*.out')) + \
-            glob(os.path.join(output_src, '*.axy')) + \
-            glob(os.path.join(output_src, '*.xyls')) + \
-            glob(os.path.join(output_src, '*.match')) + \
-            glob(os.path.join(output_src, '*.new')) + \
-            glob(os.path.join(output_src, '*.rdls')) + \
-            glob(os.path.join(output_src, '*.solved'))
-
-        # list of lists created by combining globs
-        lists_of_file_paths = [fits_file_paths, cfg_file_paths, other_soln_file_paths]
+        if batch_dir is None:
+            batch_dir = os.path.join(__resources_dir__, 'fits_files')
+        output_src = batch_dir
 
         irods_fits_output_dst = mk_irods_path('modified_fits')
         irods_cfg_output_dst = mk_irods_path('astrometrica_config_files')
         irods_other_soln_output_dst = mk_irods_path('other_solution_files')
 
-        output_dsts = [irods_fits_output_dst, irods_cfg_output_dst,
-                       irods_other_soln_output_dst]
+        # one listing of the directory, each file kept, packed or dropped
+        # according to the retention policy
+        retained = self.retention_policy.sort(sorted(os.listdir(output_src)))
+        for filename in retained[DROP]:
+            os.remove(os.path.join(output_src, filename))
+
+        uploads = []
+        for filename in retained[KEEP]:
+            # compressed frames go back compressed
+            kind = artifact_type(filename)
+            if kind == 'fits':
+                output_dst = irods_fits_output_dst
+            elif kind == 'cfg':
+                output_dst = irods_cfg_output_dst
+            else:
+                output_dst = irods_other_soln_output_dst
+            uploads.append((os.path.join(output_src, filename), output_dst))
+
+        # the packed files are deleted once their archive is uploaded
+        packed_paths = [os.path.join(output_src, filename)
+                        for filename in retained[PACK]]
+        archive_path = None
+        if packed_paths:
+            archive_path = pack(packed_paths, os.path.join(
+                output_src, frame_base(retained[PACK][0]) + ARCHIVE_SUFFIX))
+            uploads.append((archive_path, irods_other_soln_output_dst))
+
+        if self.upload_planner is None:
+            results = self.uploader.upload(uploads)
+        else:
+            plan = self.upload_planner.plan(uploads, source_keys)
+            plan.report(dry_run=self.upload_dry_run)
+            if self.upload_dry_run:
+                results = self.uploader.upload(uploads)
+            else:
+                results = self.uploader.skip(plan.unchanged) + \
+                    self.uploader.upload(plan.to_upload)
+            self.upload_planner.record(results, source_keys)
 
-        for soln_file_paths, output_dst in zip(lists_of_file_paths, output_dsts):
-            self._move_to_irods_store(sess, output_src, soln_file_paths, output_dst)
+        if archive_path is not None:
+            results = self._unpack_result(results, archive_path, packed_paths)
+        return results
+
+    @staticmethod
+    def _unpack_result(results, archive_path, packed_paths):
+        """Settle the files packed into an archive by how its upload went.
+
+        If the archive was uploaded, its files are deleted. Otherwise the
+        archive is, and its failure is reported against each of its files,
+        which are left to be packed again by a resumed run.
+
+        :return: The results, with the archive's failure (if any) replaced
+            by one for each file in it.
+        """
+        archive_result = next(result for result in results
+                              if result.local_path == archive_path)
+        if archive_result.succeeded:
+            for path in packed_paths:
+                os.remove(path)
+            return results
+
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+        return [result for result in results if result is not archive_result] \
+            + [archive_result._replace(local_path=path)
+               for path in packed_paths]
 
     def _get_irods_session(self):
         iplant_params = self.iplant_params
@@ -307,56 +1029,34 @@ class Astrogen(object):
             zone=iplant_params['zone']
         )
 
-    def _move_to_irods_store(self, sess, output_src, files_glob, output_irods_dst):
-        """Move files to an irods store.
+    def _get_data_objects(self, slice_number=None):
+        """Get and clean data objects from an iRODS collection on iPlant.
 
-        Note: overwrites files that are identically named.
+        The collection is listed lazily, a page at a time, so the first
+        frames can be fetched while the rest are still being listed. Only
+        FITS files (compressed or not) whose names match name_pattern are
+        listed, and with recursive_listing the subcollections are too; of
+        the frames there sharing a name, only the first is passed on (see
+        unique_names).
 
-        :param output_irods_dst:
-        :param files_glob:
-        :param output_src:
-        :param sess:
-        :return:
+        :param int slice_number: Optionally, the slice (see slice_of) to
+            pass on the data objects of, leaving out the rest.
         """
-        try:
-            sess.collections.create(output_irods_dst)
-        except:  # TODO get exception name
-            pass
-            
-        for filename in files_glob:
-            basename = os.path.basename(filename)
-            iplant_filepath = os.path.join(output_irods_dst, basename)
-
-            # create irods file to store the local file
-            try:
-                obj = sess.data_objects.create(iplant_filepath)
-            except UserInputException as e: 
-               logging.info("File {} not moved. Exception details: {}".
-                     format(filename, e))
-               continue
-            finally:
-               os.remove(filename)
-
-            # copy the local file
-            with obj.open('w+') as f, open(filename, 'r') as g:
-                f.write(g.read())
-
-            # TODO rm local file
-
-    def _get_data_objects(self):
-        """Get and clean data objects from an iRODS collection on iPlant."""
         iplant_params = self.iplant_params
 
         logging.info("Reading data from {} as {} ...".
                      format(iplant_params['host'], self.user))
 
-        sess = self._get_irods_session()
-        coll = sess.collections.get(iplant_params['iplant_filepath'])
-        data_objects = coll.data_objects
-        # cleaned_data_objects = \
-        #     filter(lambda x: x.name.lower().endswith('.fits') or
-        #                      x.name.lower().endswith('.arch'),
-        #            data_objects)
+        data_objects = list_data_objects(
+            self.session_pool, iplant_params['iplant_filepath'],
+            name_patterns(self.listing_name_pattern),
+            self.recursive_listing)
+        if slice_number is not None:
+            data_objects = (
+                data_object for data_object in data_objects
+                if slice_of(data_object.name, self.num_slices) == slice_number)
+        if self.recursive_listing:
+            data_objects = unique_names(data_objects)
         return data_objects
 
     @staticmethod
@@ -399,28 +1099,17 @@ class Astrogen(object):
 
     @staticmethod
     def _passes_muster(hdus):
-        """Up or down vote on a list of hdus. Currently a no-op."""
-        # TODO useful for later, if we decide to filter
-        # header = hdus[0].header  # first element is primary HDU, we don't use others
-        # dt = Preprocessor._extract_datetime(header['DATE-OBS'][0])
-        # image_type = header['VIMTYPE'][0][1:-1].strip()
-        # ao_loop_state = header['AOLOOPST'][0][1:-1].strip()
-        # shutter_state = header['VSHUTTER'][0][1:-1].strip()
-        return True
+        """Up or down vote on a list of hdus, by the primary HDU's header.
+        Frames are triaged before download (see triage.py); this is for
+        files already at hand.
+        """
+        header = dict(hdus[0].header.items())
+        return Triage().check_header(header) is None
 
-    @staticmethod
-    def _add_to_local_batch(data_object):
+    def _add_to_local_batch(self, data_object):
         """Add a FITS file from iPlant datastore to a local batch.
 
+        Goes through the same session pool as batched downloads, so it is
+        safe to call from several threads.
         """
-        # TODO decorate for IO error catching
-        try:
-            name = data_object.name
-            # write to temp. local file
-            filepath = os.path.join(__batch_dir__, name)
-            with open(filepath, 'w') as f:
-                with data_object.open('r') as irods_f:
-                   f.write(irods_f.read())
-        except IOError:
-            logging.info('File rejected: {}.'.format(data_object.name))
-
+        self.downloader.download([data_object], __batch_dir__)
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+#
+# autoscaler.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Sizes the pool of Work Queue workers to the backlog of solve jobs, adding
+workers while it is large and releasing them as it drains.
+"""
+import logging
+import math
+import re
+import subprocess
+import time
+
+# a PBS job id, e.g. 1234567.head1
+_JOB_ID = re.compile(r'^\s*(\d+(?:\[\d*\])?\.[\w.-]+)\s*$')
+
+
+class PbsWorkerPool(object):
+    """
+    Submits and releases workers with shell commands: pbs_submit_workers to
+    add them and qdel to take them away. Each submitted worker's PBS job id
+    (read from the submit command's output) is its handle.
+    """
+    def __init__(self, submit_command, release_command='qdel {job_ids}',
+                 run_command=None):
+        """
+        :param submit_command: A callable taking a number of workers and
+            returning the shell command that submits them.
+        :param str release_command: The shell command that releases workers,
+            with a {job_ids} field.
+        :param run_command: A callable running a shell command and returning
+            its output. Defaults to subprocess.check_output; replaceable for
+            testing.
+        """
+        self.submit_command = submit_command
+        self.release_command = release_command
+        self.run_command = run_command or \
+            (lambda cmd: subprocess.check_output(cmd, shell=True))
+
+    def submit(self, num_workers):
+        """Submit workers, returning their handles."""
+        output = self.run_command(self.submit_command(num_workers))
+        job_ids = [m.group(1) for m in
+                   (_JOB_ID.match(line) for line in output.splitlines()) if m]
+        if len(job_ids) < num_workers:
+            logging.info("Submitted {} workers but only saw {} job ids; the "
+                         "others will exit on their idle timeout.".
+                         format(num_workers, len(job_ids)))
+            job_ids += [None] * (num_workers - len(job_ids))
+        return job_ids
+
+    def release(self, handles):
+        """Release workers by their handles."""
+        job_ids = [handle for handle in handles if handle is not None]
+        if job_ids:
+            try:
+                self.run_command(
+                    self.release_command.format(job_ids=' '.join(job_ids)))
+            except subprocess.CalledProcessError as e:
+                # e.g. a worker whose job already ended
+                logging.info("Releasing workers failed: {}".format(e))
+
+
+class WorkerAutoscaler(object):
+    """
+    Decides how many workers a backlog needs, from its depth and the solve
+    times seen so far, and resizes a worker pool to match within
+    [min_workers, max_workers].
+
+    The target is enough workers to drain the backlog in target_drain_time
+    seconds, but never more than the backlog can keep busy. Workers are
+    added as soon as the backlog calls for them, but released only once it
+    has called for fewer throughout a cooldown, so that a lull (e.g. the
+    tail of a shard) does not cost a qdel, then fresh submissions and their
+    wait in the PBS queue.
+    """
+    def __init__(self, worker_pool, min_workers, max_workers,
+                 target_drain_time, jobs_per_worker=1,
+                 initial_solve_time=120., cooldown_solves=3, clock=None):
+        """
+        :param worker_pool: Something with submit(n) -> handles and
+            release(handles), e.g. a PbsWorkerPool.
+        :param int min_workers: Workers kept even with an empty backlog.
+        :param int max_workers: The most workers at once.
+        :param float target_drain_time: Seconds to aim to clear the backlog in.
+        :param int jobs_per_worker: Jobs each worker runs at once (its cores).
+        :param float initial_solve_time: The solve time (seconds) assumed
+            until some have been observed.
+        :param float cooldown_solves: The cooldown before releasing workers,
+            in mean solve times.
+        :param clock: A callable returning the time in seconds. Defaults to
+            time.time; replaceable for testing.
+        """
+        self.worker_pool = worker_pool
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.target_drain_time = float(target_drain_time)
+        self.jobs_per_worker = max(1, jobs_per_worker)
+        self.initial_solve_time = float(initial_solve_time)
+        self.cooldown_solves = cooldown_solves
+        self.clock = clock or time.time
+        self.handles = []
+
+        # when the backlog started calling for fewer workers, and the most
+        # it has called for since
+        self._shrink_since = None
+        self._shrink_to = None
+
+        self._num_solves = 0
+        self._total_solve_time = 0.
+
+    @property
+    def num_workers(self):
+        return len(self.handles)
+
+    @property
+    def mean_solve_time(self):
+        if not self._num_solves:
+            return self.initial_solve_time
+        return self._total_solve_time / self._num_solves
+
+    @property
+    def cooldown(self):
+        """Seconds the backlog must call for fewer workers before any are
+        released.
+        """
+        return self.cooldown_solves * self.mean_solve_time
+
+    def observe_solve_time(self, seconds):
+        """Record how long a job took."""
+        if seconds is not None:
+            self._num_solves += 1
+            self._total_solve_time += seconds
+
+    def desired_workers(self, queue_depth):
+        """The number of workers a backlog of queue_depth jobs calls for."""
+        if queue_depth <= 0:
+            return self.min_workers
+
+        slots = queue_depth * self.mean_solve_time / self.target_drain_time
+        wanted = int(math.ceil(slots / self.jobs_per_worker))
+
+        # more workers than jobs to give them would sit idle
+        useful = int(math.ceil(float(queue_depth) / self.jobs_per_worker))
+        wanted = min(wanted, useful)
+        return min(self.max_workers, max(self.min_workers, wanted))
+
+    def update(self, queue_depth):
+        """Resize the pool for the current backlog.
+
+        :param int queue_depth: Jobs waiting or running.
+        :return: The number of workers after resizing.
+        """
+        desired = self.desired_workers(queue_depth)
+        if desired >= self.num_workers:
+            self._shrink_since = None
+            self._shrink_to = None
+        if desired > self.num_workers:
+            added = self.worker_pool.submit(desired - self.num_workers)
+            self.handles.extend(added)
+            logging.info("Autoscaler: backlog {}, added {} workers ({} total).".
+                         format(queue_depth, len(added), self.num_workers))
+        elif desired < self.num_workers:
+            now = self.clock()
+            if self._shrink_since is None:
+                self._shrink_since, self._shrink_to = now, desired
+            self._shrink_to = max(self._shrink_to, desired)
+            if now - self._shrink_since < self.cooldown:
+                return self.num_workers
+
+            # release the newest first; the oldest are likeliest to be busy
+            released = self.handles[self._shrink_to:]
+            self.handles = self.handles[:self._shrink_to]
+            self._shrink_since = None
+            self._shrink_to = None
+            self.worker_pool.release(released)
+            logging.info("Autoscaler: backlog {}, released {} workers "
+                         "({} total).".format(queue_depth, len(released),
+                                               self.num_workers))
+        return self.num_workers
+
+    def shutdown(self):
+        """Release every worker."""
+        self.worker_pool.release(self.handles)
+        self.handles = []
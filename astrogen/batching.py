@@ -0,0 +1,105 @@
+#!/usr/bin/python
+#
+# batching.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Groups data objects into batches by file count and total size.
+"""
+import logging
+
+
+class BatchBuilder(object):
+    """
+    Keeps a running count of the files and bytes added to a batch, so that
+    checking whether the batch is full is O(1).
+
+    Either limit may be None (or 0) to leave it unbounded. A single file
+    larger than max_bytes is still accepted by an empty batch, so that it
+    gets a batch of its own rather than never being processed.
+    """
+    def __init__(self, max_files=None, max_bytes=None):
+        """
+        :param int max_files: The most files in a batch.
+        :param int max_bytes: The most bytes in a batch.
+        """
+        self.max_files = max_files or None
+        self.max_bytes = max_bytes or None
+        self.items = []
+        self.num_files = 0
+        self.num_bytes = 0
+
+    def accepts(self, size):
+        """Whether a file of this many bytes can be added without going over
+        either limit.
+        """
+        if not self.items:
+            return True
+        if self.max_files is not None and self.num_files + 1 > self.max_files:
+            return False
+        if self.max_bytes is not None and self.num_bytes + size > self.max_bytes:
+            return False
+        return True
+
+    def add(self, item, size):
+        """Add an item of `size` bytes to the batch."""
+        self.items.append(item)
+        self.num_files += 1
+        self.num_bytes += size
+
+    def is_full(self):
+        if self.max_files is not None and self.num_files >= self.max_files:
+            return True
+        if self.max_bytes is not None and self.num_bytes >= self.max_bytes:
+            return True
+        return False
+
+    def take(self):
+        """Return the items in the batch and start a new, empty one."""
+        items = self.items
+        self.items = []
+        self.num_files = 0
+        self.num_bytes = 0
+        return items
+
+
+def data_object_size(data_object):
+    """The size in bytes iRODS reports for a data object, or 0 if unknown."""
+    try:
+        return int(data_object.size)
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+def plan_batches(data_objects, max_files=None, max_bytes=None):
+    """Group data objects into batches before any of them are downloaded,
+    using the sizes in their iRODS metadata.
+
+    :param data_objects: An iterable of data objects. It is consumed lazily.
+    :param int max_files: The most files in a batch.
+    :param int max_bytes: The most bytes in a batch.
+    :return: A generator of lists of data objects.
+    """
+    builder = BatchBuilder(max_files, max_bytes)
+    num_unsized = 0
+    for data_object in data_objects:
+        size = data_object_size(data_object)
+        if not size:
+            num_unsized += 1
+        if not builder.accepts(size):
+            yield builder.take()
+        builder.add(data_object, size)
+        if builder.is_full():
+            yield builder.take()
+
+    if builder.items:
+        yield builder.take()
+
+    if num_unsized:
+        logging.info("{} data objects had no size in their metadata, and "
+                     "were batched as empty files.".format(num_unsized))
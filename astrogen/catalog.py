@@ -0,0 +1,295 @@
+#!/usr/bin/python
+#
+# catalog.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+A local catalog of solved frames (where each points, its footprint and when
+it was taken), indexed for cone and time-window searches.
+"""
+import argparse
+import calendar
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from extraction import OK
+
+# the height (degrees) of the declination zones that index frame centers
+ZONE_HEIGHT = 1.0
+
+_DATE_OBS = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2}):(\d{2}(?:\.\d*)?))?$')
+
+
+class CatalogEntry(namedtuple('CatalogEntry',
+                              'name path ra dec pixel_scale rotation width '
+                              'height date_obs')):
+    """
+    A solved frame. ra and dec (of its center) are in degrees, pixel_scale in
+    arcseconds per pixel, rotation in degrees E of N, and width and height in
+    arcminutes (None if its size is unknown). path is where it was stored.
+    """
+    __slots__ = ()
+
+
+def parse_date_obs(value):
+    """A DATE-OBS value (YYYY-MM-DD or YYYY-MM-DDThh:mm:ss[.s], UT) in
+    seconds since the epoch, or None if it cannot be read.
+    """
+    if not isinstance(value, basestring):
+        return None
+    match = _DATE_OBS.match(value.strip())
+    if not match:
+        return None
+    year, month, day, hour, minute = \
+        [int(field or 0) for field in match.groups()[:5]]
+    seconds = float(match.group(6) or 0)
+    try:
+        return calendar.timegm((year, month, day, hour, minute, 0)) + seconds
+    except ValueError:
+        return None
+
+
+def angular_distance(ra1, dec1, ra2, dec2):
+    """The angle (degrees) between two positions, by the haversine formula."""
+    ra1, dec1, ra2, dec2 = map(math.radians, (ra1, dec1, ra2, dec2))
+    a = math.sin((dec2 - dec1) / 2) ** 2 + \
+        math.cos(dec1) * math.cos(dec2) * math.sin((ra2 - ra1) / 2) ** 2
+    return math.degrees(2 * math.asin(min(1., math.sqrt(a))))
+
+
+def _zone(dec):
+    return int(math.floor((dec + 90.) / ZONE_HEIGHT))
+
+
+class Catalog(object):
+    """
+    Solved frames in an SQLite database. Frames are indexed by declination
+    zone and RA, so that a cone search reads only the zones it overlaps, and
+    by observation time.
+    """
+    def __init__(self, catalog_path, shared_disk=False):
+        """
+        :param str catalog_path: The SQLite database file. Created if
+            missing.
+        :param bool shared_disk: Whether the file is on a network file
+            system, where write-ahead logging does not work; the database
+            is then kept in SQLite's default (rollback) journal mode.
+        """
+        self.catalog_path = catalog_path
+        self._lock = threading.Lock()
+
+        # the pipeline stages share the connection, behind the lock
+        self._db = sqlite3.connect(catalog_path, check_same_thread=False)
+        self._db.create_function('angular_distance', 4, angular_distance)
+        self._db.execute('PRAGMA journal_mode={}'.format(
+            'DELETE' if shared_disk else 'WAL'))
+        self._db.execute('CREATE TABLE IF NOT EXISTS frames ('
+                         'name TEXT PRIMARY KEY, '
+                         'path TEXT, '
+                         'ra REAL NOT NULL, '
+                         'dec REAL NOT NULL, '
+                         'zone INTEGER NOT NULL, '
+                         'pixel_scale REAL, '
+                         'rotation REAL, '
+                         'width REAL, '
+                         'height REAL, '
+                         'radius REAL NOT NULL, '
+                         'date_obs TEXT, '
+                         'obs_time REAL, '
+                         'added REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS frames_zone '
+                         'ON frames (zone, ra)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS frames_obs_time '
+                         'ON frames (obs_time)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS frames_radius '
+                         'ON frames (radius)')
+        self._db.commit()
+
+    def add(self, table, headers=None, paths=None):
+        """Add (or replace) the solved frames of a SolutionTable.
+
+        :param SolutionTable table: The frames' parameters. Frames without
+            a solution are skipped.
+        :param dict headers: Optionally, primary headers by frame name, for
+            the image size (NAXIS1, NAXIS2) and DATE-OBS.
+        :param dict paths: Optionally, where each frame is stored, by name.
+        :return: The number of frames added.
+        """
+        headers = headers or {}
+        paths = paths or {}
+        now = time.time()
+        records = []
+        for row in table.rows():
+            if row['status'] != OK:
+                continue
+            header = headers.get(row['name']) or {}
+            width, height = _footprint(header, row['pixel_scale'])
+            # half the diagonal: how far the frame reaches from its center
+            radius = math.hypot(width, height) / 120. if width else 0.
+            date_obs = header.get('DATE-OBS')
+            if not isinstance(date_obs, basestring):
+                date_obs = None
+            records.append((row['name'], paths.get(row['name']),
+                            row['ra'], row['dec'], _zone(row['dec']),
+                            row['pixel_scale'], row['rotation'], width, height,
+                            radius, date_obs, parse_date_obs(date_obs), now))
+
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO frames VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', records)
+            self._db.commit()
+        return len(records)
+
+    def search(self, ra=None, dec=None, radius=None, start=None, end=None,
+               limit=None):
+        """Find frames covering a position, taken in a time window, or both.
+
+        :param float ra: The position's RA, in degrees.
+        :param float dec: The position's Dec, in degrees.
+        :param float radius: Degrees around the position. A frame matches if
+            any of it may lie within radius of the position (its footprint
+            is taken as the circle about its corners).
+        :param start: The start of the window, as seconds since the epoch or
+            a DATE-OBS style string.
+        :param end: The end of the window, likewise.
+        :param int limit: Optionally, the most frames to return.
+        :return: A list of CatalogEntries, nearest (or earliest) first.
+        """
+        conditions, params = [], []
+        for bound, op in ((start, '>='), (end, '<=')):
+            if bound is None:
+                continue
+            if isinstance(bound, basestring):
+                parsed = parse_date_obs(bound)
+                if parsed is None:
+                    raise ValueError("Cannot read the time {!r}".format(bound))
+                bound = parsed
+            conditions.append('obs_time {} ?'.format(op))
+            params.append(bound)
+
+        columns = 'name, path, ra, dec, pixel_scale, rotation, width, ' \
+                  'height, date_obs'
+        with self._lock:
+            if ra is None or dec is None:
+                queries = [(conditions, params)]
+            else:
+                queries = [(conditions + cone_conditions, params + cone_params)
+                           for cone_conditions, cone_params
+                           in self._cone_queries(ra, dec, radius or 0.)]
+
+            rows = []
+            for query_conditions, query_params in queries:
+                rows.extend(self._db.execute(
+                    'SELECT {}, obs_time FROM frames {}'.format(
+                        columns,
+                        'WHERE ' + ' AND '.join(query_conditions)
+                        if query_conditions else ''),
+                    query_params).fetchall())
+
+        if ra is None or dec is None:
+            rows.sort(key=lambda row: (row[-1] is None, row[-1], row[0]))
+        else:
+            rows.sort(key=lambda row: (angular_distance(row[2], row[3],
+                                                        ra, dec), row[0]))
+        if limit is not None:
+            rows = rows[:limit]
+        return [CatalogEntry(*row[:-1]) for row in rows]
+
+    def _cone_queries(self, ra, dec, radius):
+        """Conditions finding the frames that may lie within radius of ra,
+        dec: one set for each declination zone (and RA range) to read.
+        """
+        max_radius = self._db.execute(
+            'SELECT COALESCE(MAX(radius), 0) FROM frames').fetchone()[0]
+        reach = radius + max_radius
+        dec_low, dec_high = max(-90., dec - reach), min(90., dec + reach)
+
+        # the widest RA a circle of reach spans, at its edge nearest a pole
+        widest_dec = max(abs(dec_low), abs(dec_high))
+        if widest_dec >= 90. or \
+                reach / math.cos(math.radians(widest_dec)) >= 180.:
+            ra_ranges = [(0., 360.)]
+        else:
+            half_width = reach / math.cos(math.radians(widest_dec))
+            low, high = (ra - half_width) % 360., (ra + half_width) % 360.
+            ra_ranges = [(low, high)] if low <= high \
+                else [(low, 360.), (0., high)]
+
+        distance = 'angular_distance(ra, dec, ?, ?) <= ? + radius'
+        for zone in range(_zone(dec_low), _zone(dec_high) + 1):
+            for low, high in ra_ranges:
+                yield (['zone = ?', 'ra BETWEEN ? AND ?', distance],
+                       [zone, low, high, ra, dec, radius])
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM frames').\
+                fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+def _footprint(header, pixel_scale):
+    """A frame's width and height in arcminutes, or (None, None)."""
+    sides = header.get('NAXIS1'), header.get('NAXIS2')
+    if not pixel_scale or \
+            not all(isinstance(side, int) and side > 0 for side in sides):
+        return None, None
+    return sides[0] * pixel_scale / 60., sides[1] * pixel_scale / 60.
+
+
+def main():
+    """
+    Search a catalog of solved frames.
+
+    Usage: python catalog.py path/to/catalog.sqlite [--cone RA DEC RADIUS]
+        [--start DATE-OBS] [--end DATE-OBS] [--limit N]
+    """
+    parser = argparse.ArgumentParser(
+        description="Search a catalog of solved frames.")
+    parser.add_argument('catalog_path')
+    parser.add_argument('--cone', nargs=3, type=float,
+                        metavar=('RA', 'DEC', 'RADIUS'),
+                        help="frames within RADIUS degrees of RA, DEC "
+                             "(degrees)")
+    parser.add_argument('--start', help="taken at or after, as DATE-OBS")
+    parser.add_argument('--end', help="taken at or before, as DATE-OBS")
+    parser.add_argument('--limit', type=int)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.catalog_path):
+        parser.error(args.catalog_path + " is not a catalog.")
+
+    catalog = Catalog(args.catalog_path)
+    ra, dec, radius = args.cone or (None, None, None)
+    start = time.time()
+    entries = catalog.search(ra, dec, radius, args.start, args.end,
+                             args.limit)
+    elapsed = time.time() - start
+
+    for entry in entries:
+        print("{:<60} {:>10.5f} {:>10.5f} {:>8} {}".format(
+            entry.name, entry.ra, entry.dec,
+            '{:.3f}'.format(entry.pixel_scale) if entry.pixel_scale else '-',
+            entry.date_obs or '-'))
+    print("{} of {} frames, in {:.1f} ms".format(len(entries), len(catalog),
+                                                 elapsed * 1000))
+    catalog.close()
+
+    return None
+
+
+if __name__=="__main__":
+    main()
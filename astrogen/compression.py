@@ -0,0 +1,221 @@
+#!/usr/bin/python
+#
+# compression.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Handles frames stored compressed (fpack .fz, gzip .gz or .zip): naming their
+outputs, reading their headers from the compressed bytes, and decompressing
+and recompressing them, so that they are moved compressed and decompressed
+only where they are solved.
+"""
+import gzip
+import io
+import os
+import shutil
+import struct
+import subprocess
+import zipfile
+import zlib
+from fits_header import BLOCK_SIZE, FitsHeaderError, parse_header_block, \
+    read_primary_header
+
+FPACK = 'fz'
+GZIP = 'gz'
+ZIP = 'zip'
+
+_COMPRESSIONS = {'.fz': FPACK, '.gz': GZIP, '.zip': ZIP}
+
+FITS_EXTENSIONS = ('.fit', '.fits', '.fts')
+
+# bytes read from the compressed stream at a time
+_CHUNK_SIZE = 16 * 1024
+
+# a zip member's local file header
+_ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_ZIP_LOCAL_SIGNATURE = b'PK\x03\x04'
+
+# the keywords of an fpacked image's table header that describe the image
+_FPACK_IMAGE_KEYWORDS = {'ZBITPIX': 'BITPIX', 'ZNAXIS': 'NAXIS'}
+
+
+def compression_of(filename):
+    """FPACK, GZIP or ZIP, as a filename's extension says, or None."""
+    return _COMPRESSIONS.get(os.path.splitext(filename)[1].lower())
+
+
+def uncompressed_name(filename):
+    """The name of a frame once decompressed, e.g. frame.fits for
+    frame.fits.fz.
+    """
+    if compression_of(filename) is None:
+        return filename
+    return os.path.splitext(filename)[0]
+
+
+def frame_base(filename):
+    """A frame's name without its extensions, which its outputs (.out, .cfg,
+    .wcs, ...) are named for.
+    """
+    return os.path.splitext(uncompressed_name(filename))[0]
+
+
+def is_fits_filename(filename, extensions=FITS_EXTENSIONS):
+    """Whether a filename is a FITS file's, compressed or not. A compressed
+    frame keeps its own extension, e.g. frame.fits.gz or frame.fit.zip.
+    """
+    return os.path.splitext(uncompressed_name(filename))[1].lower() in \
+        extensions
+
+
+class _InflatingReader(object):
+    """
+    Reads a deflate (or gzip) stream, decompressing only as much as is read.
+    """
+    def __init__(self, fileobj, wbits):
+        self.fileobj = fileobj
+        self._decompressor = zlib.decompressobj(wbits)
+        self._buffer = b''
+
+    def read(self, size):
+        while len(self._buffer) < size:
+            chunk = self.fileobj.read(_CHUNK_SIZE)
+            if not chunk:
+                self._buffer += self._decompressor.flush()
+                break
+            self._buffer += self._decompressor.decompress(chunk)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _zip_member_reader(fileobj):
+    """A reader of the first member of a zip file, from its local header,
+    without needing to seek to the central directory.
+    """
+    fields = _ZIP_LOCAL_HEADER.unpack(
+        fileobj.read(_ZIP_LOCAL_HEADER.size).ljust(_ZIP_LOCAL_HEADER.size))
+    signature, method = fields[0], fields[3]
+    name_length, extra_length = fields[9], fields[10]
+    if signature != _ZIP_LOCAL_SIGNATURE:
+        raise zipfile.BadZipfile("Not a zip file.")
+    fileobj.read(name_length + extra_length)
+    if method == zipfile.ZIP_STORED:
+        return fileobj
+    if method == zipfile.ZIP_DEFLATED:
+        return _InflatingReader(fileobj, -zlib.MAX_WBITS)
+    raise zipfile.BadZipfile("Unsupported zip compression method {}".
+                             format(method))
+
+
+def read_image_header(fits_file, compression=None):
+    """Read the header describing a frame's image, decompressing no more
+    than it takes.
+
+    For an fpacked frame, that is the header of the compressed image's
+    table, with ZBITPIX, ZNAXIS and ZNAXISn given as BITPIX, NAXIS and
+    NAXISn.
+
+    :param fits_file: A binary file object at the start of the frame.
+    :param str compression: FPACK, GZIP, ZIP or None.
+    :return: A dict of keyword to value.
+    """
+    if compression == GZIP:
+        return read_primary_header(_InflatingReader(fits_file,
+                                                    16 + zlib.MAX_WBITS))
+    if compression == ZIP:
+        return read_primary_header(_zip_member_reader(fits_file))
+
+    primary = read_primary_header(fits_file)
+    if compression != FPACK:
+        return primary
+
+    # the primary HDU of an fpacked file holds no data; its image follows
+    if primary.get('NAXIS'):
+        raise FitsHeaderError("Not an fpacked file.")
+    header = {}
+    while True:
+        block = fits_file.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            raise FitsHeaderError("No END card before the end of the file.")
+        if parse_header_block(block, header):
+            break
+    if header.get('ZIMAGE') is not True:
+        raise FitsHeaderError("Not an fpacked file.")
+
+    image_header = dict(header)
+    image_header['SIMPLE'] = True
+    for keyword, image_keyword in _FPACK_IMAGE_KEYWORDS.items():
+        image_header[image_keyword] = header.get(keyword)
+    for i in range(1, (header.get('ZNAXIS') or 0) + 1):
+        image_header['NAXIS{}'.format(i)] = header.get('ZNAXIS{}'.format(i))
+    return image_header
+
+
+def read_header(fits_path):
+    """read_image_header for a file, compressed as its name says."""
+    with io.open(fits_path, 'rb') as f:
+        return read_image_header(f, compression_of(fits_path))
+
+
+def decompress_command(compressed_path, fits_path):
+    """The shell command decompressing a frame, e.g. on a worker."""
+    commands = {
+        FPACK: 'funpack -S {src} > {dst}',
+        GZIP: 'gzip -dc {src} > {dst}',
+        ZIP: 'unzip -p {src} > {dst}',
+    }
+    return commands[compression_of(compressed_path)].\
+        format(src=compressed_path, dst=fits_path)
+
+
+def decompress(compressed_path, fits_path):
+    """Decompress a frame, streaming gzip and zip, and running funpack for
+    fpacked frames.
+    """
+    compression = compression_of(compressed_path)
+    if compression == FPACK:
+        _run_to_file(['funpack', '-S', compressed_path], fits_path)
+    elif compression == GZIP:
+        with gzip.open(compressed_path, 'rb') as src, \
+                io.open(fits_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    else:
+        with zipfile.ZipFile(compressed_path) as archive:
+            member = archive.namelist()[0]
+            with archive.open(member) as src, \
+                    io.open(fits_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def compress(fits_path, compressed_path, compression=None):
+    """Compress a file, as the compressed name says (or as compression
+    says), streaming it through gzip or zip, or running fpack.
+    """
+    if compression is None:
+        compression = compression_of(compressed_path)
+    tmp_path = compressed_path + '.tmp'
+    if compression == FPACK:
+        _run_to_file(['fpack', '-S', fits_path], tmp_path)
+    elif compression == GZIP:
+        with io.open(fits_path, 'rb') as src, \
+                gzip.open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    else:
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as archive:
+            archive.write(fits_path, os.path.basename(fits_path))
+    os.rename(tmp_path, compressed_path)
+
+
+def _run_to_file(command, dest_path):
+    with io.open(dest_path, 'wb') as dst:
+        exit_status = subprocess.call(command, stdout=dst)
+    if exit_status != 0:
+        os.remove(dest_path)
+        raise IOError("{} exited with status {}".format(command[0],
+                                                        exit_status))
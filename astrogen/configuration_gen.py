@@ -14,8 +14,8 @@ Generates a new configuration file for use with Astrometrica
 from astropy.io import fits
 import os
 import astrogen
-import pyfits
 import sys
+from fits_header import update_primary_header
 
 __pkg_root__ = os.path.dirname(__file__)
 __resources_dir__ = os.path.join(__pkg_root__, os.pardir, 'resources')
@@ -74,14 +74,12 @@ class ConfigFile(object):
 
     def set_fits_headers(self, fits_filename):
         """
-        Sets objctra and objctdec fits headers based on instance variables
+        Sets objctra and objctdec fits headers based on instance variables,
+        in place, without loading the image data
         """
-        fits_file = pyfits.open(fits_filename)
-        # TODO unit test for this
-        # Following lines should set headers even if they don't exist
-        # If not, will add some code later
-        fits_file[0].header["objctra"] = self.stdout_ra
-        fits_file[0].header["objctdec"] = self.stdout_dec
+        update_primary_header(fits_filename,
+                              [("OBJCTRA", self.stdout_ra),
+                               ("OBJCTDEC", self.stdout_dec)])
 
         return None
 
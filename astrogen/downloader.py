@@ -0,0 +1,117 @@
+#!/usr/bin/python
+#
+# downloader.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Fetches data objects from iPlant into a local batch directory using several
+worker threads at once.
+"""
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from Queue import Queue
+from streaming import DEFAULT_CHUNK_SIZE, stream_copy
+from throughput import ThroughputMeter
+
+
+class ParallelDownloader(object):
+    """
+    Downloads data objects concurrently, each worker borrowing a session from
+    a shared SessionPool.
+
+    Only the `path` and `name` attributes of the data objects passed in are
+    used; the objects are re-fetched through the borrowed session, so listings
+    made with one session can be downloaded over several.
+    """
+    def __init__(self, session_pool, num_workers,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param SessionPool session_pool: Where workers get their sessions.
+        :param int num_workers: The number of concurrent downloads.
+        :param int chunk_size: The size of each worker's copy buffer.
+        """
+        self.session_pool = session_pool
+        self.num_workers = max(1, int(num_workers))
+        self.chunk_size = chunk_size
+        self.meter = None
+        self.digests = {}
+
+    def download(self, data_objects, dest_dir):
+        """Download data objects into a local directory.
+
+        :param data_objects: An iterable of iRODS data objects.
+        :param str dest_dir: The local directory to write to.
+        :return: The local paths of the files that were downloaded, in the
+            order their downloads finished. The SHA-1 of each file's contents,
+            computed during the copy, is left in `digests`, keyed by name.
+        """
+        # a fresh meter per call, so each report covers one batch
+        self.meter = ThroughputMeter('Download')
+        self.digests = {}
+        work = Queue(maxsize=2 * self.num_workers)
+        downloaded = []
+        lock = threading.Lock()
+
+        def worker():
+            # one buffer per worker, reused for every file it copies
+            buf = bytearray(self.chunk_size)
+            while True:
+                data_object = work.get()
+                if data_object is None:
+                    break
+                filepath = self._fetch(data_object, dest_dir, buf)
+                if filepath is not None:
+                    with lock:
+                        downloaded.append(filepath)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(self.num_workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        self.meter.start()
+        for data_object in data_objects:
+            work.put(data_object)
+        for _ in threads:
+            work.put(None)
+        for t in threads:
+            t.join()
+        self.meter.stop()
+
+        self.meter.report()
+        return downloaded
+
+    def _fetch(self, data_object, dest_dir, buf):
+        """Copy one data object to dest_dir, returning its local path (or None
+        if the transfer failed).
+        """
+        filepath = os.path.join(dest_dir, data_object.name)
+        hasher = hashlib.sha1()
+        start = time.time()
+        try:
+            with self.session_pool.session() as sess:
+                irods_obj = sess.data_objects.get(data_object.path)
+                with io.open(filepath, 'wb') as f:
+                    with irods_obj.open('r') as irods_f:
+                        nbytes = stream_copy(irods_f, f, buf=buf,
+                                             hasher=hasher)
+        except Exception as e:
+            logging.info('File rejected: {}. Exception details: {}'.
+                         format(data_object.name, e))
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            return None
+
+        self.meter.record(data_object.name, nbytes, time.time() - start)
+        self.digests[data_object.name] = hasher.hexdigest()
+        return filepath
@@ -0,0 +1,550 @@
+#!/usr/bin/python
+#
+# executors.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Backends that run solve-field over a batch of FITS files: makeflow on Work
+Queue workers submitted through PBS, or a pool of local processes.
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from Queue import Queue
+from zipfile import BadZipfile
+from zlib import error as ZlibError
+import makeflow_gen
+from compression import compression_of, decompress, frame_base, \
+    uncompressed_name
+from makeflow_monitor import MakeflowLogWatcher, makeflow_log_path
+
+
+class SolveJob(namedtuple('SolveJob',
+                          'name fits_path output_path hints field_width')):
+    """
+    Solve one FITS file, writing solve-field's stdout to output_path. hints
+    are the frame's SolveHints, or None to solve it blind; field_width is the
+    (narrowest, widest) size of its field in arcminutes, if known. A
+    compressed fits_path (see compression) is decompressed beside itself
+    first.
+    """
+    __slots__ = ()
+
+SolveJob.__new__.__defaults__ = (None, None)
+
+
+class JobResult(namedtuple('JobResult',
+                           'name output_path exit_status runtime')):
+    """
+    The outcome of a SolveJob. exit_status is None if the job was killed for
+    running too long; runtime (seconds) is None if the backend cannot tell.
+    """
+    __slots__ = ()
+
+    @property
+    def succeeded(self):
+        return self.exit_status == 0 and os.path.exists(self.output_path) \
+            and os.path.getsize(self.output_path) > 0
+
+
+class Executor(object):
+    """
+    Runs solve jobs. Subclasses implement run(), yielding a JobResult for each
+    job as it completes.
+    """
+    def __init__(self, path_to_solve_field, path_to_netpbm, write_wcs=False):
+        """
+        :param path_to_solve_field: The absolute path to solve field.
+        :param path_to_netpbm: The absolute path to netpbm.
+        :param bool write_wcs: Whether solve-field should write each
+            solution's WCS header (<frame>.wcs) beside its frame.
+        """
+        self.path_to_solve_field = path_to_solve_field
+        self.path_to_netpbm = path_to_netpbm
+        self.write_wcs = write_wcs
+
+    def run(self, jobs, work_dir, tag=None):
+        """Run a batch of jobs.
+
+        :param list[SolveJob] jobs: The jobs to run.
+        :param str work_dir: The batch directory, where the jobs run.
+        :param str tag: Optionally, tells apart several runs in one batch
+            directory.
+        :return: A generator of JobResults, in completion order.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release whatever the executor holds between batches."""
+        pass
+
+    @staticmethod
+    def _solved(job):
+        """Whether solve-field solved a job's frame: it leaves a .solved
+        file beside the frame when it does.
+        """
+        return os.path.exists(os.path.join(
+            os.path.dirname(job.fits_path),
+            frame_base(os.path.basename(job.fits_path)) + '.solved'))
+
+
+class LocalExecutor(Executor):
+    """
+    Runs solve-field directly, in as many concurrent processes as there are
+    cores (or num_workers), killing any job that runs past job_timeout.
+    Compressed frames are decompressed by the job's thread just before
+    solving, gzip and zip streamed through memory.
+    """
+    def __init__(self, path_to_solve_field, path_to_netpbm, num_workers=None,
+                 job_timeout=None, write_wcs=False, quick_cpulimit=None,
+                 cpulimit=None):
+        """
+        :param int num_workers: The number of concurrent solve-field
+            processes. Defaults to the number of cores.
+        :param float job_timeout: Seconds before a job is killed. None (or 0)
+            for no limit.
+        :param int quick_cpulimit: Optionally, CPU seconds for a quick hinted
+            try before solving a hinted frame blind, as the makeflow backend
+            does.
+        :param int cpulimit: CPU seconds for a blind solve. Defaults to
+            makeflow_gen.DEFAULT_CPULIMIT.
+        """
+        super(LocalExecutor, self).__init__(path_to_solve_field,
+                                            path_to_netpbm, write_wcs)
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.job_timeout = job_timeout or None
+        self.quick_cpulimit = quick_cpulimit
+        self.cpulimit = cpulimit or makeflow_gen.DEFAULT_CPULIMIT
+
+    def run(self, jobs, work_dir, tag=None):
+        jobs = list(jobs)
+        work = Queue()
+        for job in jobs:
+            work.put(job)
+        results = Queue()
+
+        env = dict(os.environ)
+        env['PATH'] = self.path_to_netpbm + os.pathsep + env.get('PATH', '')
+
+        def worker():
+            while True:
+                job = work.get()
+                if job is None:
+                    break
+                results.put(self._run_job(job, work_dir, env))
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self.num_workers, len(jobs)))]
+        for t in threads:
+            t.daemon = True
+            work.put(None)
+            t.start()
+
+        for _ in jobs:
+            yield results.get()
+
+        for t in threads:
+            t.join()
+
+    def _run_job(self, job, work_dir, env):
+        fits_path = job.fits_path
+        if compression_of(fits_path) is not None:
+            fits_path = os.path.join(os.path.dirname(job.fits_path),
+                                     uncompressed_name(
+                                         os.path.basename(job.fits_path)))
+            try:
+                decompress(job.fits_path, fits_path)
+            except (EnvironmentError, EOFError, BadZipfile, ZlibError) as e:
+                logging.info("Job {} not decompressed: {}".
+                             format(job.name, e))
+                return JobResult(job.name, job.output_path, 1, None)
+
+        if job.hints is not None and self.quick_cpulimit:
+            exit_status, runtime = self._solve(
+                job, fits_path, job.hints, self.quick_cpulimit, work_dir, env)
+            if self._solved(job):
+                return JobResult(job.name, job.output_path, exit_status,
+                                 runtime)
+            # not solved quickly with the hints; solve it blind
+            exit_status, blind_runtime = self._solve(
+                job, fits_path, None, self.cpulimit, work_dir, env)
+            return JobResult(job.name, job.output_path, exit_status,
+                             runtime + blind_runtime)
+
+        exit_status, runtime = self._solve(job, fits_path, job.hints,
+                                           self.cpulimit, work_dir, env)
+        return JobResult(job.name, job.output_path, exit_status, runtime)
+
+    def _solve(self, job, fits_path, hints, cpulimit, work_dir, env):
+        """Run solve-field once over a job's frame.
+
+        :return: The exit status (None if killed) and the runtime.
+        """
+        command = makeflow_gen.solve_field_command(
+            self.path_to_solve_field, fits_path,
+            makeflow_gen.default_backend_config_path(), hints,
+            options=makeflow_gen.WCS_SOLVE_FIELD_OPTIONS if self.write_wcs
+            else makeflow_gen.SOLVE_FIELD_OPTIONS, cpulimit=cpulimit)
+
+        start = time.time()
+        with open(job.output_path, 'w') as out:
+            # own process group, so a timeout kills solve-field's children too
+            proc = subprocess.Popen(command, shell=True, stdout=out,
+                                    cwd=work_dir, env=env,
+                                    preexec_fn=os.setsid)
+            timed_out = []
+            timer = None
+            if self.job_timeout is not None:
+                timer = threading.Timer(self.job_timeout, self._kill,
+                                        args=(proc, timed_out))
+                timer.start()
+            exit_status = proc.wait()
+            if timer is not None:
+                timer.cancel()
+
+        runtime = time.time() - start
+        if timed_out:
+            logging.info("Job {} killed after {:.0f} s.".
+                         format(job.name, runtime))
+            exit_status = None
+        return exit_status, runtime
+
+    @staticmethod
+    def _kill(proc, timed_out):
+        timed_out.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:  # already finished
+            pass
+
+
+class MakeflowExecutor(Executor):
+    """
+    Runs a batch as a makeflow on Work Queue, with workers submitted to PBS
+    by pbs_submit_workers.
+    """
+    def __init__(self, path_to_solve_field, path_to_netpbm, makeflows_dir,
+                 project_name, pbs_params, num_workers, poll_interval=5.0,
+                 autoscaler=None, shard_size=None, resources=None,
+                 quick_cpulimit=None, cpulimit=None, index_files=None,
+                 write_wcs=False):
+        """
+        :param str makeflows_dir: Where the generated makeflows are written.
+        :param str project_name: The Work Queue project name.
+        :param dict pbs_params: PBS options for the workers: group_list,
+            queue, select, walltime and cput.
+        :param int num_workers: The number of workers to submit, if not
+            autoscaling. They are submitted once, with the first makeflow,
+            and serve every makeflow of the run.
+        :param float poll_interval: Seconds between looks at the makeflow
+            log.
+        :param autoscaler: Optionally, a WorkerAutoscaler that sizes the
+            workers to the backlog instead. Its workers outlive a batch, and
+            serve the next one too; they are not scaled down between
+            batches.
+        :param int shard_size: Optionally, the most rules in one makeflow.
+            Shards are named for their contents rather than the batch.
+        :param dict resources: Optionally, makeflow_gen.Resources for the
+            hinted and blind categories of rule.
+        :param int quick_cpulimit: Optionally, CPU seconds for a quick hinted
+            try before solving a hinted frame blind.
+        :param int cpulimit: CPU seconds for a blind solve. Defaults to
+            makeflow_gen.DEFAULT_CPULIMIT.
+        :param dict index_files: Optionally, the index files by scale, to
+            send to workers (cached there) with solve-field and a backend
+            config, rather than have them read from the shared filesystem.
+
+        Categories, tiered tries and bundled index files need shards;
+        without a shard_size the batch is written by makeflow_gen as before.
+        """
+        super(MakeflowExecutor, self).__init__(path_to_solve_field,
+                                               path_to_netpbm, write_wcs)
+        self.makeflows_dir = makeflows_dir
+        self.project_name = project_name
+        self.pbs_params = pbs_params
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self.autoscaler = autoscaler
+        self.shard_size = shard_size
+        self.resources = resources
+        self.quick_cpulimit = quick_cpulimit
+        self.cpulimit = cpulimit or makeflow_gen.DEFAULT_CPULIMIT
+        self.index_files = index_files
+        self._workers_submitted = False
+
+    def run(self, jobs, work_dir, tag=None):
+        """Run a batch as a makeflow, yielding each job's result as soon as
+        the makeflow log shows its rule finished.
+
+        With a shard_size, the batch is split into makeflows of at most that
+        many rules, run one after another. With a quick_cpulimit too, hinted
+        frames are first tried with that limit alone, in the hinted category;
+        those it does not solve are then solved blind, in makeflows of their
+        own, in the blind category.
+        """
+        jobs = list(jobs)
+        quick = self.shard_size and self.quick_cpulimit
+        unsolved = []
+        for result, job in self._run_makeflows(jobs, work_dir, tag):
+            if quick and job.hints and not self._solved(job):
+                unsolved.append(job)
+                continue
+            yield result
+
+        if unsolved:
+            logging.info("{} hinted frames not solved in {} s; solving them "
+                         "blind.".format(len(unsolved), self.quick_cpulimit))
+            blind_jobs = [job._replace(hints=None) for job in unsolved]
+            for result, _ in self._run_makeflows(blind_jobs, work_dir, tag):
+                yield result
+
+    def _run_makeflows(self, jobs, work_dir, tag):
+        """Write and run the makeflow(s) for jobs, yielding each result with
+        its job.
+        """
+        fits_filenames = [os.path.basename(job.fits_path) for job in jobs]
+        hints = dict((os.path.basename(job.fits_path), job.hints)
+                     for job in jobs if job.hints)
+
+        if self.shard_size:
+            makeflow_paths = makeflow_gen.sharded_makeflow_gen(
+                fits_filenames,
+                self.path_to_solve_field,
+                self.path_to_netpbm,
+                work_dir,
+                self.makeflows_dir,
+                shard_size=self.shard_size,
+                hints=hints,
+                resources=self.resources,
+                quick_cpulimit=self.quick_cpulimit,
+                cpulimit=self.cpulimit,
+                index_files=self.index_files,
+                field_widths=dict((os.path.basename(job.fits_path),
+                                   job.field_width) for job in jobs),
+                write_wcs=self.write_wcs
+            )
+            shard_size = self.shard_size
+        else:
+            makeflow_name = os.path.basename(work_dir)
+            if tag is not None:
+                makeflow_name += '_' + tag
+            makeflow_path = os.path.join(self.makeflows_dir,
+                                         makeflow_name + '.mf')
+            makeflow_gen.makeflow_gen(
+                fits_filenames,
+                self.path_to_solve_field,
+                self.path_to_netpbm,
+                input_dir=work_dir,
+                makeflow_path=makeflow_path,
+                hints=hints,
+                write_wcs=self.write_wcs
+            )
+            makeflow_paths = [makeflow_path]
+            shard_size = len(jobs)
+
+        if self.autoscaler is not None:
+            self.autoscaler.update(len(jobs))
+
+        jobs_by_name = dict((job.name, job) for job in jobs)
+        # rules are written in job order, so shard i holds the ith slice
+        for i, makeflow_path in enumerate(makeflow_paths):
+            shard_jobs = jobs[i * shard_size:(i + 1) * shard_size]
+            jobs_after = max(0, len(jobs) - (i + 1) * shard_size)
+            for result in self._run_shard(makeflow_path, shard_jobs, work_dir,
+                                          jobs_after):
+                yield result, jobs_by_name[result.name]
+
+    def _run_shard(self, makeflow_path, jobs, work_dir, jobs_after):
+        """Run one makeflow, whose rules are the given jobs in order.
+
+        :param int jobs_after: Jobs in the shards still to run, counted in
+            the backlog the autoscaler sees.
+        """
+        # each rule targets its job's .out
+        jobs_by_target = dict(
+            (os.path.basename(job.output_path), job) for job in jobs)
+        watcher = MakeflowLogWatcher(
+            makeflow_log_path(makeflow_path),
+            [os.path.basename(job.output_path) for job in jobs])
+
+        on_poll = None
+        if self.autoscaler is not None:
+            def on_poll(watcher):
+                if watcher.queue_depth is not None:
+                    self.autoscaler.update(watcher.queue_depth + jobs_after)
+
+        start = time.time()
+        makeflow_proc = self.start_makeflow(
+            makeflow_path, work_dir, submit_workers=self.autoscaler is None)
+        reported = set()
+        for completion in watcher.follow(lambda: makeflow_proc.poll() is None,
+                                         self.poll_interval, on_poll=on_poll):
+            if self.autoscaler is not None and completion.exit_status == 0:
+                self.autoscaler.observe_solve_time(completion.runtime)
+            job = jobs_by_target[completion.target]
+            reported.add(job.name)
+            yield JobResult(job.name, job.output_path, completion.exit_status,
+                            completion.runtime)
+        exit_status = makeflow_proc.wait()
+        self._log_finished(makeflow_path, start, exit_status)
+
+        # anything the log did not account for, e.g. if makeflow crashed
+        for job in jobs:
+            if job.name not in reported:
+                solved = os.path.exists(job.output_path) and \
+                    os.path.getsize(job.output_path) > 0
+                yield JobResult(job.name, job.output_path,
+                                0 if solved else (exit_status or 1), None)
+
+    def run_makeflow(self, makeflow_script_name, work_dir):
+        """Runs a makeflow, returning makeflow's exit status once it has
+        finished.
+
+        :param makeflow_script_name: The absolute path of the makeflow script
+            to run.
+        :param work_dir: The directory holding the batch's fits files.
+        """
+        start = time.time()
+        exit_status = self.start_makeflow(makeflow_script_name, work_dir).wait()
+        self._log_finished(makeflow_script_name, start, exit_status)
+        return exit_status
+
+    def start_makeflow(self, makeflow_script_name, work_dir,
+                       submit_workers=True):
+        """Starts makeflow and pbs_submit_workers for a makeflow script,
+        returning the makeflow process without waiting for it.
+
+        :param makeflow_script_name: The absolute path of the makeflow script
+            to run.
+        :param work_dir: The directory holding the batch's fits files.
+        :param bool submit_workers: Whether to submit num_workers workers
+            too, if not already submitted this run; not when an autoscaler
+            manages them.
+        """
+        ##
+        # Get the shell, stand on head so that `module load` works
+        #
+        echo_out = subprocess.check_output('echo $SHELL', shell=True)
+        shell = os.path.basename(echo_out.strip())
+
+        # edge case: if shell is ksh93, use 'ksh'
+        if shell.startswith('ksh'):
+            shell = 'ksh'
+
+        # called for this particular shell
+        module_init = '/usr/share/Modules/init/' + shell
+
+        ##
+        # build makeflow, pbs_submit_workers commands
+        #
+        makeflow_cmd = 'cd {outputs_dir} && ' \
+              'makeflow --wrapper \'. {shell_module}\' ' \
+                  '-T wq ' \
+                  '-a ' \
+                  '-N {project_name} ' \
+                  '-l {log_path} ' \
+              '{makeflow_script_name}'.\
+            format(outputs_dir=work_dir,
+                   shell_module=module_init,
+                   project_name=self.project_name,
+                   log_path=makeflow_log_path(makeflow_script_name),
+                   makeflow_script_name=makeflow_script_name)
+
+        ##
+        # call commands
+        #
+        print ('Now calling makeflow and pbs_submit_workers (you may want to '
+              'watch {} for .out files in a couple of minutes) ...'.
+               format(work_dir))
+        makeflow_output_dst = os.path.join(work_dir, 'makeflow_output')
+
+        if submit_workers:
+            self._submit_workers()
+        # the child keeps its own copy of the descriptor
+        with open(makeflow_output_dst, 'w') as f2:
+            return subprocess.Popen(makeflow_cmd, shell=True, stdout=f2)
+
+    def _submit_workers(self):
+        """Submit num_workers workers with pbs_submit_workers, unless they
+        were already submitted this run, waiting for the submission (not the
+        workers) to finish. Its output is left in makeflows_dir.
+
+        :return: pbs_submit_workers' exit status, or None if the workers
+            were already submitted.
+        """
+        if self._workers_submitted:
+            return None
+        self._workers_submitted = True
+
+        pbs_output_dst = os.path.join(self.makeflows_dir, 'pbs_output')
+        with open(pbs_output_dst, 'w') as f1:
+            exit_status = subprocess.call(
+                self.pbs_submit_command(self.num_workers), shell=True,
+                stdout=f1)
+        if exit_status != 0:
+            logging.error("pbs_submit_workers exited with status {}; see {}.".
+                          format(exit_status, pbs_output_dst))
+        return exit_status
+
+    @staticmethod
+    def _log_finished(makeflow_script_name, start, exit_status):
+        print ('... batch complete.')
+        t = time.localtime()
+        logging.info('finished a batch on {day}-{mo}-{year} at {hour}:{min}:{sec}'.format(
+                day=t.tm_mday, mo=t.tm_mon, year=t.tm_year, hour=t.tm_hour,
+                min=t.tm_min, sec=t.tm_sec))
+        logging.info("Makeflow {} finished in {:.0f} s with status {}.".
+                     format(makeflow_script_name, time.time() - start,
+                            exit_status))
+
+    def close(self):
+        """Release any workers the autoscaler still holds."""
+        if self.autoscaler is not None:
+            self.autoscaler.shutdown()
+
+    def pbs_submit_command(self, num_workers):
+        """The pbs_submit_workers command line submitting num_workers
+        workers for this project.
+        """
+        return 'pbs_submit_workers ' \
+               '-d all ' \
+               '-N {project_name} ' \
+               '-p "-N {project_name} ' \
+                   '-W group_list={group_list} ' \
+                   '-q {queue} ' \
+                   '-l jobtype=serial ' \
+                   '-l {select} ' \
+                   '-l place=pack:shared ' \
+                   '-l walltime={walltime} ' \
+                   '-l cput={cput}" ' \
+               '{num_workers}'.format(project_name=self.project_name,
+                                      num_workers=num_workers,
+                                      **self.pbs_params)
+
+
+def make_executor(backend, path_to_solve_field, path_to_netpbm, **kwargs):
+    """Build the executor named in astrogen.cfg.
+
+    :param str backend: 'makeflow' or 'local'.
+    :param kwargs: Passed on to the executor's constructor.
+    """
+    executors = {
+        'makeflow': MakeflowExecutor,
+        'local': LocalExecutor,
+    }
+    try:
+        executor_class = executors[backend]
+    except KeyError:
+        raise ValueError("Unknown executor backend: {}. Expected one of {}.".
+                         format(backend, ', '.join(sorted(executors))))
+    return executor_class(path_to_solve_field, path_to_netpbm, **kwargs)
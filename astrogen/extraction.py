@@ -0,0 +1,355 @@
+#!/usr/bin/python
+#
+# extraction.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Extracts the parameters of solved frames for a whole batch at once, and
+writes the Astrometrica configuration files from them.
+
+Parameters come from solve-field's stdout, or (in WCS mode) from the WCS
+header solve-field writes beside a solved frame.
+"""
+import csv
+import logging
+import math
+import os
+import re
+import threading
+from multiprocessing.pool import ThreadPool
+from fits_header import read_primary_header
+
+# lines of solve-field's stdout describing a solution
+_PIXEL_SCALE = re.compile(r'pixel scale ([-+\d.eE]+) arcsec/pix')
+_FIELD_CENTER = re.compile(
+    r'Field center: \(RA,Dec\) = \(\s*([-+\d.eE]+),\s*([-+\d.eE]+)\)')
+_FIELD_CENTER_HMS = re.compile(
+    r'Field center: \(RA H:M:S, Dec D:M:S\) = \(\s*([-+\d:.]+),\s*([-+\d:.]+)\)')
+_FIELD_ROTATION = re.compile(
+    r'Field rotation angle: up is ([-+\d.eE]+) degrees ([EW]) of N')
+
+# arcseconds per radian
+_ARCSEC_PER_RADIAN = 206265.
+
+# the pixel size (mm) assumed if the template does not give one
+DEFAULT_PIXEL_SIZE = 0.03
+
+# where parameters are read from: solve-field's stdout (<frame>.out), or the
+# solution's WCS header (<frame>.wcs)
+STDOUT = 'stdout'
+WCS = 'wcs'
+EXTRACTION_MODES = (STDOUT, WCS)
+
+# status of a frame in a SolutionTable
+OK = 'ok'
+UNSOLVED = 'unsolved'
+ERROR = 'error'
+
+
+def parse_solve_output(lines):
+    """Pull a solution out of solve-field's stdout.
+
+    :param lines: The lines of a .out file.
+    :return: A dict with any of ra and dec (degrees), ra_hms and dec_dms
+        (space separated sexagesimal, as Astrometrica writes them),
+        pixel_scale (arcsec/pixel) and rotation (degrees E of N) that were
+        found.
+    """
+    solution = {}
+    for line in lines:
+        if 'pixel scale' in line and 'pixel_scale' not in solution:
+            match = _PIXEL_SCALE.search(line)
+            if match:
+                solution['pixel_scale'] = float(match.group(1))
+        elif line.startswith('Field center'):
+            match = _FIELD_CENTER.search(line)
+            if match:
+                solution['ra'] = float(match.group(1))
+                solution['dec'] = float(match.group(2))
+                continue
+            match = _FIELD_CENTER_HMS.search(line)
+            if match:
+                solution['ra_hms'] = match.group(1).replace(':', ' ')
+                solution['dec_dms'] = match.group(2).replace(':', ' ')
+        elif line.startswith('Field rotation'):
+            match = _FIELD_ROTATION.search(line)
+            if match:
+                rotation = float(match.group(1))
+                solution['rotation'] = \
+                    rotation if match.group(2) == 'E' else -rotation
+    return solution
+
+
+def read_solve_output(stdout_filename):
+    """parse_solve_output for a .out file."""
+    with open(stdout_filename, 'r') as f:
+        return parse_solve_output(f)
+
+
+def parse_wcs_header(header):
+    """Derive a solution from the TAN WCS header of a solved frame.
+
+    The center is that of the image (IMAGEW by IMAGEH pixels, as solve-field
+    records them), or the reference point if the header does not give the
+    image size. SIP distortion terms are ignored; they move the center by a
+    small fraction of a pixel.
+
+    :param dict header: The header of a .wcs file.
+    :return: A dict like parse_solve_output's, empty if the header holds no
+        CD matrix.
+    """
+    try:
+        cd = [[float(header['CD1_1']), float(header['CD1_2'])],
+              [float(header['CD2_1']), float(header['CD2_2'])]]
+        ra0 = float(header['CRVAL1'])
+        dec0 = float(header['CRVAL2'])
+    except (KeyError, TypeError, ValueError):
+        return {}
+
+    ra, dec = ra0, dec0
+    width, height = header.get('IMAGEW'), header.get('IMAGEH')
+    if width and height and 'CRPIX1' in header and 'CRPIX2' in header:
+        dx = (width + 1) / 2. - header['CRPIX1']
+        dy = (height + 1) / 2. - header['CRPIX2']
+        ra, dec = _deproject_tan(ra0, dec0,
+                                 cd[0][0] * dx + cd[0][1] * dy,
+                                 cd[1][0] * dx + cd[1][1] * dy)
+
+    det = cd[0][0] * cd[1][1] - cd[0][1] * cd[1][0]
+    if not det:
+        return {}
+    # as astrometry.net's tan_get_orientation, which solve-field reports
+    parity = 1. if det >= 0 else -1.
+    rotation = -math.degrees(math.atan2(parity * cd[1][0] - cd[0][1],
+                                        parity * cd[0][0] + cd[1][1]))
+    return {'ra': ra, 'dec': dec,
+            'ra_hms': _sexagesimal(ra / 15., 3, signed=False),
+            'dec_dms': _sexagesimal(dec, 2, signed=True),
+            'pixel_scale': math.sqrt(abs(det)) * 3600.,
+            'rotation': rotation}
+
+
+def read_wcs(wcs_filename):
+    """parse_wcs_header for a .wcs file."""
+    return parse_wcs_header(read_primary_header(wcs_filename))
+
+
+def _deproject_tan(ra0, dec0, x, y):
+    """The RA and Dec (degrees) of the point at intermediate world
+    coordinates x, y (degrees) of a gnomonic projection about ra0, dec0.
+    """
+    xi, eta = math.radians(x), math.radians(y)
+    rho = math.hypot(xi, eta)
+    if not rho:
+        return ra0, dec0
+    c = math.atan(rho)
+    dec0 = math.radians(dec0)
+    dec = math.asin(math.cos(c) * math.sin(dec0) +
+                    eta * math.sin(c) * math.cos(dec0) / rho)
+    ra = ra0 + math.degrees(math.atan2(
+        xi * math.sin(c),
+        rho * math.cos(dec0) * math.cos(c) - eta * math.sin(dec0) * math.sin(c)))
+    return ra % 360., math.degrees(dec)
+
+
+def _sexagesimal(value, decimals, signed):
+    """value as space separated sexagesimal, e.g. '12 30 00.000'."""
+    sign = '-' if value < 0 else '+'
+    scale = 10 ** decimals
+    # rounded once, in units of the last digit, so 59.9999 carries over
+    units = int(round(abs(value) * 3600 * scale))
+    whole, seconds = divmod(units, 60 * scale)
+    degrees, minutes = divmod(whole, 60)
+    text = '{:02d} {:02d} {:0{width}.{decimals}f}'.format(
+        degrees, minutes, seconds / float(scale),
+        width=decimals + 3, decimals=decimals)
+    return sign + text if signed else text
+
+
+class SolutionTable(object):
+    """
+    The parameters of a number of frames, held as one list per column. A
+    frame whose status is not OK has None for its values.
+    """
+    COLUMNS = ('name', 'ra', 'dec', 'ra_hms', 'dec_dms', 'pixel_scale',
+               'rotation', 'focal_length', 'status')
+
+    def __init__(self):
+        self.columns = dict((column, []) for column in self.COLUMNS)
+
+    def __len__(self):
+        return len(self.columns['name'])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def append(self, **row):
+        for column in self.COLUMNS:
+            self.columns[column].append(row.get(column))
+
+    def extend(self, other):
+        for column in self.COLUMNS:
+            self.columns[column].extend(other.columns[column])
+
+    def rows(self):
+        """The frames, as dicts."""
+        for values in zip(*[self.columns[c] for c in self.COLUMNS]):
+            yield dict(zip(self.COLUMNS, values))
+
+    def names_with_status(self, status):
+        return [name for name, s in zip(self['name'], self['status'])
+                if s == status]
+
+    def write_csv(self, csv_file, header=True):
+        """Write the table as CSV, one frame per line.
+
+        :param csv_file: A file object, open for writing.
+        :param bool header: Whether to write the column names first.
+        """
+        writer = csv.writer(csv_file)
+        if header:
+            writer.writerow(self.COLUMNS)
+        writer.writerows(zip(*[self.columns[c] for c in self.COLUMNS]))
+
+
+class BatchExtractor(object):
+    """
+    Extracts the parameters of many solved frames at once: the stdout files
+    (or WCS headers) are parsed by a pool of threads, and the configuration
+    template is read only once.
+    """
+    def __init__(self, template_filename, num_workers=4, mode=STDOUT):
+        """
+        :param str template_filename: The Astrometrica configuration
+            template.
+        :param int num_workers: The number of threads parsing outputs.
+        :param str mode: STDOUT or WCS, where to read parameters from.
+        """
+        if mode not in EXTRACTION_MODES:
+            raise ValueError("Unknown extraction mode: {}. Expected one of "
+                             "{}.".format(mode, ', '.join(EXTRACTION_MODES)))
+        self.mode = mode
+        with open(template_filename, 'r') as template:
+            self.template_lines = template.readlines()
+        self.pixel_size = self._template_value('PixelWide',
+                                               DEFAULT_PIXEL_SIZE)
+        self.num_workers = max(1, num_workers)
+
+    def _template_value(self, key, default):
+        for line in self.template_lines:
+            if line.startswith(key + '='):
+                try:
+                    return float(line.split('=', 1)[1])
+                except ValueError:
+                    break
+        return default
+
+    def read_solution(self, base_path):
+        """The solution of one frame, as parse_solve_output returns it.
+
+        :param str base_path: The frame's path, less the extension; its .out
+            or .wcs file is read, as the mode says. A frame without a .wcs
+            file was not solved.
+        """
+        if self.mode == WCS:
+            wcs_path = base_path + '.wcs'
+            if not os.path.exists(wcs_path):
+                return {}
+            return read_wcs(wcs_path)
+        return read_solve_output(base_path + '.out')
+
+    def extract(self, stdout_filenames):
+        """Extract the parameters of frames from their solve-field stdout,
+        or from the .wcs files beside it in WCS mode.
+
+        :param stdout_filenames: The frames' .out files. A frame is named
+            for its .out file's basename, less the extension.
+        :return: A SolutionTable, in the order given.
+        """
+        stdout_filenames = list(stdout_filenames)
+        table = SolutionTable()
+        if not stdout_filenames:
+            return table
+
+        if len(stdout_filenames) == 1:
+            # e.g. a frame extracted as soon as it is solved
+            rows = [self._extract_one(stdout_filenames[0])]
+        else:
+            pool = ThreadPool(min(self.num_workers, len(stdout_filenames)))
+            try:
+                rows = pool.map(self._extract_one, stdout_filenames)
+            finally:
+                pool.close()
+                pool.join()
+        for row in rows:
+            table.append(**row)
+        return table
+
+    def _extract_one(self, stdout_filename):
+        base_path = os.path.splitext(stdout_filename)[0]
+        name = os.path.basename(base_path)
+        try:
+            solution = self.read_solution(base_path)
+        except (IOError, ValueError) as e:
+            logging.info("Parameters not extracted for {}: {}".
+                         format(name, e))
+            return {'name': name, 'status': ERROR}
+
+        if 'pixel_scale' not in solution or 'ra_hms' not in solution \
+                or not solution['pixel_scale']:
+            return {'name': name, 'status': UNSOLVED}
+        solution.setdefault('rotation', 0.)
+        solution['focal_length'] = \
+            _ARCSEC_PER_RADIAN * self.pixel_size / solution['pixel_scale']
+        solution.update(name=name, status=OK)
+        return solution
+
+    def write_configs(self, table, dest_dir):
+        """Write an Astrometrica configuration file for each frame of a table
+        that was solved.
+
+        :param SolutionTable table: The extracted parameters.
+        :param str dest_dir: Where to write the files, as <name>.cfg.
+        :return: The paths written.
+        """
+        paths = []
+        for row in table.rows():
+            if row['status'] != OK:
+                continue
+            path = os.path.join(dest_dir, row['name'] + '.cfg')
+            with open(path, 'w') as new_cfg:
+                new_cfg.writelines(self.config_lines(row))
+            paths.append(path)
+        return paths
+
+    def config_lines(self, row):
+        """The template, with the focal length and position angle of a
+        frame.
+        """
+        for line in self.template_lines:
+            if "FocalLength" in line:
+                yield "FocalLength=" + str(row['focal_length']) + "\n"
+            elif "PA" in line and "VarPA" not in line:
+                yield "PA=" + str(row['rotation']) + "\n"
+            else:
+                yield line
+
+
+class SolutionLog(object):
+    """
+    A CSV file that the tables of every batch in a run are appended to.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, table):
+        with self._lock:
+            is_new = not os.path.exists(self.path)
+            with open(self.path, 'ab') as f:
+                table.write_csv(f, header=is_new)
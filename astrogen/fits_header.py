@@ -0,0 +1,271 @@
+#!/usr/bin/python
+#
+# fits_header.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Reads and updates the primary header of a FITS file without reading (or
+parsing) the data that follows it.
+"""
+import io
+import mmap
+import os
+import re
+import shutil
+import tempfile
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# keywords that repeat and carry no value
+_COMMENTARY = ('COMMENT', 'HISTORY', '')
+
+_KEYWORD = re.compile(r'^[A-Z0-9_-]{1,8}$')
+_END_CARD = b'END'.ljust(CARD_SIZE)
+
+
+class FitsHeaderError(ValueError):
+    """The bytes read are not a FITS primary header."""
+    pass
+
+
+def read_primary_header(fits_file):
+    """Read the primary header of a FITS file, block by block, stopping at
+    the END card.
+
+    :param fits_file: A path, or a binary file object positioned at the start
+        of the FITS file.
+    :return: A dict of keyword to value. Strings are unquoted, T/F become
+        bools, and numbers become ints or floats.
+    """
+    if isinstance(fits_file, basestring):
+        with io.open(fits_file, 'rb') as f:
+            return read_primary_header(f)
+
+    header = {}
+    first = True
+    while True:
+        block = fits_file.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            raise FitsHeaderError("No END card before the end of the file.")
+        if first and not block.startswith(b'SIMPLE  ='):
+            raise FitsHeaderError("Not a FITS file.")
+        first = False
+
+        if parse_header_block(block, header):
+            return header
+
+
+def parse_header_block(block, header):
+    """Parse the cards of one header block into header.
+
+    :param bytes block: BLOCK_SIZE bytes of header.
+    :param dict header: Updated with the block's keywords.
+    :return: Whether the block held the END card.
+    """
+    for start in range(0, len(block), CARD_SIZE):
+        card = block[start:start + CARD_SIZE].decode('ascii', 'replace')
+        keyword = card[:8].strip()
+        if keyword == 'END':
+            return True
+        if keyword in _COMMENTARY or card[8:10] != '= ':
+            continue
+        header[keyword] = parse_value(card[10:])
+    return False
+
+
+def parse_value(text):
+    """Parse the value field of a header card (everything after '= ')."""
+    text = text.strip()
+    if text.startswith("'"):
+        # a string; a doubled quote is a literal one
+        value, i = [], 1
+        while i < len(text):
+            if text[i] == "'":
+                if text[i + 1:i + 2] == "'":
+                    value.append("'")
+                    i += 2
+                    continue
+                break
+            value.append(text[i])
+            i += 1
+        return ''.join(value).rstrip()
+
+    value = text.split('/', 1)[0].strip()
+    if value == 'T':
+        return True
+    if value == 'F':
+        return False
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace('D', 'E'))
+    except ValueError:
+        return value or None
+
+
+def format_card(keyword, value, comment=None):
+    """Format a header card, in the fixed format.
+
+    :param str keyword: The keyword; it is upper cased.
+    :param value: A string, bool, int or float. For COMMENT and HISTORY, the
+        text.
+    :param str comment: Optionally, the card's comment.
+    :return: The CARD_SIZE bytes of the card.
+    """
+    keyword = keyword.upper()
+    if keyword in ('COMMENT', 'HISTORY'):
+        card = '{:<8}{}'.format(keyword, value)
+    elif not _KEYWORD.match(keyword):
+        raise FitsHeaderError("Not a FITS keyword: {!r}".format(keyword))
+    else:
+        card = '{:<8}= {}'.format(keyword, _format_value(value))
+        if comment:
+            card += ' / ' + comment
+    if len(card) > CARD_SIZE:
+        raise FitsHeaderError("Card too long: {!r}".format(card))
+    return card.ljust(CARD_SIZE).encode('ascii')
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '{:>20}'.format('T' if value else 'F')
+    if isinstance(value, (int, long)):
+        return '{:>20d}'.format(value)
+    if isinstance(value, float):
+        text = '{:.16G}'.format(value)
+        if '.' not in text:
+            # a real keeps its decimal point, e.g. 1.E-05
+            mantissa, e, exponent = text.partition('E')
+            text = mantissa + '.' + e + exponent
+        return '{:>20}'.format(text)
+    # a string, padded to at least 8 characters inside its quotes
+    return "{:<20}".format("'{:<8}'".format(value.replace("'", "''")))
+
+
+def update_primary_header(fits_path, cards, use_mmap=False):
+    """Set cards of a FITS file's primary header, touching nothing else.
+
+    A card replaces the first of its keyword; other cards go before the END
+    card. If they fit in the header's padding, only the header blocks that
+    changed are written, in place. Otherwise the file is rewritten with a
+    header one or more blocks longer, the data streamed across unread.
+
+    :param str fits_path: The FITS file.
+    :param cards: (keyword, value) or (keyword, value, comment) tuples.
+    :param bool use_mmap: Whether to map the header into memory rather than
+        read and write it, e.g. when updating many files.
+    :return: True if the header was updated in place, False if the file was
+        rewritten.
+    """
+    new_cards = [format_card(*card) for card in cards]
+    with io.open(fits_path, 'r+b') as f:
+        if use_mmap:
+            mapped = mmap.mmap(f.fileno(), 0)
+            try:
+                header = _read_header_blocks(
+                    lambda i: mapped[i * BLOCK_SIZE:(i + 1) * BLOCK_SIZE])
+                updated = _with_cards(header, new_cards)
+                if len(updated) == len(header):
+                    for start in _changed_blocks(header, updated):
+                        mapped[start:start + BLOCK_SIZE] = \
+                            bytes(updated[start:start + BLOCK_SIZE])
+                    mapped.flush()
+                    return True
+            finally:
+                mapped.close()
+        else:
+            header = _read_header_blocks(lambda i: f.read(BLOCK_SIZE))
+            updated = _with_cards(header, new_cards)
+            if len(updated) == len(header):
+                for start in _changed_blocks(header, updated):
+                    f.seek(start)
+                    f.write(updated[start:start + BLOCK_SIZE])
+                return True
+
+    _rewrite_with_header(fits_path, updated, len(header))
+    return False
+
+
+def _read_header_blocks(read_block):
+    """The raw primary header, through its END card's block.
+
+    :param read_block: A callable returning the ith block.
+    """
+    header = bytearray()
+    i = 0
+    while True:
+        block = read_block(i)
+        if len(block) < BLOCK_SIZE:
+            raise FitsHeaderError("No END card before the end of the file.")
+        if i == 0 and not block.startswith(b'SIMPLE  ='):
+            raise FitsHeaderError("Not a FITS file.")
+        header.extend(block)
+        if _end_card_index(block) is not None:
+            return header
+        i += 1
+
+
+def _end_card_index(header):
+    for start in range(0, len(header), CARD_SIZE):
+        if header[start:start + CARD_SIZE].rstrip() == b'END':
+            return start // CARD_SIZE
+    return None
+
+
+def _with_cards(header, new_cards):
+    """header with new_cards set, padded to whole blocks."""
+    end = _end_card_index(header)
+    cards = [bytes(header[start:start + CARD_SIZE])
+             for start in range(0, end * CARD_SIZE, CARD_SIZE)]
+    positions = {}
+    for i, card in enumerate(cards):
+        keyword = card[:8].strip()
+        if card[8:10] == b'= ':
+            positions.setdefault(keyword, i)
+
+    for card in new_cards:
+        keyword = card[:8].strip()
+        if keyword in positions and keyword not in _COMMENTARY:
+            cards[positions[keyword]] = card
+        else:
+            positions[keyword] = len(cards)
+            cards.append(card)
+    cards.append(_END_CARD)
+
+    updated = bytearray(b''.join(cards))
+    blocks = max(len(header), -(-len(updated) // BLOCK_SIZE) * BLOCK_SIZE)
+    updated.extend(b' ' * (blocks - len(updated)))
+    return updated
+
+
+def _changed_blocks(header, updated):
+    return [start for start in range(0, len(header), BLOCK_SIZE)
+            if header[start:start + BLOCK_SIZE] !=
+            updated[start:start + BLOCK_SIZE]]
+
+
+def _rewrite_with_header(fits_path, header, old_header_size):
+    """Replace a FITS file's header with a longer one, copying what follows
+    the old header across in chunks.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp',
+                                    dir=os.path.dirname(
+                                        os.path.abspath(fits_path)))
+    try:
+        with os.fdopen(fd, 'wb') as dst, io.open(fits_path, 'rb') as src:
+            dst.write(header)
+            src.seek(old_header_size)
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        shutil.copymode(fits_path, tmp_path)
+        os.rename(tmp_path, fits_path)
+    except:
+        os.remove(tmp_path)
+        raise
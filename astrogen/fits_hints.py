@@ -0,0 +1,226 @@
+#!/usr/bin/python
+#
+# fits_hints.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Derives solve-field hints (where the frame points, and its plate scale) from
+FITS headers, so that solve-field need not search the whole sky.
+"""
+import logging
+import zipfile
+import zlib
+from collections import namedtuple
+from compression import read_header
+from extraction import read_solve_output
+from fits_header import FitsHeaderError
+
+# arcseconds per radian / 1000: a micron pixel at a millimetre focal length
+_ARCSEC_PER_MICRON_MM = 206.265
+
+
+class SolveHints(namedtuple('SolveHints',
+                            'ra dec radius scale_low scale_high')):
+    """
+    Hints for solving one frame. ra, dec and radius are in degrees and
+    scale_low and scale_high in arcseconds per pixel; any may be None if the
+    headers did not say.
+    """
+    __slots__ = ()
+
+    @property
+    def has_position(self):
+        return self.ra is not None and self.dec is not None
+
+    @property
+    def has_scale(self):
+        return self.scale_low is not None and self.scale_high is not None
+
+    def __nonzero__(self):
+        return self.has_position or self.has_scale
+
+
+def parse_angle(value, hours=False):
+    """Parse an RA or Dec header value in degrees.
+
+    :param value: A number of degrees, or a sexagesimal string
+        ('12 34 56.7', '12:34:56.7' or '-05 06 07').
+    :param bool hours: Whether a sexagesimal value is in hours (as RA is).
+    :return: Degrees, or None if the value cannot be read.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    fields = value.replace(':', ' ').split()
+    if not fields:
+        return None
+    try:
+        numbers = [float(field) for field in fields]
+    except ValueError:
+        return None
+    if len(numbers) == 1:
+        # a bare number in a string is already in degrees
+        return numbers[0]
+
+    sign = -1. if fields[0].startswith('-') else 1.
+    degrees = abs(numbers[0])
+    for i, number in enumerate(numbers[1:3]):
+        degrees += number / 60. ** (i + 1)
+    degrees *= sign
+    return degrees * 15. if hours else degrees
+
+
+def hints_from_header(header, search_radius, scale_tolerance,
+                      default_pixel_size=None,
+                      pixel_size_includes_binning=True):
+    """Hints for a frame from its primary header.
+
+    The pointing comes from OBJCTRA/OBJCTDEC (or RA/DEC), and the scale from
+    the pixel size (XPIXSZ, microns), binning (XBINNING) and focal length
+    (FOCALLEN, mm).
+
+    :param dict header: The frame's primary header.
+    :param float search_radius: Degrees around the pointing to search.
+    :param float scale_tolerance: The fraction either side of the computed
+        scale to allow, e.g. 0.1 for +/- 10%.
+    :param float default_pixel_size: Microns, if the header has no XPIXSZ.
+    :param bool pixel_size_includes_binning: Whether XPIXSZ is already the
+        binned pixel size (as MaxIm DL writes it).
+    :return: SolveHints, false if the header had nothing to go on.
+    """
+    ra = parse_angle(header.get('OBJCTRA', header.get('RA')), hours=True)
+    dec = parse_angle(header.get('OBJCTDEC', header.get('DEC')))
+    if ra is None or dec is None or not -90. <= dec <= 90.:
+        ra = dec = None
+
+    scale_low = scale_high = None
+    pixel_size = _positive(header.get('XPIXSZ')) or default_pixel_size
+    focal_length = _positive(header.get('FOCALLEN'))
+    if pixel_size and focal_length:
+        if not pixel_size_includes_binning:
+            pixel_size *= _positive(header.get('XBINNING')) or 1
+        scale = _ARCSEC_PER_MICRON_MM * pixel_size / focal_length
+        scale_low = scale * (1. - scale_tolerance)
+        scale_high = scale * (1. + scale_tolerance)
+
+    return SolveHints(ra, dec, search_radius if ra is not None else None,
+                      scale_low, scale_high)
+
+
+def probe_hints(fits_paths, headers=None, **kwargs):
+    """Hints for each of a number of FITS files, reading only their primary
+    headers (or, for compressed files, their image headers).
+
+    :param fits_paths: The files to probe.
+    :param dict headers: Optionally, filled with the header read for each
+        path, for other uses.
+    :param kwargs: Passed on to hints_from_header.
+    :return: A dict of path to SolveHints, holding only the files that had
+        something to go on.
+    """
+    hints = {}
+    for fits_path in fits_paths:
+        try:
+            header = read_header(fits_path)
+        except (IOError, FitsHeaderError, zipfile.BadZipfile,
+                zlib.error) as e:
+            logging.info("Could not read the header of {}: {}".
+                         format(fits_path, e))
+            continue
+        if headers is not None:
+            headers[fits_path] = header
+        frame_hints = hints_from_header(header, **kwargs)
+        if frame_hints:
+            hints[fits_path] = frame_hints
+    return hints
+
+
+def solution_from_stdout(stdout_filename):
+    """Where a solved frame points, and its scale, from solve-field's stdout.
+
+    :param str stdout_filename: The .out file of a solved frame.
+    :return: An (ra, dec, scale) tuple in degrees and arcseconds per pixel,
+        or None if the frame was not solved.
+    """
+    solution = read_solve_output(stdout_filename)
+    try:
+        return solution['ra'], solution['dec'], solution['pixel_scale']
+    except KeyError:
+        return None
+
+
+def hints_from_solution(solution, search_radius, scale_tolerance):
+    """Hints for a frame taken close (in time and pointing) to an already
+    solved one.
+
+    :param tuple solution: The (ra, dec, scale) of the solved frame.
+    :param float search_radius: Degrees around its center to search.
+    :param float scale_tolerance: The fraction either side of its scale to
+        allow.
+    """
+    ra, dec, scale = solution
+    return SolveHints(ra, dec, search_radius,
+                      scale * (1. - scale_tolerance),
+                      scale * (1. + scale_tolerance))
+
+
+def _positive(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool) \
+            and value > 0:
+        return float(value)
+    return None
+
+
+class HintReport(object):
+    """
+    Compares the runtimes of hinted and blind solves, to estimate the solve
+    time the hints saved.
+    """
+    def __init__(self):
+        self.hinted = []
+        self.blind = []
+
+    def record(self, hinted, runtime):
+        """Record a successful solve's runtime (seconds)."""
+        if runtime is not None:
+            (self.hinted if hinted else self.blind).append(runtime)
+
+    @staticmethod
+    def _mean(runtimes):
+        return sum(runtimes) / len(runtimes) if runtimes else None
+
+    def time_saved(self, blind_runtime=None):
+        """Seconds saved by hinting, estimated as what the hinted frames
+        would have taken at the mean blind runtime, less what they took.
+
+        :param float blind_runtime: The blind runtime to assume, if this run
+            solved no frames blind.
+        :return: Seconds, or None if there is nothing to compare against.
+        """
+        blind_runtime = self._mean(self.blind) or blind_runtime
+        if blind_runtime is None or not self.hinted:
+            return None
+        return blind_runtime * len(self.hinted) - sum(self.hinted)
+
+    def report(self, blind_runtime=None):
+        """Log the comparison."""
+        mean_hinted = self._mean(self.hinted)
+        mean_blind = self._mean(self.blind)
+        logging.info("Hinted solves: {} (mean {}); blind solves: {} (mean {})".
+                     format(len(self.hinted), _seconds(mean_hinted),
+                            len(self.blind), _seconds(mean_blind)))
+        saved = self.time_saved(blind_runtime)
+        if saved is not None:
+            logging.info("Header hints saved an estimated {:.0f} s of solve "
+                         "time.".format(saved))
+
+
+def _seconds(value):
+    return 'n/a' if value is None else '{:.1f} s'.format(value)
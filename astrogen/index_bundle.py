@@ -0,0 +1,150 @@
+#!/usr/bin/python
+#
+# index_bundle.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Picks the astrometry.net index files a set of frames needs, from the range of
+their field sizes, and writes a backend config that loads just those from a
+worker's own directory.
+"""
+import hashlib
+import os
+import re
+import tempfile
+
+# the quad diameters (arcminutes) of each index scale: scale n (index-20n,
+# index-420n, ...) holds quads from _QUAD_SIZES[n] to _QUAD_SIZES[n + 1]
+_QUAD_SIZES = [2.0, 2.8, 4.0, 5.6, 8.0, 11., 16., 22., 30., 42., 60., 85.,
+               120., 170., 240., 340., 480., 680., 1000., 1400., 2000.]
+
+# the arcsec-per-pixel bounds of a blind solve (-u app -L 0.3 -H 3.0)
+BLIND_SCALE = (0.3, 3.0)
+
+# astrometry.net's advice: quads from 10% of the field size up to its size
+MIN_QUAD_FRACTION = 0.1
+
+_INDEX_NAME = re.compile(r'^index-(\d+)(?:-\d+)?\.fits?$')
+
+
+def index_scale(filename):
+    """The scale number of an index file, e.g. 3 for index-203-05.fits or
+    index-4203-05.fits, or None if the name is not an index file's.
+    """
+    match = _INDEX_NAME.match(os.path.basename(filename))
+    if not match:
+        return None
+    scale = int(match.group(1)) % 100
+    return scale if scale < len(_QUAD_SIZES) - 1 else None
+
+
+def find_index_files(index_dir):
+    """The index files in a directory.
+
+    :param str index_dir: A directory of index files, as named in a backend
+        config's add_path.
+    :return: A dict of scale number to a sorted list of paths.
+    """
+    index_files = {}
+    for filename in sorted(os.listdir(index_dir)):
+        scale = index_scale(filename)
+        if scale is not None:
+            index_files.setdefault(scale, []).append(
+                os.path.join(os.path.abspath(index_dir), filename))
+    return index_files
+
+
+def field_width(header, hints=None):
+    """The range of a frame's field size, in arcminutes.
+
+    :param dict header: The frame's primary header, for NAXIS1 and NAXIS2.
+    :param hints: The frame's SolveHints, for its scale. Without a scale the
+        blind solve's bounds are assumed.
+    :return: A (narrowest, widest) tuple, or None if the header does not give
+        the image size.
+    """
+    header = header or {}
+    sides = [header.get('NAXIS1'), header.get('NAXIS2')]
+    if not all(isinstance(side, int) and side > 0 for side in sides):
+        return None
+    if hints is not None and hints.has_scale:
+        scale_low, scale_high = hints.scale_low, hints.scale_high
+    else:
+        scale_low, scale_high = BLIND_SCALE
+    return scale_low * min(sides) / 60., scale_high * max(sides) / 60.
+
+
+def scales_for_fields(field_widths):
+    """The index scales needed to solve fields of the given sizes.
+
+    :param field_widths: (narrowest, widest) tuples, in arcminutes.
+    :return: A sorted list of scale numbers.
+    """
+    scales = set()
+    for narrowest, widest in field_widths:
+        smallest_quad = MIN_QUAD_FRACTION * narrowest
+        for scale in range(len(_QUAD_SIZES) - 1):
+            if _QUAD_SIZES[scale] <= widest and \
+                    _QUAD_SIZES[scale + 1] >= smallest_quad:
+                scales.add(scale)
+    return sorted(scales)
+
+
+def select_index_files(index_files, field_widths):
+    """The index files a set of frames needs.
+
+    :param dict index_files: As returned by find_index_files.
+    :param field_widths: A (narrowest, widest) tuple for each frame, or None
+        for a frame whose size is unknown (which then needs every index).
+    :return: A sorted list of paths.
+    """
+    field_widths = list(field_widths)
+    if not field_widths or None in field_widths:
+        scales = index_files.keys()
+    else:
+        scales = scales_for_fields(field_widths)
+    return sorted(path for scale in scales
+                  for path in index_files.get(scale, []))
+
+
+def write_bundle_config(template_path, index_paths, dest_dir):
+    """Write a backend config loading the given index files from the
+    directory solve-field runs in, rather than from a shared add_path.
+
+    Everything else (cpulimit, inparallel, ...) is kept from the template.
+    The config is named for its contents, so frames needing the same index
+    files share it.
+
+    :param str template_path: The backend config to start from.
+    :param index_paths: The index files, which a worker will have under
+        their basenames.
+    :param str dest_dir: Where to write the config.
+    :return: The config's path.
+    """
+    lines = []
+    with open(template_path, 'r') as template:
+        for line in template:
+            keyword = line.split(None, 1)[0] if line.strip() else ''
+            if keyword in ('add_path', 'autoindex', 'index'):
+                continue
+            lines.append(line)
+    lines.append('\n# index files fetched to the worker with each job\n')
+    lines.append('add_path .\n')
+    lines.extend('index {}\n'.format(os.path.basename(path))
+                 for path in index_paths)
+    contents = ''.join(lines)
+
+    config_path = os.path.join(
+        dest_dir,
+        'astrometry_{}.cfg'.format(hashlib.sha1(contents).hexdigest()[:16]))
+    if not os.path.exists(config_path):
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=dest_dir)
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.rename(tmp_path, config_path)
+    return config_path
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+#
+# irods_listing.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Lists iRODS collections with metadata (GenQuery) queries, a page of rows at
+a time, so that a large collection's data objects can be used as they
+arrive rather than after the whole listing is in memory.
+"""
+import copy
+import logging
+from collections import namedtuple
+from irods.column import Criterion
+from irods.models import Collection, DataObject
+from compression import FITS_EXTENSIONS, FPACK, GZIP, ZIP
+
+class ListedObject(namedtuple('ListedObject', 'path name size')):
+    """A data object as listed: enough to batch, triage and fetch it, in
+    place of an iRODSDataObject.
+    """
+    __slots__ = ()
+
+    @property
+    def collection(self):
+        return self.path[:-len(self.name) - 1]
+
+
+def any_of(column, op, values):
+    """A condition that a column compares (op, e.g. 'like') to any of the
+    values.
+
+    GenQuery takes one condition per column, so the alternatives go into
+    that one condition, joined by '||'.
+    """
+    criterion = Criterion(op, column, values[0])
+    criterion.value = ' || {} '.format(op).join(
+        column.type.to_irods(value) for value in values)
+    return criterion
+
+
+def name_patterns(name_pattern='%', extensions=FITS_EXTENSIONS):
+    """LIKE patterns for the names of FITS files, compressed or not, whose
+    names (before the extension) match name_pattern.
+
+    LIKE is case sensitive, so each extension is matched in lower and upper
+    case.
+    """
+    patterns = []
+    for extension in extensions:
+        for compression in ('', FPACK, GZIP, ZIP):
+            suffix = extension + ('.' + compression if compression else '')
+            for cased in (suffix.lower(), suffix.upper()):
+                patterns.append(name_pattern + cased)
+    return patterns
+
+
+def _at_offset(query, offset):
+    """The query, starting offset rows in.
+
+    python-irodsclient 0.4.0's filter() replaces a query's offset() method
+    with a number, so the offset is set on a copy instead, as offset() would.
+    """
+    query = copy.copy(query)
+    query._offset = offset
+    return query
+
+
+def _paged(fetch_page):
+    """Yield the rows of fetch_page(offset) for successive offsets, until
+    a page comes back empty.
+
+    How many rows a page holds is up to the server (GenQuery's maxRows,
+    500 by default, but it can be capped lower), so a short page is not
+    taken to be the last.
+    """
+    offset = 0
+    while True:
+        page = fetch_page(offset)
+        if not page:
+            return
+        for row in page:
+            yield row
+        offset += len(page)
+
+
+def paged_rows(query):
+    """Run a query a page at a time, yielding its rows as each page
+    arrives.
+
+    Pages are requested by offset alone, since the query returns at most a
+    page of rows at once anyway.
+
+    :param query: An irods.query.Query.
+    :return: A generator of rows (dicts of column to value).
+    """
+    return _paged(lambda offset: list(_at_offset(query, offset).all()))
+
+
+def unique_names(data_objects):
+    """Pass on data objects, leaving out any named the same as one passed
+    on before.
+
+    A batch keeps its frames, and the outputs of every frame go, under their
+    names alone, so of the frames in different subcollections sharing a
+    name only the first listed can be solved; the others would overwrite
+    it. Listings come back in the same order every time, so it is the same
+    frame on every run.
+
+    :param data_objects: An iterable of ListedObjects.
+    :return: A generator of ListedObjects.
+    """
+    first_paths = {}
+    for data_object in data_objects:
+        first_path = first_paths.setdefault(data_object.name,
+                                            data_object.path)
+        if first_path == data_object.path:
+            yield data_object
+        else:
+            logging.info("{} not solved: its name is taken by {}.".
+                         format(data_object.path, first_path))
+
+
+def list_data_objects(session_pool, collection, patterns=None,
+                      recursive=True):
+    """List the data objects in a collection, lazily, a page at a time.
+
+    The filtering is done by iRODS, so only matching objects are sent. Each
+    page borrows a session from the pool just while it is fetched, so the
+    listing can be consumed slowly (e.g. by downloads) without holding one.
+
+    :param SessionPool session_pool: Where the queries get their sessions.
+    :param str collection: The collection's path.
+    :param patterns: Optionally, LIKE patterns (see name_patterns), one of
+        which each data object's name must match.
+    :param bool recursive: Whether to include the subcollections, at any
+        depth.
+    :return: A generator of ListedObjects.
+    """
+    collection = collection.rstrip('/')
+    if recursive:
+        in_collection = any_of(Collection.name, 'like',
+                               [collection, collection + '/%'])
+    else:
+        in_collection = Collection.name == collection
+
+    def fetch_page(offset):
+        with session_pool.session() as sess:
+            query = sess.query(Collection.name, DataObject.name,
+                               DataObject.size).filter(in_collection)
+            if patterns:
+                query = query.filter(any_of(DataObject.name, 'like',
+                                            list(patterns)))
+            return list(_at_offset(query, offset).all())
+
+    # each replica has its own row, next to the others for the object
+    last_path = None
+    for row in _paged(fetch_page):
+        # '_' in the collection's path matches any character in LIKE
+        if recursive and row[Collection.name] != collection and \
+                not row[Collection.name].startswith(collection + '/'):
+            continue
+        path = row[Collection.name] + '/' + row[DataObject.name]
+        if path != last_path:
+            yield ListedObject(path, row[DataObject.name], row[DataObject.size])
+        last_path = path
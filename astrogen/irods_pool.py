@@ -0,0 +1,102 @@
+#!/usr/bin/python
+#
+# irods_pool.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+A pool of iRODS sessions shared by the threads that move data to and from
+iPlant.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from Queue import Queue
+
+
+class SessionPool(object):
+    """
+    Hands out iRODS sessions to worker threads. At most `size` sessions are
+    opened, and each one is reused across transfers instead of reconnecting
+    for every data object.
+    """
+    def __init__(self, session_factory, size):
+        """
+        :param session_factory: A callable taking no arguments that returns a
+            new session (normally Astrogen._get_irods_session).
+        :param int size: The maximum number of sessions open at once.
+        """
+        self.session_factory = session_factory
+        self.size = max(1, int(size))
+        self._idle = Queue()
+        self._lock = threading.Lock()
+        self._sessions = []
+
+    @contextmanager
+    def session(self):
+        """Borrow a session for the duration of a `with` block.
+
+        A session whose block raised is discarded rather than returned to the
+        pool, since its connection may be in an unknown state.
+        """
+        sess = self._acquire()
+        try:
+            yield sess
+        except Exception:
+            self._discard(sess)
+            raise
+        else:
+            self._idle.put(sess)
+
+    @property
+    def num_created(self):
+        """The number of sessions currently owned by the pool."""
+        with self._lock:
+            return len(self._sessions)
+
+    def cleanup(self):
+        """Close every session the pool has opened."""
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for sess in sessions:
+            self._close(sess)
+        self._idle = Queue()
+
+    def _acquire(self):
+        with self._lock:
+            must_create = \
+                self._idle.empty() and len(self._sessions) < self.size
+            if must_create:
+                # reserve the slot before connecting, outside the lock
+                self._sessions.append(None)
+
+        if not must_create:
+            return self._idle.get()
+
+        try:
+            sess = self.session_factory()
+        except Exception:
+            with self._lock:
+                self._sessions.remove(None)
+            raise
+
+        with self._lock:
+            self._sessions[self._sessions.index(None)] = sess
+        return sess
+
+    def _discard(self, sess):
+        with self._lock:
+            if sess in self._sessions:
+                self._sessions.remove(sess)
+        self._close(sess)
+
+    @staticmethod
+    def _close(sess):
+        try:
+            sess.cleanup()
+        except Exception as e:
+            logging.info("Could not clean up iRODS session: {}".format(e))
@@ -0,0 +1,279 @@
+#!/usr/bin/python
+#
+# journal.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+A durable record of where each data object is in the pipeline, so that an
+interrupted run can be resumed.
+"""
+import os
+import sqlite3
+import sys
+import threading
+import time
+from batching import data_object_size
+
+LISTED = 'listed'
+DOWNLOADED = 'downloaded'
+SOLVED = 'solved'
+EXTRACTED = 'extracted'
+UPLOADED = 'uploaded'
+FAILED = 'failed'
+
+STATES = (LISTED, DOWNLOADED, SOLVED, EXTRACTED, UPLOADED, FAILED)
+
+# states in which a frame's local files are still needed
+IN_PROGRESS_STATES = (DOWNLOADED, SOLVED, EXTRACTED)
+
+# the detail of frames failed by triage (see triage.py), which are rejected
+# rather than left to be done
+TRIAGE_DETAIL = 'triage'
+
+# listings are committed in chunks this size
+_LISTING_COMMIT_INTERVAL = 1000
+
+
+class Journal(object):
+    """
+    Records the state of every data object of a run in an SQLite database.
+    Each state change is committed as it happens, so the journal survives the
+    process dying at any point.
+
+    Data objects are identified by their iRODS path.
+    """
+    def __init__(self, journal_path, shared_disk=False):
+        """
+        :param str journal_path: The SQLite database file. Created if missing.
+        :param bool shared_disk: Whether the file is on a network file
+            system, where write-ahead logging does not work; the database
+            is then kept in SQLite's default (rollback) journal mode.
+        """
+        self.journal_path = journal_path
+        self._lock = threading.Lock()
+
+        # the pipeline stages share the connection, behind the lock
+        self._db = sqlite3.connect(journal_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode={}'.format(
+            'DELETE' if shared_disk else 'WAL'))
+        self._db.execute('CREATE TABLE IF NOT EXISTS frames ('
+                         'path TEXT PRIMARY KEY, '
+                         'name TEXT NOT NULL, '
+                         'size INTEGER NOT NULL DEFAULT 0, '
+                         'state TEXT NOT NULL, '
+                         'local_path TEXT, '
+                         'detail TEXT, '
+                         'updated REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS frames_state '
+                         'ON frames (state)')
+        # what was uploaded where, kept across runs (clear() leaves it)
+        self._db.execute('CREATE TABLE IF NOT EXISTS uploads ('
+                         'irods_path TEXT PRIMARY KEY, '
+                         'size INTEGER NOT NULL, '
+                         'digest TEXT NOT NULL, '
+                         'source TEXT, '
+                         'updated REAL NOT NULL)')
+        columns = [row[1] for row in
+                   self._db.execute('PRAGMA table_info(uploads)')]
+        if 'source' not in columns:
+            # a journal from before uploads recorded their sources
+            self._db.execute('ALTER TABLE uploads ADD COLUMN source TEXT')
+        self._db.commit()
+
+    def clear(self):
+        """Forget every data object, e.g. before a fresh (non-resumed) run."""
+        with self._lock:
+            self._db.execute('DELETE FROM frames')
+            self._db.commit()
+
+    def listed(self, data_objects):
+        """Record data objects as listed, passing them through.
+
+        Objects already in the journal keep their state, so a resumed run
+        can re-list its collection without losing progress.
+
+        :param data_objects: An iterable of data objects. Consumed lazily.
+        :return: A generator of the same data objects.
+        """
+        pending = 0
+        for data_object in data_objects:
+            with self._lock:
+                self._db.execute(
+                    'INSERT OR IGNORE INTO frames (path, name, size, state, '
+                    'updated) VALUES (?, ?, ?, ?, ?)',
+                    (data_object.path, data_object.name,
+                     data_object_size(data_object), LISTED, time.time()))
+                pending += 1
+                if pending == _LISTING_COMMIT_INTERVAL:
+                    self._db.commit()
+                    pending = 0
+            yield data_object
+
+        with self._lock:
+            self._db.commit()
+
+    def mark(self, paths, state, local_paths=None, detail=None):
+        """Move data objects to a new state.
+
+        :param paths: The iRODS paths of the data objects.
+        :param str state: One of STATES.
+        :param local_paths: Optionally, where each object now lives locally,
+            in the same order as paths.
+        :param str detail: Optionally, why (e.g. which stage failed).
+        """
+        if state not in STATES:
+            raise ValueError("Unknown journal state: {}".format(state))
+
+        paths = list(paths)
+        now = time.time()
+        with self._lock:
+            if local_paths is None:
+                self._db.executemany(
+                    'UPDATE frames SET state = ?, detail = ?, updated = ? '
+                    'WHERE path = ?',
+                    [(state, detail, now, path) for path in paths])
+            else:
+                self._db.executemany(
+                    'UPDATE frames SET state = ?, local_path = ?, detail = ?, '
+                    'updated = ? WHERE path = ?',
+                    [(state, local_path, detail, now, path)
+                     for path, local_path in zip(paths, local_paths)])
+            self._db.commit()
+
+    def state_of(self, path):
+        """The state of a data object, or None if it was never listed."""
+        with self._lock:
+            row = self._db.execute('SELECT state FROM frames WHERE path = ?',
+                                   (path,)).fetchone()
+        return row[0] if row else None
+
+    def paths_in_state(self, *states):
+        """The paths of data objects in any of the given states."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT path FROM frames WHERE state IN ({})'.
+                format(', '.join('?' * len(states))), states).fetchall()
+        return set(row[0] for row in rows)
+
+    def in_progress(self):
+        """Data objects that were downloaded but not uploaded.
+
+        :return: A list of (path, name, state, local_path) tuples.
+        """
+        with self._lock:
+            return self._db.execute(
+                'SELECT path, name, state, local_path FROM frames '
+                'WHERE state IN ({}) ORDER BY local_path'.
+                format(', '.join('?' * len(IN_PROGRESS_STATES))),
+                IN_PROGRESS_STATES).fetchall()
+
+    def summary(self):
+        """Count the data objects (and their bytes) in each state.
+
+        Answered from the journal alone, without touching iRODS.
+
+        :return: A dict mapping state to a (count, bytes) tuple.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT state, COUNT(*), COALESCE(SUM(size), 0) FROM frames '
+                'GROUP BY state').fetchall()
+        counts = dict((state, (0, 0)) for state in STATES)
+        counts.update((state, (count, nbytes)) for state, count, nbytes in rows)
+        return counts
+
+    def remaining(self):
+        """How much work is left: the number of data objects not yet
+        uploaded, and their total size in bytes. Frames rejected by triage
+        are not counted (see rejected).
+        """
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM frames '
+                'WHERE state != ? AND NOT (state = ? AND detail LIKE ?)',
+                (UPLOADED, FAILED, TRIAGE_DETAIL + '%')).fetchone()
+
+    def rejected(self):
+        """The number of data objects rejected by triage, and their total
+        size in bytes.
+        """
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM frames '
+                'WHERE state = ? AND detail LIKE ?',
+                (FAILED, TRIAGE_DETAIL + '%')).fetchone()
+
+    def record_uploads(self, uploads):
+        """Record the size and MD5 digest of files just uploaded, and the
+        source key (see upload_planner.source_key) of those that have one.
+
+        :param uploads: An iterable of (irods path, size, hex digest, source
+            key or None) tuples.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO uploads (irods_path, size, digest, '
+                'source, updated) VALUES (?, ?, ?, ?, ?)',
+                [(irods_path, size, digest, source, now)
+                 for irods_path, size, digest, source in uploads])
+            self._db.commit()
+
+    def upload_digests(self, irods_paths):
+        """The recorded uploads among the given iRODS paths.
+
+        :return: A dict mapping iRODS path to a (size, hex digest, source
+            key) tuple.
+        """
+        irods_paths = list(irods_paths)
+        digests = {}
+        with self._lock:
+            # SQLite allows at most 999 parameters in one statement
+            for i in range(0, len(irods_paths), 500):
+                chunk = irods_paths[i:i + 500]
+                rows = self._db.execute(
+                    'SELECT irods_path, size, digest, source FROM uploads '
+                    'WHERE irods_path IN ({})'.
+                    format(', '.join('?' * len(chunk))), chunk).fetchall()
+                digests.update((row[0], row[1:]) for row in rows)
+        return digests
+
+    def close(self):
+        self._db.close()
+
+
+def main():
+    """
+    Print what is left of the run recorded in a journal, without connecting
+    to iPlant.
+
+    Usage: python journal.py path/to/journal.sqlite
+    """
+    journal_path = str(sys.argv[1])
+    if not os.path.exists(journal_path):
+        raise ValueError(journal_path + " is not a journal.")
+
+    journal = Journal(journal_path)
+    for state, (count, nbytes) in sorted(journal.summary().items(),
+                                         key=lambda x: STATES.index(x[0])):
+        print("{:<12}{:>10} files {:>12.2f} MB".
+              format(state, count, nbytes / 1024. ** 2))
+
+    count, nbytes = journal.rejected()
+    print("{:<12}{:>10} files {:>12.2f} MB".
+          format('rejected', count, nbytes / 1024. ** 2))
+    count, nbytes = journal.remaining()
+    print("{:<12}{:>10} files {:>12.2f} MB".
+          format('remaining', count, nbytes / 1024. ** 2))
+    journal.close()
+
+    return None
+
+
+if __name__=="__main__":
+    main()
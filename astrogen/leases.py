@@ -0,0 +1,327 @@
+#!/usr/bin/python
+#
+# leases.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Shares one run between several astrogen nodes. The collection is split into
+slices by a hash of each data object's name, and each node leases slices
+from a store on shared disk, one at a time, until none are left. A lease
+that is not renewed expires, and another node may then take (steal) it.
+"""
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+FREE = 'free'
+LEASED = 'leased'
+DONE = 'done'
+
+STATES = (FREE, LEASED, DONE)
+
+
+def slice_of(name, num_slices):
+    """The slice a data object belongs to, by its name, the same on every
+    node. Frames sharing a name (see irods_listing.unique_names) fall in
+    the same slice.
+    """
+    return (zlib.crc32(name) & 0xffffffff) % num_slices
+
+
+def default_node_id():
+    """This node's name: its host's, so that it is the same when the node
+    is restarted (and resumes).
+    """
+    return socket.gethostname().split('.')[0]
+
+
+def node_path(path, node_id):
+    """A node's own copy of a file, e.g. journal.sqlite becomes
+    journal.<node_id>.sqlite.
+    """
+    root, extension = os.path.splitext(path)
+    return '{}.{}{}'.format(root, node_id, extension)
+
+
+class LeaseStore(object):
+    """
+    Records which node holds each slice of the collection, and until when,
+    in an SQLite database every node can reach.
+
+    The database is kept in SQLite's default (rollback) journal mode, since
+    write-ahead logging does not work on network file systems.
+    """
+    def __init__(self, store_path, node_id, num_slices, lease_seconds):
+        """
+        :param str store_path: The SQLite database file, on disk shared by
+            the nodes. Created if missing.
+        :param str node_id: This node's name; unique among the nodes.
+        :param int num_slices: How many slices the collection is split into.
+            Every node of a run must agree.
+        :param float lease_seconds: How long a lease lasts unless renewed.
+        """
+        self.store_path = store_path
+        self.node_id = node_id
+        self.num_slices = int(num_slices)
+        self.lease_seconds = lease_seconds
+        # slices this node leased, and those since taken by other nodes
+        self.lost = set()
+        self._leased = set()
+        self._lock = threading.Lock()
+
+        # isolation_level None: transactions are begun explicitly, so that
+        # taking a lease is one atomic step across nodes
+        self._db = sqlite3.connect(store_path, timeout=60,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        with self._transaction():
+            self._db.execute('CREATE TABLE IF NOT EXISTS slices ('
+                             'slice INTEGER PRIMARY KEY, '
+                             'state TEXT NOT NULL, '
+                             'holder TEXT, '
+                             'expires REAL, '
+                             'updated REAL NOT NULL)')
+            count = self._db.execute('SELECT COUNT(*) FROM slices').\
+                fetchone()[0]
+            if count == 0:
+                now = time.time()
+                self._db.executemany(
+                    'INSERT INTO slices (slice, state, updated) '
+                    'VALUES (?, ?, ?)',
+                    [(i, FREE, now) for i in range(self.num_slices)])
+            elif count != self.num_slices:
+                raise ValueError("{} holds {} slices, not {}.".format(
+                    store_path, count, self.num_slices))
+
+    def acquire(self):
+        """Lease a free slice or, failing that, steal an expired lease.
+
+        :return: The slice number, or None if there is none to take.
+        """
+        now = time.time()
+        with self._transaction():
+            row = self._db.execute(
+                'SELECT slice, holder FROM slices WHERE state = ? '
+                'ORDER BY slice LIMIT 1', (FREE,)).fetchone()
+            if row is None:
+                row = self._db.execute(
+                    'SELECT slice, holder FROM slices WHERE state = ? AND '
+                    'expires < ? ORDER BY expires LIMIT 1',
+                    (LEASED, now)).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                'UPDATE slices SET state = ?, holder = ?, expires = ?, '
+                'updated = ? WHERE slice = ?',
+                (LEASED, self.node_id, now + self.lease_seconds, now, row[0]))
+            self._leased.add(row[0])
+
+        if row[1] is not None and row[1] != self.node_id:
+            logging.info("Slice {} taken over from node {}, whose lease "
+                         "expired.".format(row[0], row[1]))
+        else:
+            logging.info("Slice {} leased.".format(row[0]))
+        return row[0]
+
+    def renew(self):
+        """Extend this node's leases.
+
+        A slice taken by another node after its lease expired is logged and
+        added to lost.
+
+        :return: The set of slices this node still holds.
+        """
+        now = time.time()
+        with self._transaction():
+            self._db.execute(
+                'UPDATE slices SET expires = ?, updated = ? '
+                'WHERE state = ? AND holder = ?',
+                (now + self.lease_seconds, now, LEASED, self.node_id))
+            rows = self._db.execute(
+                'SELECT slice FROM slices WHERE state = ? AND holder = ?',
+                (LEASED, self.node_id)).fetchall()
+            held = set(row[0] for row in rows)
+            lost = self._leased - held
+            self._leased -= lost
+            self.lost |= lost
+        for slice_number in sorted(lost):
+            logging.info("Lease on slice {} lost to another node.".
+                         format(slice_number))
+        return held
+
+    def complete(self, slice_number):
+        """Mark a slice this node holds as done."""
+        self._set_state(slice_number, DONE)
+
+    def release(self, slice_number):
+        """Give up a slice this node holds, unfinished, for any node to
+        lease.
+        """
+        self._set_state(slice_number, FREE)
+
+    def others_stalled(self, seconds):
+        """Whether other nodes hold leases they have not renewed for the
+        given time, so that their holders have likely died and the slices
+        will be free to steal once the leases expire.
+        """
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM slices WHERE state = ? AND '
+                'holder != ? AND updated <= ?',
+                (LEASED, self.node_id, time.time() - seconds)).fetchone()[0] > 0
+
+    def summary(self):
+        """Count the slices in each state.
+
+        :return: A dict mapping state to a count.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT state, COUNT(*) FROM slices GROUP BY state').fetchall()
+        counts = dict((state, 0) for state in STATES)
+        counts.update(rows)
+        return counts
+
+    def holders(self):
+        """The unexpired leases, as a dict of node to the slices it holds."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT holder, slice FROM slices WHERE state = ? AND '
+                'expires >= ? ORDER BY slice',
+                (LEASED, time.time())).fetchall()
+        holders = {}
+        for holder, slice_number in rows:
+            holders.setdefault(holder, []).append(slice_number)
+        return holders
+
+    def reset(self):
+        """Free every slice, e.g. before a fresh run across the nodes."""
+        with self._transaction():
+            self._db.execute(
+                'UPDATE slices SET state = ?, holder = NULL, expires = NULL, '
+                'updated = ?', (FREE, time.time()))
+
+    def close(self):
+        self._db.close()
+
+    def _set_state(self, slice_number, state):
+        with self._transaction():
+            self._db.execute(
+                'UPDATE slices SET state = ?, holder = ?, expires = NULL, '
+                'updated = ? WHERE slice = ? AND state = ? AND holder = ?',
+                (state, self.node_id if state == DONE else None, time.time(),
+                 slice_number, LEASED, self.node_id))
+            self._leased.discard(slice_number)
+
+    def _transaction(self):
+        return _Transaction(self._db, self._lock)
+
+
+class _Transaction(object):
+    """An immediate (write-locked) transaction, behind the store's lock."""
+    def __init__(self, db, lock):
+        self.db = db
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.db.execute('BEGIN IMMEDIATE')
+        except Exception:
+            self.lock.release()
+            raise
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        finally:
+            self.lock.release()
+
+
+class LeaseHeartbeat(object):
+    """
+    Renews a node's leases from a background thread, often enough that they
+    do not expire while the node is alive.
+    """
+    def __init__(self, store, interval, on_beat=None):
+        """
+        :param LeaseStore store: The leases to renew.
+        :param float interval: Seconds between renewals; well under the
+            lease's length.
+        :param on_beat: Optionally, a callable run after each renewal, e.g.
+            to complete finished slices.
+        """
+        self.store = store
+        self.interval = interval
+        self.on_beat = on_beat
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.beat()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def beat(self):
+        """Renew the leases now."""
+        self.store.renew()
+        if self.on_beat is not None:
+            self.on_beat()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.beat()
+            except Exception as e:
+                # the store may be briefly unreachable; try again next beat
+                logging.info("Could not renew leases: {}".format(e))
+
+
+def main():
+    """
+    Print how far a run shared between nodes has got, or free every slice
+    for a fresh run.
+
+    Usage: python leases.py path/to/leases.sqlite [--reset]
+    """
+    store_path = str(sys.argv[1])
+    if not os.path.exists(store_path):
+        raise ValueError(store_path + " is not a lease store.")
+
+    db = sqlite3.connect(store_path)
+    num_slices = db.execute('SELECT COUNT(*) FROM slices').fetchone()[0]
+    db.close()
+    store = LeaseStore(store_path, default_node_id(), num_slices, 0)
+    if '--reset' in sys.argv[2:]:
+        store.reset()
+    for state, count in sorted(store.summary().items(),
+                               key=lambda x: STATES.index(x[0])):
+        print("{:<8}{:>6} slices".format(state, count))
+    for holder, slices in sorted(store.holders().items()):
+        print("{} holds {}".format(holder, ', '.join(map(str, slices))))
+    store.close()
+
+    return None
+
+
+if __name__=="__main__":
+    main()
@@ -12,10 +12,52 @@
 Generates a makeflow file for processing FITS files with the astrometry software 
 solve_field.
 """
+import hashlib
+import itertools
 import pdb
 import sys
 import os
+import tempfile
+from collections import namedtuple
 import astrogen
+from compression import compression_of, decompress_command, frame_base, \
+    uncompressed_name
+from index_bundle import select_index_files, write_bundle_config
+
+# the solve-field options every frame shares
+SHARED_SOLVE_FIELD_OPTIONS = '-p ' \
+                             '--wcs none ' \
+                             '--corr none ' \
+                             '--scamp-ref none ' \
+                             '--pnm none'
+SOLVE_FIELD_OPTIONS = '-p ' \
+                      '--cpulimit {cpulimit} ' \
+                      '--wcs none ' \
+                      '--corr none ' \
+                      '--scamp-ref none ' \
+                      '--pnm none'
+
+# the same, but leaving solve-field to write each solution's WCS header to
+# <frame>.wcs, for extraction in WCS mode
+SHARED_WCS_SOLVE_FIELD_OPTIONS = \
+    SHARED_SOLVE_FIELD_OPTIONS.replace('--wcs none ', '')
+WCS_SOLVE_FIELD_OPTIONS = SOLVE_FIELD_OPTIONS.replace('--wcs none ', '')
+
+DEFAULT_CPULIMIT = 600
+
+# makeflow categories: frames with hints, and frames solved blind
+HINTED, BLIND = 'hinted', 'blind'
+
+# what bundled inputs are called on a worker
+_BUNDLED_SOLVE_FIELD_DIR = 'astrometry'
+_BUNDLED_CONFIG = 'astrometry.cfg'
+
+
+class Resources(namedtuple('Resources', 'cores memory disk')):
+    """What one rule needs of a worker: cores, and memory and disk in MB."""
+    __slots__ = ()
+
+DEFAULT_SHARD_SIZE = 1000
 
 
 def get_fits_filenames(fits_source_directory):
@@ -27,7 +69,70 @@ def get_fits_filenames(fits_source_directory):
     raise ValueError(fits_source_directory + " is not a valid directory.")
 
 
-def makeflow_gen(fits_filenames, path_to_solve_field, path_to_netpbm):
+def default_backend_config_path():
+    """The absolute path of the astrometry.net backend config in resources."""
+    abs_resources_path = os.path.abspath(astrogen.__resources_dir__)
+    return os.path.join(abs_resources_path, 'astrometry.cfg')
+
+
+def solve_field_command(path_to_solve_field, path_to_input_fits,
+                        path_to_config, hints=None,
+                        options=SOLVE_FIELD_OPTIONS,
+                        cpulimit=DEFAULT_CPULIMIT):
+    """The solve-field command line for one FITS file, without redirection.
+
+    Shared by the makeflow rules and the local executor, so that both solve
+    frames identically.
+
+    :param path_to_solve_field: The absolute path to solve field.
+    :param path_to_input_fits: The path of the FITS file to solve.
+    :param path_to_config: The path of the astrometry.net backend config.
+    :param hints: Optionally, SolveHints for the frame. Without them (or for
+        whatever they lack) the frame is solved blind.
+    :param str options: The options shared by every frame, with a
+        {cpulimit} field.
+    :param int cpulimit: CPU seconds solve-field may spend on the frame.
+    """
+    scale_low, scale_high = '-u app -L 0.3 ', '-H 3.0 '
+    position = ''
+    if hints is not None and hints.has_scale:
+        scale_low = '-u arcsecperpix -L {:.4f} '.format(hints.scale_low)
+        scale_high = '-H {:.4f} '.format(hints.scale_high)
+    if hints is not None and hints.has_position:
+        position = '--ra {:.6f} --dec {:.6f} --radius {:.3f} '.\
+            format(hints.ra, hints.dec, hints.radius)
+
+    return '{solve_field_path} ' \
+               '-g ' \
+               '{scale_low}' \
+               '{options} ' \
+               '{scale_high}' \
+               '{position}' \
+               '--backend-config {path_to_config} ' \
+               '--overwrite {path_to_input_fits}'.\
+        format(
+            solve_field_path=path_to_solve_field,
+            scale_low=scale_low,
+            scale_high=scale_high,
+            options=options.format(cpulimit=cpulimit),
+            position=position,
+            path_to_config=path_to_config,
+            path_to_input_fits=path_to_input_fits
+        )
+
+
+def decompress_prefix(stored_path, fits_path):
+    """The start of a rule's command decompressing a compressed frame beside
+    itself before it is solved, or '' for a frame that is not compressed.
+    """
+    if compression_of(stored_path) is None:
+        return ''
+    return decompress_command(stored_path, fits_path) + ' && '
+
+
+def makeflow_gen(fits_filenames, path_to_solve_field, path_to_netpbm,
+                 input_dir=None, makeflow_path=None, hints=None,
+                 write_wcs=False):
     """Write out contents of fits_filenames to properly formatted makeflow file.
 
     Note that the call to makeflow that is passed this script is expected to be
@@ -35,46 +140,54 @@ def makeflow_gen(fits_filenames, path_to_solve_field, path_to_netpbm):
     For this reason, the fits_filenames are not paths.
 
     :param list[str] fits_filenames: The names (not paths) of fits filenames to
-        use.
+        use. Compressed frames (see compression) are decompressed beside
+        themselves by their rules.
     :param path_to_netpbm: The absolute path to netpbm.
     :param path_to_solve_field: The absolute path to solve field.
+    :param input_dir: The directory holding the fits files. Defaults to
+        resources/fits_files.
+    :param makeflow_path: Where to write the makeflow. Defaults to
+        output/makeflows/output.mf.
+    :param dict hints: Optionally, SolveHints by fits filename. Frames
+        without hints are solved blind.
+    :param bool write_wcs: Whether solve-field should write each solution's
+        WCS header beside its frame.
     """
-    makeflow_path = \
-        os.path.join(astrogen.__output_dir__, 'makeflows', 'output.mf')
+    if hints is None:
+        hints = {}
+    options = WCS_SOLVE_FIELD_OPTIONS if write_wcs else SOLVE_FIELD_OPTIONS
+    if makeflow_path is None:
+        makeflow_path = \
+            os.path.join(astrogen.__output_dir__, 'makeflows', 'output.mf')
     makeflow_file = open(makeflow_path, "w")
 
     abs_resources_path = os.path.abspath(astrogen.__resources_dir__)
-    backend_config_path = os.path.join(abs_resources_path, 'astrometry.cfg')
-    input_path = os.path.join(abs_resources_path, 'fits_files')
+    backend_config_path = default_backend_config_path()
+    if input_dir is None:
+        input_path = os.path.join(abs_resources_path, 'fits_files')
+    else:
+        input_path = os.path.abspath(input_dir)
 
     # This should only appear once at the top
     makeflow_file.write("export PATH={}:$PATH\n".format(path_to_netpbm))
 
     for filename in fits_filenames:
-        output_filename = os.path.splitext(os.path.basename(filename))[0] + '.out'
-        fits_path = os.path.join(input_path, filename)
+        output_filename = frame_base(os.path.basename(filename)) + '.out'
+        stored_path = os.path.join(input_path, filename)
+        fits_path = os.path.join(input_path, uncompressed_name(filename))
         makeflow_file.write(
             '{output_filename} : {path_to_input_fits} {solve_field_path}\n'
             '\tmodule load python && '
-            '{solve_field_path} '
-                '-g '
-                '-u app '
-                '-L 0.3 '
-                '-p '
-                '--cpulimit 600 '
-                '--wcs none '
-                '--corr none '
-                '--scamp-ref none '
-                '--pnm none '
-                '-H 3.0 '
-                '--backend-config {path_to_config} '
-                '--overwrite {path_to_input_fits} '
+            '{decompress}{solve_field_cmd} '
             '> {output_filename}\n\n'.
             format(
                 output_filename=output_filename,
-                path_to_input_fits=fits_path,
+                path_to_input_fits=stored_path,
                 solve_field_path=path_to_solve_field,
-                path_to_config=backend_config_path
+                decompress=decompress_prefix(stored_path, fits_path),
+                solve_field_cmd=solve_field_command(
+                    path_to_solve_field, fits_path, backend_config_path,
+                    hints.get(filename), options=options)
             )
         )
 
@@ -82,6 +195,178 @@ def makeflow_gen(fits_filenames, path_to_solve_field, path_to_netpbm):
     return None
 
 
+def sharded_makeflow_gen(fits_filenames, path_to_solve_field, path_to_netpbm,
+                         input_dir, makeflows_dir, shard_size=DEFAULT_SHARD_SIZE,
+                         hints=None, resources=None, quick_cpulimit=None,
+                         cpulimit=DEFAULT_CPULIMIT, index_files=None,
+                         field_widths=None, write_wcs=False):
+    """Write fits_filenames out as a number of smaller makeflows (shards).
+
+    Each shard defines the solve-field path, backend config, input directory
+    and shared options once, as makeflow variables, so that a rule holds only
+    what is particular to its frame. Filenames are consumed as they are
+    written, so the list may be a generator of any length.
+
+    Shards are named for a hash of their contents, so shards of different
+    batches never collide, even when written to the same directory at once.
+
+    With a quick_cpulimit, a hinted frame's rule is a hinted solve limited
+    to quick_cpulimit, run in the hinted category. The frames it does not
+    solve are for the caller to solve blind, in shards of their own, so that
+    a blind solve always runs in the blind category (see MakeflowExecutor).
+
+    :param fits_filenames: The names (not paths) of the fits files, in any
+        iterable.
+    :param path_to_solve_field: The absolute path to solve field.
+    :param path_to_netpbm: The absolute path to netpbm.
+    :param input_dir: The directory holding the fits files.
+    :param makeflows_dir: Where to write the shards.
+    :param int shard_size: The most rules in one shard.
+    :param dict hints: Optionally, SolveHints by fits filename.
+    :param dict resources: Optionally, Resources by category (HINTED and
+        BLIND), declared to Work Queue so it can run several solves on one
+        worker.
+    :param int quick_cpulimit: CPU seconds for the hinted try, or None to
+        give hinted frames cpulimit, like the rest.
+    :param int cpulimit: CPU seconds for a blind solve.
+    :param dict index_files: Optionally, the index files by scale (see
+        index_bundle.find_index_files), to bundle with each job. Workers
+        then fetch solve-field's directory, a backend config and the index
+        files a shard needs as cached inputs, instead of reading them from
+        the shared filesystem.
+    :param dict field_widths: The (narrowest, widest) field size of each
+        frame, in arcminutes, by fits filename, from which a shard's index
+        files are picked. A frame without one needs every index.
+    :param bool write_wcs: Whether solve-field should write each solution's
+        WCS header beside its frame.
+    :return: A generator of the shards' paths, each yielded once written.
+    """
+    if hints is None:
+        hints = {}
+    if field_widths is None:
+        field_widths = {}
+    header = 'export PATH={netpbm}:$PATH\n' \
+             'SOLVE_FIELD={solve_field}\n' \
+             'BACKEND_CONFIG={backend_config}\n' \
+             'INPUT_DIR={input_dir}\n' \
+             'SOLVE_OPTIONS={options}\n'.\
+        format(netpbm=path_to_netpbm,
+               solve_field=path_to_solve_field,
+               backend_config=default_backend_config_path(),
+               input_dir=os.path.abspath(input_dir),
+               options=SHARED_WCS_SOLVE_FIELD_OPTIONS if write_wcs
+               else SHARED_SOLVE_FIELD_OPTIONS)
+
+    filenames = iter(fits_filenames)
+    while True:
+        shard = list(itertools.islice(filenames, shard_size))
+        if not shard:
+            return
+        shard_header = header
+        if index_files is not None:
+            shard_header += _bundle_variables(
+                path_to_solve_field, makeflows_dir,
+                select_index_files(index_files, (field_widths.get(filename)
+                                                 for filename in shard)))
+        yield _write_shard(shard, shard_header + '\n', makeflows_dir, hints,
+                           resources, quick_cpulimit, cpulimit,
+                           bundled=index_files is not None)
+
+
+def _bundle_variables(path_to_solve_field, makeflows_dir, index_paths):
+    """The makeflow variables naming what a shard's jobs take to a worker:
+    solve-field's directory (for its helper programs), a backend config
+    loading index_paths, and index_paths themselves. Each is renamed to its
+    basename on the worker, where it is cached between jobs.
+    """
+    bundle_config = write_bundle_config(default_backend_config_path(),
+                                        index_paths, makeflows_dir)
+    return 'SOLVE_FIELD_DIR={solve_field_dir}\n' \
+           'BUNDLE_CONFIG={bundle_config}\n' \
+           'INDEX_FILES={index_files}\n'.\
+        format(solve_field_dir=os.path.dirname(path_to_solve_field),
+               bundle_config=bundle_config,
+               index_files=' '.join('{}->{}'.format(path,
+                                                    os.path.basename(path))
+                                    for path in index_paths))
+
+
+def category_declaration(category, resources):
+    """The makeflow lines putting the rules that follow in a category, and
+    declaring what each of its rules needs.
+    """
+    return 'CATEGORY={}\n' \
+           'CORES={}\n' \
+           'MEMORY={}\n' \
+           'DISK={}\n\n'.format(category, resources.cores, resources.memory,
+                                resources.disk)
+
+
+def _solve_rule(filename, hints, cpulimit, bundled=False):
+    """The rule solving one frame of a shard. A compressed frame is moved
+    compressed, and decompressed by the rule.
+    """
+    output_filename = frame_base(os.path.basename(filename)) + '.out'
+    stored_path = '$(INPUT_DIR)/' + filename
+    fits_path = '$(INPUT_DIR)/' + uncompressed_name(filename)
+    if bundled:
+        inputs = '$(SOLVE_FIELD_DIR)->{} ' \
+                 '$(BUNDLE_CONFIG)->{} ' \
+                 '$(INDEX_FILES)'.format(_BUNDLED_SOLVE_FIELD_DIR,
+                                         _BUNDLED_CONFIG)
+        solve_field = os.path.join(_BUNDLED_SOLVE_FIELD_DIR, 'solve-field')
+        backend_config = _BUNDLED_CONFIG
+    else:
+        inputs = '$(SOLVE_FIELD)'
+        solve_field = '$(SOLVE_FIELD)'
+        backend_config = '$(BACKEND_CONFIG)'
+
+    solve_cmd = '{} > {}'.format(
+        solve_field_command(solve_field, fits_path, backend_config, hints,
+                            options='--cpulimit {cpulimit} $(SOLVE_OPTIONS)',
+                            cpulimit=cpulimit),
+        output_filename)
+
+    return '{output_filename} : {stored_path} {inputs}\n' \
+           '\tmodule load python && {decompress}{solve_cmd}\n\n'.\
+        format(output_filename=output_filename, stored_path=stored_path,
+               inputs=inputs,
+               decompress=decompress_prefix(stored_path, fits_path),
+               solve_cmd=solve_cmd)
+
+
+def _write_shard(fits_filenames, header, makeflows_dir, hints, resources,
+                 quick_cpulimit, cpulimit, bundled=False):
+    """Write one shard, hashing it as it goes, and name it for the hash."""
+    digest = hashlib.sha1()
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=makeflows_dir)
+    with os.fdopen(fd, 'w') as makeflow_file:
+        def write(text):
+            digest.update(text)
+            makeflow_file.write(text)
+
+        write(header)
+        if resources:
+            # declared once each; rules then only switch between them
+            for category in (HINTED, BLIND):
+                write(category_declaration(category, resources[category]))
+        current_category = None
+        for filename in fits_filenames:
+            frame_hints = hints.get(filename)
+            category = HINTED if frame_hints is not None else BLIND
+            if resources and category != current_category:
+                write('CATEGORY={}\n'.format(category))
+                current_category = category
+            limit = quick_cpulimit \
+                if frame_hints is not None and quick_cpulimit else cpulimit
+            write(_solve_rule(filename, frame_hints, limit, bundled))
+
+    shard_path = os.path.join(makeflows_dir,
+                              'shard_{}.mf'.format(digest.hexdigest()[:16]))
+    os.rename(tmp_path, shard_path)
+    return shard_path
+
+
 def main():
     """
     DEPRECATED. This script is called from astrogen. The parameters below
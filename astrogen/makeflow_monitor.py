@@ -0,0 +1,159 @@
+#!/usr/bin/python
+#
+# makeflow_monitor.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Follows a running makeflow through its log, reporting each rule as it
+finishes.
+"""
+import os
+import time
+from collections import namedtuple
+
+# node states, as written in the makeflow log
+WAITING, RUNNING, COMPLETE, FAILED, ABORTED = range(5)
+
+_FINISHED_STATES = (COMPLETE, FAILED, ABORTED)
+
+
+class JobCompletion(namedtuple('JobCompletion',
+                               'target node_id state exit_status runtime')):
+    """
+    A makeflow rule that finished. The log does not record exit codes, so
+    exit_status is 0 for a completed rule, 1 for a failed one and None for
+    an aborted one. runtime is in seconds, or None if the rule was never
+    seen running (e.g. it was already complete when the log was recovered).
+    """
+    __slots__ = ()
+
+
+def makeflow_log_path(makeflow_script_name):
+    """Where makeflow writes the log for a script."""
+    return makeflow_script_name + '.makeflowlog'
+
+
+class MakeflowLogWatcher(object):
+    """
+    Tails a makeflow log as it grows.
+
+    Makeflow numbers the nodes of a workflow in the order their rules appear
+    in the script, so the targets passed in must be in that order too.
+    """
+    def __init__(self, log_path, targets):
+        """
+        :param str log_path: The makeflow log to follow.
+        :param list[str] targets: The target of each rule, in script order.
+        """
+        self.log_path = log_path
+        self.targets = list(targets)
+        self.nodes_waiting = None
+        self.nodes_running = None
+        self.workflow_finished = False
+
+        self._offset = 0
+        self._partial_line = ''
+        self._started = {}
+        self._reported = set()
+
+    def follow(self, is_running, poll_interval=1.0, callback=None,
+               on_poll=None):
+        """Yield a JobCompletion for every rule as it finishes.
+
+        :param is_running: A callable returning whether makeflow is still
+            running. Following stops once it is not and the log is drained.
+        :param float poll_interval: Seconds between looks at the log.
+        :param callback: Optionally, called with each JobCompletion as well.
+        :param on_poll: Optionally, called with the watcher after every look
+            at the log, e.g. to act on the queue depth.
+        """
+        while True:
+            still_running = is_running()
+            for completion in self.poll():
+                if callback is not None:
+                    callback(completion)
+                yield completion
+            if on_poll is not None:
+                on_poll(self)
+
+            if self.workflow_finished or not still_running:
+                # one more look, for lines written just before exiting
+                for completion in self.poll():
+                    if callback is not None:
+                        callback(completion)
+                    yield completion
+                return
+            time.sleep(poll_interval)
+
+    @property
+    def queue_depth(self):
+        """Rules waiting or running as of the last log line, or None before
+        the log has any.
+        """
+        if self.nodes_waiting is None:
+            return None
+        return self.nodes_waiting + self.nodes_running
+
+    def poll(self):
+        """Read whatever has been appended to the log since the last call.
+
+        :return: A list of JobCompletions for rules that finished.
+        """
+        if not os.path.exists(self.log_path):
+            return []
+
+        with open(self.log_path, 'r') as f:
+            f.seek(self._offset)
+            data = f.read()
+            self._offset = f.tell()
+
+        lines = (self._partial_line + data).split('\n')
+        # the last piece is an incomplete line (or empty)
+        self._partial_line = lines.pop()
+
+        completions = []
+        for line in lines:
+            completion = self._parse_line(line)
+            if completion is not None:
+                completions.append(completion)
+        return completions
+
+    def _parse_line(self, line):
+        if line.startswith('#'):
+            fields = line[1:].split()
+            if fields and fields[0] in ('COMPLETED', 'FAILED', 'ABORTED'):
+                self.workflow_finished = True
+            return None
+
+        fields = line.split()
+        if len(fields) < 6:
+            return None
+
+        try:
+            timestamp = int(fields[0]) / 1e6
+            node_id, state = int(fields[1]), int(fields[2])
+            self.nodes_waiting = int(fields[4])
+            self.nodes_running = int(fields[5])
+        except ValueError:
+            return None
+
+        if state == RUNNING:
+            self._started[node_id] = timestamp
+            self._reported.discard(node_id)
+            return None
+        if state not in _FINISHED_STATES or node_id in self._reported:
+            return None
+        if not 0 <= node_id < len(self.targets):
+            return None
+
+        self._reported.add(node_id)
+        started = self._started.get(node_id)
+        runtime = timestamp - started if started is not None else None
+        exit_status = {COMPLETE: 0, FAILED: 1, ABORTED: None}[state]
+        return JobCompletion(self.targets[node_id], node_id, state,
+                             exit_status, runtime)
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+#
+# pipeline.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Runs the stages of a batch (fetch, solve, extract, upload) concurrently, so
+that one batch can be downloading while another is being solved.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from Queue import Queue
+
+# marks the end of the stream of batches
+_DONE = object()
+
+
+class Batch(object):
+    """
+    A batch of FITS files and the working directory they live in. Every batch
+    gets its own directory, so that several can be in flight at once.
+    """
+    def __init__(self, batch_id, parent_dir, work_dir=None):
+        """
+        :param int batch_id: A number identifying the batch within a run.
+        :param str parent_dir: Where to create the working directory.
+        :param str work_dir: An existing working directory to adopt instead
+            of creating one (e.g. when resuming a run).
+        """
+        self.batch_id = batch_id
+        if work_dir is None:
+            if not os.path.isdir(parent_dir):
+                os.makedirs(parent_dir)
+            work_dir = tempfile.mkdtemp(
+                prefix='batch_{:05d}_'.format(batch_id), dir=parent_dir)
+        self.work_dir = work_dir
+
+        # iRODS paths by FITS filename
+        self.irods_paths = {}
+
+        # FITS filenames solved (here or in an earlier run), and those whose
+        # parameters have been extracted
+        self.solved = set()
+        self.extracted = set()
+
+        # solve cache keys by FITS filename, and the files not found there
+        self.cache_keys = {}
+        self.cache_misses = []
+
+        # download digests by FITS filename, and the header cards since
+        # written into each frame: together they stand for the frame's
+        # contents when it is uploaded
+        self.digests = {}
+        self.header_cards = {}
+
+        # solve-field hints and primary headers by FITS filename, for the
+        # frames that have them
+        self.hints = {}
+        self.headers = {}
+
+    @property
+    def name(self):
+        return os.path.basename(self.work_dir)
+
+    def is_empty(self):
+        return not os.listdir(self.work_dir)
+
+    def remove(self):
+        """Delete the working directory and everything in it."""
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def __repr__(self):
+        return 'Batch({}, {!r})'.format(self.batch_id, self.work_dir)
+
+
+class Pipeline(object):
+    """
+    A chain of stages joined by bounded queues. Each stage runs in its own
+    thread(s); a stage function receives an item from the previous stage
+    and returns the item to pass on, or None to drop it.
+
+    Items that raise in a stage are logged and dropped, so one bad batch
+    does not stall the run.
+    """
+    def __init__(self, queue_size=1):
+        """
+        :param int queue_size: How many finished items may wait between two
+            stages. This bounds how far a fast stage runs ahead of a slow one
+            (and so how many batch directories exist at once).
+        """
+        self.queue_size = max(1, int(queue_size))
+        self.stages = []
+        self.stage_seconds = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, func, num_workers=1):
+        """Append a stage to the pipeline.
+
+        :param str name: Used in log messages.
+        :param func: A callable taking one item and returning one item (or
+            None).
+        :param int num_workers: The number of threads running this stage.
+        """
+        self.stages.append((name, func, max(1, int(num_workers))))
+        self.stage_seconds[name] = 0.
+        return self
+
+    def run(self, source, source_name='fetch'):
+        """Push every item of source through the stages.
+
+        The source is consumed in a thread of its own, so a generator that
+        does work (e.g. downloads) between yields is itself a stage.
+
+        :param source: An iterable of items for the first stage.
+        :param str source_name: The name of the source stage, for logging.
+        :return: The items that made it out of the last stage.
+        """
+        queues = [Queue(maxsize=self.queue_size) for _ in self.stages]
+        results = []
+        threads = [threading.Thread(target=self._feed,
+                                    args=(source, source_name, queues[0]
+                                          if queues else None, results))]
+
+        for i, (name, func, num_workers) in enumerate(self.stages):
+            inbox = queues[i]
+            outbox = queues[i + 1] if i + 1 < len(queues) else None
+            remaining = [num_workers]
+            for _ in range(num_workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(name, func, inbox, outbox, remaining, results)))
+
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+        for name, _, _ in self.stages:
+            logging.info("Pipeline stage {} was busy for {:.2f} s".
+                         format(name, self.stage_seconds[name]))
+        return results
+
+    def _feed(self, source, source_name, outbox, results):
+        iterator = iter(source)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            except Exception as e:
+                logging.error("Pipeline stage {} failed, stopping: {}".
+                              format(source_name, e))
+                break
+            finally:
+                self._add_time(source_name, time.time() - start)
+
+            if outbox is None:
+                results.append(item)
+            else:
+                outbox.put(item)
+
+        if outbox is not None:
+            outbox.put(_DONE)
+
+    def _work(self, name, func, inbox, outbox, remaining, results):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                # let sibling workers see the end too; the last one out
+                # tells the next stage
+                inbox.put(_DONE)
+                with self._lock:
+                    remaining[0] -= 1
+                    is_last = remaining[0] == 0
+                if is_last and outbox is not None:
+                    outbox.put(_DONE)
+                return
+
+            start = time.time()
+            try:
+                item = func(item)
+            except Exception as e:
+                logging.error("Pipeline stage {} failed on {!r}: {}".
+                              format(name, item, e))
+                item = None
+            finally:
+                self._add_time(name, time.time() - start)
+
+            if item is None:
+                continue
+            if outbox is None:
+                with self._lock:
+                    results.append(item)
+            else:
+                outbox.put(item)
+
+    def _add_time(self, name, seconds):
+        with self._lock:
+            self.stage_seconds[name] = \
+                self.stage_seconds.get(name, 0.) + seconds
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+#
+# retention.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Decides what becomes of each file a batch produces: uploaded as it is,
+packed with the batch's other small files into one archive, or deleted.
+"""
+import gzip
+import os
+import tarfile
+from compression import FITS_EXTENSIONS, is_fits_filename
+
+# what becomes of an artifact
+KEEP = 'keep'
+PACK = 'pack'
+DROP = 'drop'
+
+ACTIONS = (KEEP, PACK, DROP)
+
+# the kinds of artifact a batch produces, by file extension; 'fits' is the
+# frame itself, with any FITS extension and compressed or not
+ARTIFACT_TYPES = (
+    ('fits', FITS_EXTENSIONS),
+    ('cfg', ('.cfg',)),
+    ('wcs', ('.wcs',)),
+    ('out', ('.out',)),
+    ('solved', ('.solved',)),
+    ('match', ('.match',)),
+    ('axy', ('.axy',)),
+    ('xyls', ('.xyls',)),
+    ('rdls', ('.rdls',)),
+    ('new', ('.new', '.new.fz', '.new.gz')),
+)
+
+ARCHIVE_SUFFIX = '.solutions.tar.gz'
+
+
+def artifact_type(filename):
+    """The kind of artifact a file is, or None if it is none of them."""
+    if is_fits_filename(filename):
+        return 'fits'
+    for kind, extensions in ARTIFACT_TYPES:
+        if filename.endswith(extensions):
+            return kind
+    return None
+
+
+def pack(paths, archive_path):
+    """Pack files into a gzipped tar archive, flat, by their basenames.
+
+    Times and owners are left out, so that packing the same files again
+    gives the same archive, byte for byte.
+
+    :param paths: The files to pack.
+    :param str archive_path: The archive to write; replaced if it exists.
+    :return: archive_path.
+    """
+    tmp_path = archive_path + '.tmp'
+    with open(tmp_path, 'wb') as raw:
+        gz = gzip.GzipFile(os.path.basename(archive_path), 'wb', fileobj=raw,
+                           mtime=0)
+        try:
+            tar = tarfile.open(fileobj=gz, mode='w')
+            try:
+                for path in sorted(paths, key=os.path.basename):
+                    info = tar.gettarinfo(path, os.path.basename(path))
+                    info.mtime = 0
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ''
+                    with open(path, 'rb') as f:
+                        tar.addfile(info, f)
+            finally:
+                tar.close()
+        finally:
+            gz.close()
+    os.rename(tmp_path, archive_path)
+    return archive_path
+
+
+class RetentionPolicy(object):
+    """
+    An action (keep, pack or drop) for each kind of artifact. Files that
+    are no kind of artifact are left alone.
+    """
+    def __init__(self, actions):
+        """
+        :param dict actions: Maps artifact types (see ARTIFACT_TYPES) to one
+            of ACTIONS. Types not given are kept.
+        """
+        known = set(kind for kind, _ in ARTIFACT_TYPES)
+        for kind, action in actions.items():
+            if kind not in known:
+                raise ValueError("Unknown artifact type: {}. Expected one of "
+                                 "{}.".format(kind, sorted(known)))
+            if action not in ACTIONS:
+                raise ValueError("Unknown retention action for {}: {}. "
+                                 "Expected one of {}.".
+                                 format(kind, action, ACTIONS))
+        self.actions = dict((kind, actions.get(kind, KEEP))
+                            for kind in known)
+
+    def action_for(self, filename):
+        """What to do with a file, or None if it is no artifact."""
+        kind = artifact_type(filename)
+        return self.actions[kind] if kind is not None else None
+
+    def sort(self, filenames):
+        """Sort artifacts by what is to become of them.
+
+        :param filenames: Names of files, e.g. a batch directory's listing.
+        :return: A dict mapping each of ACTIONS to a list of filenames.
+        """
+        sorted_files = dict((action, []) for action in ACTIONS)
+        for filename in filenames:
+            action = self.action_for(filename)
+            if action is not None:
+                sorted_files[action].append(filename)
+        return sorted_files
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+#
+# sequence_planner.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Groups the frames of a batch into sequences (one target, one night), so that
+one frame of each can be solved first and its solution used to seed the rest.
+"""
+import re
+from collections import namedtuple
+
+# Observer_Target_YYYYMMDD_HHMMSS..., e.g.
+# Briol_1197Rhodesia_20140630_044345_flatfield_TA_FITS.fit
+_SEQUENCE_NAME = re.compile(
+    r'^(?P<observer>[^_]+)_(?P<target>[^_]+)_(?P<date>\d{8})_(?P<time>\d{6})')
+
+
+class Sequence(namedtuple('Sequence', 'key representative followers')):
+    """
+    Frames of one target from one night. The representative is solved first;
+    the followers are solved after it, seeded from its solution.
+    """
+    __slots__ = ()
+
+
+def sequence_key(filename, header=None):
+    """What sequence a frame belongs to, and when in it it was taken.
+
+    The filename is tried first, then the OBJECT, OBSERVER and DATE-OBS
+    headers. Dates are UT dates, which for our (Arizona) sites do not change
+    during a night.
+
+    :param str filename: The frame's filename.
+    :param dict header: Optionally, the frame's primary header.
+    :return: A (key, timestamp) tuple; key is None if neither the filename
+        nor the header say.
+    """
+    match = _SEQUENCE_NAME.match(filename)
+    if match:
+        return ((match.group('observer'), match.group('target'),
+                 match.group('date')),
+                match.group('date') + match.group('time'))
+
+    header = header or {}
+    target = header.get('OBJECT')
+    date_obs = header.get('DATE-OBS')
+    if target and isinstance(date_obs, basestring) and len(date_obs) >= 10:
+        # DATE-OBS is YYYY-MM-DD or YYYY-MM-DDThh:mm:ss
+        return ((header.get('OBSERVER'), target, date_obs[:10]),
+                re.sub(r'\D', '', date_obs))
+    return None, filename
+
+
+def plan_sequences(filenames, headers=None):
+    """Group frames into sequences.
+
+    :param filenames: The frames' filenames.
+    :param dict headers: Optionally, the frames' primary headers by filename.
+    :return: A list of Sequences. Frames that fit no sequence are each a
+        sequence of their own, with no followers.
+    """
+    headers = headers or {}
+    groups = {}
+    plan = []
+    for filename in filenames:
+        key, timestamp = sequence_key(filename, headers.get(filename))
+        if key is None:
+            plan.append(Sequence(None, filename, []))
+        else:
+            groups.setdefault(key, []).append((timestamp, filename))
+
+    for key, frames in sorted(groups.items()):
+        frames.sort()
+        # the middle frame leads, being closest in time (and so in pointing)
+        # to the rest
+        middle = len(frames) // 2
+        plan.append(Sequence(key, frames[middle][1],
+                             [filename for _, filename in
+                              frames[:middle] + frames[middle + 1:]]))
+    return plan
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+#
+# solve_cache.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+A local, size-bounded cache of solve-field results, keyed by the contents of
+the FITS file that was solved.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+# the files kept for each solved frame, by extension
+CACHED_EXTENSIONS = ('.out', '.cfg', '.wcs')
+
+
+def cache_key(irods_checksum=None, local_digest=None):
+    """Make a cache key from a frame's checksum.
+
+    The iRODS checksum is preferred, since it is known before download. Both
+    kinds are hashed (with a prefix naming their source) so that keys are
+    safe to use as filenames whatever the checksum's format.
+
+    :param str irods_checksum: The checksum stored in iRODS, if any.
+    :param str local_digest: The SHA-1 hex digest of the downloaded file.
+    :return: The key, or None if neither checksum is available.
+    """
+    if irods_checksum:
+        source = 'irods:' + irods_checksum
+    elif local_digest:
+        source = 'sha1:' + local_digest
+    else:
+        return None
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+class SolveCache(object):
+    """
+    Stores the solve-field stdout (.out), Astrometrica configuration (.cfg)
+    and, if there is one, WCS header (.wcs) of solved frames. The least
+    recently used entries are evicted once the cache grows past max_bytes.
+
+    An SQLite index in the cache directory records each entry's size and
+    last use, so that lookups and eviction never walk the directory.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        """
+        :param str cache_dir: Where the cache lives. Created if missing.
+        :param int max_bytes: The most bytes of results to keep.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # stages in different threads share the connection, behind the lock
+        self._db = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'),
+                                   check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         'key TEXT PRIMARY KEY, '
+                         'size INTEGER NOT NULL, '
+                         'last_used REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_last_used '
+                         'ON entries (last_used)')
+        self._db.commit()
+
+    def get(self, key, dest_dir, basename):
+        """Restore a cached result into dest_dir.
+
+        :param str key: The frame's cache key.
+        :param str dest_dir: Where to write the results.
+        :param str basename: The frame's filename without extension; results
+            are written as basename.out, basename.cfg and basename.wcs.
+        :return: True on a hit, False on a miss.
+        """
+        with self._lock:
+            row = None
+            if key is not None:
+                row = self._db.execute(
+                    'SELECT key FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return False
+
+            try:
+                for ext in CACHED_EXTENSIONS:
+                    src = self._entry_path(key, ext)
+                    if os.path.exists(src):
+                        shutil.copyfile(src,
+                                        os.path.join(dest_dir, basename + ext))
+            except (IOError, OSError) as e:
+                logging.error("Solve cache entry {} unreadable, dropping it: "
+                              "{}".format(key, e))
+                self._remove(key)
+                self.misses += 1
+                return False
+
+            self._db.execute('UPDATE entries SET last_used = ? WHERE key = ?',
+                             (time.time(), key))
+            self._db.commit()
+            self.hits += 1
+            return True
+
+    def put(self, key, out_path, cfg_path=None, wcs_path=None):
+        """Add a solved frame's results to the cache.
+
+        :param str key: The frame's cache key.
+        :param str out_path: The solve-field stdout.
+        :param str cfg_path: The generated Astrometrica configuration file.
+        :param str wcs_path: The solution's WCS header, if written.
+        """
+        if key is None:
+            return
+
+        with self._lock:
+            entry_dir = os.path.dirname(self._entry_path(key, ''))
+            if not os.path.isdir(entry_dir):
+                os.makedirs(entry_dir)
+
+            size = 0
+            for ext, src in zip(CACHED_EXTENSIONS,
+                                (out_path, cfg_path, wcs_path)):
+                if src is not None and os.path.exists(src):
+                    dst = self._entry_path(key, ext)
+                    shutil.copyfile(src, dst)
+                    size += os.path.getsize(dst)
+
+            self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                             (key, size, time.time()))
+            self._db.commit()
+            self._evict()
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM entries WHERE key = ?',
+                                    (key,)).fetchone() is not None
+
+    @property
+    def total_bytes(self):
+        return self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def report(self):
+        """Log and return the hits and misses since the cache was opened."""
+        lookups = self.hits + self.misses
+        hit_rate = 100. * self.hits / lookups if lookups else 0.
+        summary = "Solve cache: {} hits, {} misses ({:.1f}% hit rate), " \
+                  "{:.2f} MB cached".format(self.hits, self.misses, hit_rate,
+                                            self.total_bytes / 1024. ** 2)
+        logging.info(summary)
+        return summary
+
+    def close(self):
+        self._db.close()
+
+    def _entry_path(self, key, ext):
+        # fan out over subdirectories to keep each one small
+        return os.path.join(self.cache_dir, key[:2], key + ext)
+
+    def _evict(self):
+        total = self.total_bytes
+        if total <= self.max_bytes:
+            return
+
+        rows = self._db.execute(
+            'SELECT key, size FROM entries ORDER BY last_used').fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._remove(key)
+            total -= size
+        self._db.commit()
+
+    def _remove(self, key):
+        for ext in CACHED_EXTENSIONS:
+            try:
+                os.remove(self._entry_path(key, ext))
+            except OSError:
+                pass
+        self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+#
+# streaming.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Constant-memory copying between local files and iRODS file objects.
+"""
+import time
+
+DEFAULT_CHUNK_SIZE = 1024 ** 2
+
+
+def stream_copy(src, dst, chunk_size=DEFAULT_CHUNK_SIZE, buf=None,
+                hasher=None):
+    """Copy everything readable from src to dst, one chunk at a time.
+
+    Memory use is bounded by the chunk size no matter how large the file is.
+    When src supports `readinto`, chunks are read into a single buffer that
+    is reused for the whole copy (and across copies, if the caller passes
+    its own).
+
+    Note that dst must accept memoryviews, so local files should be opened
+    with io.open rather than the builtin open.
+
+    :param src: A readable binary file-like object.
+    :param dst: A writable binary file-like object.
+    :param int chunk_size: The most bytes held in memory at once.
+    :param bytearray buf: An optional buffer to read into. Its length
+        overrides chunk_size.
+    :param hasher: An optional hashlib object, updated with every chunk so
+        that the file's digest comes for free with the copy.
+    :return: The number of bytes copied.
+    """
+    if buf is None:
+        buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    readinto = getattr(src, 'readinto', None)
+
+    total = 0
+    while True:
+        if readinto is not None:
+            n = readinto(view)
+            if not n:
+                break
+            chunk = view[:n]
+        else:
+            chunk = src.read(len(buf))
+            if not chunk:
+                break
+            n = len(chunk)
+
+        dst.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+        total += n
+
+    return total
+
+
+def timed_stream_copy(src, dst, chunk_size=DEFAULT_CHUNK_SIZE, buf=None,
+                      hasher=None):
+    """Like stream_copy, but also returns how long the copy took.
+
+    :return: A tuple (bytes copied, seconds elapsed).
+    """
+    start = time.time()
+    nbytes = stream_copy(src, dst, chunk_size, buf, hasher)
+    return nbytes, time.time() - start
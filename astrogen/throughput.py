@@ -0,0 +1,117 @@
+#!/usr/bin/python
+#
+# throughput.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Bookkeeping for per-file and aggregate transfer rates.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+_MB = 1024. ** 2
+
+
+class TransferRecord(namedtuple('TransferRecord', 'name nbytes seconds')):
+    """The size and duration of a single file transfer."""
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """Bytes per second for this transfer."""
+        if self.seconds <= 0:
+            return float('inf') if self.nbytes else 0.
+        return self.nbytes / self.seconds
+
+
+class ThroughputMeter(object):
+    """
+    Collects TransferRecords from any number of threads and summarises them.
+    """
+    def __init__(self, label):
+        """
+        :param str label: What is being measured, e.g. 'Download'. Used in
+            log messages.
+        """
+        self.label = label
+        self.records = []
+        self._lock = threading.Lock()
+        self._started = None
+        self._stopped = None
+
+    def start(self):
+        self._started = time.time()
+        self._stopped = None
+
+    def stop(self):
+        self._stopped = time.time()
+
+    def record(self, name, nbytes, seconds):
+        """Add the result of one transfer and log its rate.
+
+        :param str name: The name of the transferred file.
+        :param int nbytes: The number of bytes moved.
+        :param float seconds: Wall-clock duration of the transfer.
+        """
+        record = TransferRecord(name, nbytes, seconds)
+        with self._lock:
+            self.records.append(record)
+        logging.info("{label}ed {name}: {mb:.2f} MB in {secs:.2f} s "
+                     "({rate:.2f} MB/s)".
+                     format(label=self.label, name=name, mb=nbytes / _MB,
+                            secs=seconds, rate=record.rate / _MB))
+        return record
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            return sum(r.nbytes for r in self.records)
+
+    @property
+    def elapsed(self):
+        """Wall-clock seconds between start() and stop() (or now)."""
+        if self._started is None:
+            return 0.
+        end = self._stopped if self._stopped is not None else time.time()
+        return end - self._started
+
+    @property
+    def aggregate_rate(self):
+        """Bytes per second over the whole measured interval."""
+        elapsed = self.elapsed
+        return self.total_bytes / elapsed if elapsed > 0 else 0.
+
+    def report(self):
+        """Log and return a one-line summary of all recorded transfers."""
+        with self._lock:
+            count = len(self.records)
+        summary = "{label}ed {count} files, {mb:.2f} MB in {secs:.2f} s " \
+                  "({rate:.2f} MB/s aggregate)".\
+            format(label=self.label, count=count, mb=self.total_bytes / _MB,
+                   secs=self.elapsed, rate=self.aggregate_rate / _MB)
+        logging.info(summary)
+        return summary
+
+    def report_latency(self):
+        """Log and return a one-line summary of the per-file durations."""
+        with self._lock:
+            seconds = sorted(r.seconds for r in self.records)
+        if not seconds:
+            return None
+        summary = "{label} latency per file: mean {mean:.2f} s, median " \
+                  "{median:.2f} s, 95th percentile {p95:.2f} s, max " \
+                  "{max:.2f} s".\
+            format(label=self.label, mean=sum(seconds) / len(seconds),
+                   median=seconds[len(seconds) // 2],
+                   p95=seconds[min(len(seconds) - 1,
+                                   int(len(seconds) * .95))],
+                   max=seconds[-1])
+        logging.info(summary)
+        return summary
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+#
+# triage.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Rejects data objects that are not worth solving (calibration frames, frames
+taken with the shutter closed, truncated transfers, and anything that is not
+a FITS image) from the first blocks of their headers, before they are
+batched and downloaded.
+"""
+import csv
+import itertools
+import logging
+import threading
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+from batching import data_object_size
+from compression import FITS_EXTENSIONS, compression_of, is_fits_filename, \
+    read_image_header
+from fits_header import BLOCK_SIZE, FitsHeaderError, parse_header_block
+
+# why a data object was rejected
+BAD_EXTENSION = 'extension'
+NOT_FITS = 'not FITS'
+BAD_HEADER = 'invalid header'
+NOT_AN_IMAGE = 'not an image'
+CALIBRATION = 'calibration frame'
+SHUTTER_CLOSED = 'shutter closed'
+TRUNCATED = 'truncated'
+
+CALIBRATION_IMAGE_TYPES = ('flat', 'dark', 'bias', 'zero')
+
+# the most header blocks read looking for the END card
+MAX_HEADER_BLOCKS = 10
+
+# where cameras record the kind of frame, and the shutter's state
+_IMAGE_TYPE_KEYWORDS = ('IMAGETYP', 'VIMTYPE', 'OBSTYPE')
+_SHUTTER_KEYWORDS = ('VSHUTTER', 'SHUTTER', 'SHUTSTAT')
+_CLOSED_SHUTTER_VALUES = ('closed', 'close', 'shut')
+
+_BITPIX_VALUES = (8, 16, 32, 64, -32, -64)
+
+
+def has_fits_extension(filename, extensions=FITS_EXTENSIONS):
+    """Whether a filename ends in one of the extensions, in any case, or in
+    one of them and a compression's (e.g. frame.fits.fz).
+    """
+    return is_fits_filename(filename, extensions)
+
+
+def expected_size(header, header_size):
+    """The smallest size of a FITS file with the given primary header.
+
+    :param dict header: The primary header.
+    :param int header_size: The bytes of header, in whole blocks.
+    """
+    naxis = header.get('NAXIS') or 0
+    num_values = 1 if naxis else 0
+    for i in range(1, naxis + 1):
+        num_values *= header.get('NAXIS{}'.format(i)) or 0
+    data_size = abs(header.get('BITPIX') or 0) // 8 * num_values
+    # data is padded to whole blocks
+    return header_size + -(-data_size // BLOCK_SIZE) * BLOCK_SIZE
+
+
+class Triage(object):
+    """
+    Decides, from their primary headers, which frames are worth solving, and
+    keeps count of those rejected and why.
+    """
+    def __init__(self, rejected_image_types=CALIBRATION_IMAGE_TYPES,
+                 reject_closed_shutter=True, extensions=FITS_EXTENSIONS,
+                 max_header_blocks=MAX_HEADER_BLOCKS):
+        """
+        :param rejected_image_types: Words that, found in a frame's image
+            type (IMAGETYP, VIMTYPE or OBSTYPE), reject it.
+        :param bool reject_closed_shutter: Whether to reject frames whose
+            VSHUTTER, SHUTTER or SHUTSTAT says the shutter was closed.
+        :param extensions: The filename extensions of FITS files.
+        :param int max_header_blocks: The most header blocks to read before
+            giving up on finding the END card.
+        """
+        self.rejected_image_types = \
+            tuple(t.lower() for t in rejected_image_types)
+        self.reject_closed_shutter = reject_closed_shutter
+        self.extensions = tuple(e.lower() for e in extensions)
+        self.max_header_blocks = max_header_blocks
+        self.accepted = 0
+        self.rejected = []
+        self._lock = threading.Lock()
+
+    def check_header(self, header, header_size=None, size=None):
+        """Why a frame should not be solved, judged by its primary header.
+
+        :param dict header: The primary header.
+        :param int header_size: The bytes of header, for checking the size.
+        :param int size: The frame's size in bytes, or 0 if unknown.
+        :return: A rejection reason, or None if the frame is worth solving.
+        """
+        if header.get('SIMPLE') is not True or \
+                header.get('BITPIX') not in _BITPIX_VALUES:
+            return BAD_HEADER
+        naxis = header.get('NAXIS')
+        if not isinstance(naxis, int) or naxis < 2 or not all(
+                isinstance(header.get('NAXIS{}'.format(i)), int) and
+                header['NAXIS{}'.format(i)] > 0 for i in (1, 2)):
+            return NOT_AN_IMAGE
+
+        for keyword in _IMAGE_TYPE_KEYWORDS:
+            image_type = header.get(keyword)
+            if isinstance(image_type, basestring) and any(
+                    word in image_type.lower()
+                    for word in self.rejected_image_types):
+                return CALIBRATION
+
+        if self.reject_closed_shutter:
+            for keyword in _SHUTTER_KEYWORDS:
+                shutter = header.get(keyword)
+                if isinstance(shutter, basestring) and \
+                        shutter.strip().lower() in _CLOSED_SHUTTER_VALUES:
+                    return SHUTTER_CLOSED
+
+        if header_size and size and size < expected_size(header, header_size):
+            return TRUNCATED
+        return None
+
+    def check_file(self, fits_file, name, size=0):
+        """Why a frame should not be solved, reading only as many blocks of
+        its header as it takes to find the END card.
+
+        :param fits_file: A binary file object at the start of the frame.
+        :param str name: The frame's filename.
+        :param int size: The frame's size in bytes, or 0 if unknown.
+        :return: A rejection reason, or None if the frame is worth solving.
+        """
+        if not has_fits_extension(name, self.extensions):
+            return BAD_EXTENSION
+
+        compression = compression_of(name)
+        if compression is not None:
+            # only the start is decompressed; a compressed size says nothing
+            # of truncation
+            try:
+                return self.check_header(
+                    read_image_header(fits_file, compression))
+            except FitsHeaderError:
+                return BAD_HEADER
+            except (zipfile.BadZipfile, zlib.error):
+                return NOT_FITS
+
+        header = {}
+        for i in range(self.max_header_blocks):
+            block = fits_file.read(BLOCK_SIZE)
+            if i == 0 and not block.startswith(b'SIMPLE  ='):
+                return NOT_FITS
+            if len(block) < BLOCK_SIZE:
+                return TRUNCATED
+            if parse_header_block(block, header):
+                return self.check_header(header, (i + 1) * BLOCK_SIZE, size)
+        return BAD_HEADER
+
+    def record(self, name, path, reason):
+        """Count a frame as accepted (reason None) or rejected."""
+        with self._lock:
+            if reason is None:
+                self.accepted += 1
+            else:
+                self.rejected.append((name, path, reason))
+
+    def counts(self):
+        """The number of frames rejected for each reason."""
+        counts = {}
+        for _, _, reason in self.rejected:
+            counts[reason] = counts.get(reason, 0) + 1
+        return counts
+
+    def report(self, report_path=None):
+        """Log the rejections by reason.
+
+        :param str report_path: Optionally, a CSV file to list each rejected
+            frame and why in.
+        """
+        counts = self.counts()
+        logging.info("Triage: {} frames accepted, {} rejected.".
+                     format(self.accepted, len(self.rejected)))
+        for reason, count in sorted(counts.items()):
+            logging.info("Triage: {:>8} rejected ({})".format(count, reason))
+        if report_path is not None:
+            with open(report_path, 'wb') as f:
+                writer = csv.writer(f)
+                writer.writerow(('name', 'path', 'reason'))
+                writer.writerows(self.rejected)
+        return counts
+
+
+def triage_data_objects(data_objects, session_pool, triage, num_workers=4):
+    """Triage data objects in iRODS, reading the start of each through a
+    pool of sessions.
+
+    A data object that cannot be read is let through; downloading it will
+    tell.
+
+    The data objects are taken a few per worker at a time, as the results
+    are consumed, so that a lazy listing is not read ahead of batching.
+
+    :param data_objects: An iterable of data objects. Only their path, name
+        and size are used.
+    :param SessionPool session_pool: Where workers get their sessions.
+    :param Triage triage: Judges each data object, and records the verdict.
+    :param int num_workers: The number of concurrent reads.
+    :return: A generator of (data_object, reason) tuples, in completion
+        order; reason is None for those worth solving.
+    """
+    def check(data_object):
+        reason = None
+        if not has_fits_extension(data_object.name, triage.extensions):
+            reason = BAD_EXTENSION
+        else:
+            try:
+                with session_pool.session() as sess:
+                    irods_obj = sess.data_objects.get(data_object.path)
+                    with irods_obj.open('r') as f:
+                        reason = triage.check_file(
+                            f, data_object.name, data_object_size(data_object))
+            except Exception as e:
+                logging.info("Could not triage {}: {}".
+                             format(data_object.name, e))
+        triage.record(data_object.name, data_object.path, reason)
+        return data_object, reason
+
+    num_workers = max(1, num_workers)
+    data_objects = iter(data_objects)
+    pool = ThreadPool(num_workers)
+    try:
+        while True:
+            chunk = list(itertools.islice(data_objects, 2 * num_workers))
+            if not chunk:
+                break
+            for result in pool.imap_unordered(check, chunk):
+                yield result
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+#
+# upload_planner.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Decides which solution files need uploading, by comparing them with what
+the destination collections already hold, so that a re-run does not send
+unchanged files again.
+"""
+import base64
+import hashlib
+import io
+import logging
+import os
+import re
+from collections import namedtuple
+from irods.models import Collection, DataObject
+from irods_listing import paged_rows
+
+# what an upload is, against what iRODS holds
+NEW = 'new'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+_MD5_CHECKSUM = re.compile(r'^[0-9a-fA-F]{32}$')
+_SHA256_PREFIX = 'sha2:'
+
+
+class RemoteObject(namedtuple('RemoteObject', 'size checksum')):
+    """A data object as listed: its size, and its iRODS checksum (an MD5
+    hex digest, 'sha2:' and a base64 SHA-256, or None if never computed).
+    """
+    __slots__ = ()
+
+
+def file_digest(path, hasher, chunk_size=1024 * 1024):
+    """Feed a file to a hashlib object, a chunk at a time."""
+    with io.open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return hasher
+            hasher.update(chunk)
+
+
+def source_key(*sources):
+    """A digest of what a file was made from, standing in for a digest of
+    the file itself: e.g. a frame's download digest, taken as it was
+    written, and the header cards since written into it.
+    """
+    return hashlib.sha1(repr(sources)).hexdigest()
+
+
+def agrees_with_checksum(digest, checksum):
+    """Whether an MD5 hex digest agrees with an iRODS checksum, as far as
+    can be told without the file: a SHA-256 checksum cannot be compared.
+    """
+    if checksum and _MD5_CHECKSUM.match(checksum):
+        return digest == checksum.lower()
+    return True
+
+
+def matches_checksum(local_path, checksum):
+    """Whether a local file has the given iRODS checksum."""
+    if checksum.startswith(_SHA256_PREFIX):
+        digest = file_digest(local_path, hashlib.sha256()).digest()
+        return base64.b64encode(digest) == checksum[len(_SHA256_PREFIX):]
+    if _MD5_CHECKSUM.match(checksum):
+        return file_digest(local_path, hashlib.md5()).hexdigest() == \
+            checksum.lower()
+    return False
+
+
+class UploadPlan(object):
+    """
+    Uploads sorted into those to send (new and changed) and those to skip
+    (unchanged). Each upload is a (local path, collection) tuple.
+    """
+    def __init__(self):
+        self.uploads = {NEW: [], CHANGED: [], UNCHANGED: []}
+        self.nbytes = {NEW: 0, CHANGED: 0, UNCHANGED: 0}
+
+    def add(self, upload, kind, nbytes):
+        self.uploads[kind].append(upload)
+        self.nbytes[kind] += nbytes
+
+    @property
+    def to_upload(self):
+        return self.uploads[NEW] + self.uploads[CHANGED]
+
+    @property
+    def unchanged(self):
+        return self.uploads[UNCHANGED]
+
+    def report(self, dry_run=False):
+        """Log and return a one-line summary of the plan."""
+        summary = "Upload plan: {} new ({:.2f} MB), {} changed ({:.2f} MB), " \
+                  "{} unchanged; {} {:.2f} MB.".format(
+                      len(self.uploads[NEW]), self.nbytes[NEW] / 1024. ** 2,
+                      len(self.uploads[CHANGED]),
+                      self.nbytes[CHANGED] / 1024. ** 2,
+                      len(self.uploads[UNCHANGED]),
+                      'skipping would save' if dry_run else 'saving',
+                      self.nbytes[UNCHANGED] / 1024. ** 2)
+        logging.info(summary)
+        return summary
+
+
+class UploadPlanner(object):
+    """
+    Plans uploads against a listing of the destination collections, made
+    once per run in a single pass of paged queries. A file is unchanged if
+    its size matches and its digest matches the data object's iRODS
+    checksum or, lacking one, the digest recorded when it was uploaded.
+
+    A file with a source key (see source_key) is compared by that key with
+    the one recorded when it was last uploaded, so that it is not read: a
+    re-run's modified FITS files are known unchanged from their download
+    digests and the headers written into them.
+    """
+    def __init__(self, session_pool, manifest=None):
+        """
+        :param SessionPool session_pool: Where the listing gets its session.
+        :param manifest: Optionally, a Journal recording the digests of
+            files uploaded by earlier runs.
+        """
+        self.session_pool = session_pool
+        self.manifest = manifest
+        self._remote = {}
+        self._listed = set()
+
+    def plan(self, uploads, source_keys=None):
+        """Sort uploads into new, changed and unchanged.
+
+        Local files are only read (for their digests) when they are the
+        size of the data object they would replace, and have no source key
+        to compare instead.
+
+        :param uploads: An iterable of (local path, collection) tuples.
+        :param dict source_keys: Optionally, source keys by local path.
+        :return: An UploadPlan.
+        """
+        if source_keys is None:
+            source_keys = {}
+        uploads = list(uploads)
+        self._list(set(collection for _, collection in uploads))
+        irods_paths = [os.path.join(collection, os.path.basename(local_path))
+                       for local_path, collection in uploads]
+        recorded = self.manifest.upload_digests(irods_paths) \
+            if self.manifest is not None else {}
+
+        plan = UploadPlan()
+        for upload, irods_path in zip(uploads, irods_paths):
+            local_path = upload[0]
+            size = os.path.getsize(local_path)
+            remote = self._remote.get(irods_path)
+            if remote is None:
+                kind = NEW
+            elif remote.size != size:
+                kind = CHANGED
+            elif local_path in source_keys and irods_path in recorded and \
+                    recorded[irods_path][2] is not None:
+                recorded_size, digest, source = recorded[irods_path]
+                kind = UNCHANGED \
+                    if source == source_keys[local_path] and \
+                    recorded_size == size and \
+                    agrees_with_checksum(digest, remote.checksum) \
+                    else CHANGED
+            elif remote.checksum:
+                kind = UNCHANGED \
+                    if matches_checksum(local_path, remote.checksum) \
+                    else CHANGED
+            elif irods_path in recorded and recorded[irods_path][0] == size:
+                digest = file_digest(local_path, hashlib.md5()).hexdigest()
+                kind = UNCHANGED if digest == recorded[irods_path][1] \
+                    else CHANGED
+            else:
+                # no way to tell without reading it back
+                kind = CHANGED
+            plan.add(upload, kind, size)
+        return plan
+
+    def record(self, results, source_keys=None):
+        """Note uploads just made, in the listing and in the manifest.
+
+        :param results: UploadResults, with their MD5 digests.
+        :param dict source_keys: Optionally, source keys by local path.
+        """
+        if source_keys is None:
+            source_keys = {}
+        uploaded = [result for result in results
+                    if result.succeeded and result.digest is not None]
+        for result in uploaded:
+            self._remote[result.irods_path] = RemoteObject(result.nbytes, None)
+        if self.manifest is not None:
+            self.manifest.record_uploads(
+                (result.irods_path, result.nbytes, result.digest,
+                 source_keys.get(result.local_path))
+                for result in uploaded)
+
+    def _list(self, collections):
+        """List the data objects of collections not yet listed: one paged
+        query for the collections sharing each parent.
+        """
+        collections = collections - self._listed
+        parents = set(os.path.dirname(collection)
+                      for collection in collections)
+        with self.session_pool.session() as sess:
+            for parent in sorted(parents):
+                query = sess.query(Collection.name, DataObject.name,
+                                   DataObject.size, DataObject.checksum).\
+                    filter(Collection.parent_name == parent)
+                for row in paged_rows(query):
+                    if row[Collection.name] not in collections:
+                        continue
+                    irods_path = os.path.join(row[Collection.name],
+                                              row[DataObject.name])
+                    self._remote[irods_path] = RemoteObject(
+                        row[DataObject.size], row[DataObject.checksum] or None)
+        self._listed.update(collections)
+        logging.info("Listed {} data objects in {} collections.".
+                     format(len(self._remote), len(self._listed)))
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+#
+# uploader.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Sends local files to iPlant using several worker threads at once, retrying
+failed transfers and deleting each local file only once its upload checks
+out.
+"""
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from Queue import Queue
+from streaming import DEFAULT_CHUNK_SIZE, stream_copy
+from throughput import ThroughputMeter
+
+
+class UploadResult(namedtuple('UploadResult',
+                              'local_path irods_path nbytes seconds attempts '
+                              'error digest')):
+    """
+    The outcome of uploading one file. error is None if it was uploaded (and
+    verified); seconds is the duration of the last attempt, and digest the
+    MD5 hex digest of what was sent. A file skipped as unchanged took no
+    attempts and has no digest.
+    """
+    __slots__ = ()
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+
+class BulkUploader(object):
+    """
+    Uploads files concurrently, each worker borrowing a session from a
+    shared SessionPool. The destination collections are created once, up
+    front, rather than for every file.
+    """
+    def __init__(self, session_pool, num_workers,
+                 chunk_size=DEFAULT_CHUNK_SIZE, max_attempts=3, backoff=1.0,
+                 remove_local=True):
+        """
+        :param SessionPool session_pool: Where workers get their sessions.
+        :param int num_workers: The number of concurrent uploads.
+        :param int chunk_size: The size of each worker's copy buffer.
+        :param int max_attempts: The most tries at uploading one file.
+        :param float backoff: Seconds to wait before the first retry; each
+            later retry waits twice as long as the one before.
+        :param bool remove_local: Whether to delete each local file once its
+            upload is verified.
+        """
+        self.session_pool = session_pool
+        self.num_workers = max(1, int(num_workers))
+        self.chunk_size = chunk_size
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff = backoff
+        self.remove_local = remove_local
+        self.meter = None
+        self._collections = set()
+
+    def upload(self, uploads):
+        """Upload local files into iRODS collections, replacing any data
+        objects of the same name.
+
+        :param uploads: An iterable of (local path, collection) tuples.
+        :return: A list of UploadResults, in the order uploads finished.
+        """
+        uploads = list(uploads)
+        self._create_collections(set(collection
+                                     for _, collection in uploads))
+
+        # a fresh meter per call, so each report covers one batch
+        self.meter = ThroughputMeter('Upload')
+        work = Queue()
+        for upload in uploads:
+            work.put(upload)
+        results = []
+        lock = threading.Lock()
+
+        def worker():
+            # one buffer per worker, reused for every file it copies
+            buf = bytearray(self.chunk_size)
+            while True:
+                upload = work.get()
+                if upload is None:
+                    break
+                result = self._upload_with_retries(upload[0], upload[1], buf)
+                with lock:
+                    results.append(result)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self.num_workers, len(uploads)))]
+        for t in threads:
+            t.daemon = True
+            work.put(None)
+            t.start()
+
+        self.meter.start()
+        for t in threads:
+            t.join()
+        self.meter.stop()
+
+        failed = [result for result in results if not result.succeeded]
+        for result in failed:
+            logging.info("File {} not uploaded after {} attempts: {}".
+                         format(result.local_path, result.attempts,
+                                result.error))
+        self.meter.report()
+        self.meter.report_latency()
+        return results
+
+    def skip(self, uploads):
+        """Treat files already in iRODS as uploaded, without sending them:
+        each local file is deleted as if its upload had been verified.
+
+        :param uploads: An iterable of (local path, collection) tuples.
+        :return: A list of UploadResults.
+        """
+        results = []
+        for local_path, collection in uploads:
+            if self.remove_local:
+                os.remove(local_path)
+            results.append(UploadResult(
+                local_path,
+                os.path.join(collection, os.path.basename(local_path)),
+                0, 0., 0, None, None))
+        return results
+
+    def _create_collections(self, collections):
+        """Create the collections not created by an earlier call. One that
+        already exists in iRODS is fine.
+        """
+        collections = collections - self._collections
+        if not collections:
+            return
+        with self.session_pool.session() as sess:
+            for collection in sorted(collections):
+                try:
+                    sess.collections.create(collection)
+                except Exception as e:
+                    logging.info("Collection {} not created: {}".
+                                 format(collection, e))
+        self._collections.update(collections)
+
+    def _upload_with_retries(self, local_path, collection, buf):
+        irods_path = os.path.join(collection, os.path.basename(local_path))
+        error = None
+        nbytes = seconds = 0
+        for attempt in range(1, self.max_attempts + 1):
+            if attempt > 1:
+                time.sleep(self.backoff * 2 ** (attempt - 2))
+            start = time.time()
+            try:
+                nbytes, digest = self._upload(local_path, irods_path, buf)
+            except EnvironmentError as e:
+                if not os.path.exists(local_path):
+                    # nothing to retry
+                    return UploadResult(local_path, irods_path, 0, 0.,
+                                        attempt, e, None)
+                error = e
+            except Exception as e:
+                error = e
+            else:
+                seconds = time.time() - start
+                self.meter.record(os.path.basename(local_path), nbytes,
+                                  seconds)
+                if self.remove_local:
+                    os.remove(local_path)
+                return UploadResult(local_path, irods_path, nbytes, seconds,
+                                    attempt, None, digest)
+            logging.info("Upload of {} failed (attempt {} of {}): {}".
+                         format(local_path, attempt, self.max_attempts,
+                                error))
+        return UploadResult(local_path, irods_path, nbytes,
+                            time.time() - start, self.max_attempts, error,
+                            None)
+
+    def _upload(self, local_path, irods_path, buf):
+        """Copy one file to irods_path and check that iRODS holds all of
+        it, returning its size and MD5 hex digest.
+        """
+        size = os.path.getsize(local_path)
+        with self.session_pool.session() as sess:
+            try:
+                obj = sess.data_objects.create(irods_path)
+            except Exception as e:
+                # already there; it is overwritten, which leaves the tail of
+                # a longer object behind, so that one is replaced instead
+                try:
+                    obj = sess.data_objects.get(irods_path)
+                except Exception:
+                    raise e
+                if obj.size > size:
+                    sess.data_objects.unlink(irods_path)
+                    obj = sess.data_objects.create(irods_path)
+            hasher = hashlib.md5()
+            with io.open(local_path, 'rb') as f, obj.open('w+') as irods_f:
+                nbytes = stream_copy(f, irods_f, buf=buf, hasher=hasher)
+
+            uploaded_size = sess.data_objects.get(irods_path).size
+        if nbytes != size or uploaded_size != size:
+            raise IOError("{} holds {} bytes of {}".format(
+                irods_path, uploaded_size, size))
+        return nbytes, hasher.hexdigest()
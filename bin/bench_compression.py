@@ -0,0 +1,122 @@
+#!/usr/bin/python
+#
+# bench_compression.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Compares moving frames compressed (and decompressing them where they are
+solved) with moving them uncompressed, for (made up) 16 bit frames of sky
+noise. fpack is included if it is on the PATH.
+
+A frame's time is its transfer at the given bandwidth plus, if compressed,
+its decompression as measured here.
+
+Usage: python bench_compression.py [num_frames [bandwidth_mb_per_s]]
+"""
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'astrogen'))
+from compression import FPACK, GZIP, ZIP, compress, decompress, read_header
+
+SIDE = 1024
+
+
+def fake_frame(path, seed):
+    """A SIDE x SIDE 16 bit frame: a sky level, with noise and a few stars."""
+    rng = random.Random(seed)
+    cards = ['SIMPLE  =                    T',
+             'BITPIX  =                   16',
+             'NAXIS   =                    2',
+             'NAXIS1  = {:>20}'.format(SIDE),
+             'NAXIS2  = {:>20}'.format(SIDE),
+             "IMAGETYP= 'Light Frame'",
+             'END']
+    header = ''.join(card.ljust(80) for card in cards).ljust(2880)
+    pixels = [1000 + int(rng.gauss(0, 12)) for _ in range(SIDE * SIDE)]
+    for _ in range(50):
+        pixels[rng.randrange(SIDE * SIDE)] = 30000
+    data = struct.pack('>{}h'.format(len(pixels)), *pixels)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(data)
+        f.write('\0' * (-len(data) % 2880))
+
+
+def bench(compression, fits_paths, work_dir):
+    """Compressed bytes, and seconds to decompress and to read the header,
+    over all frames.
+    """
+    nbytes = decompress_time = header_time = 0
+    for fits_path in fits_paths:
+        compressed_path = os.path.join(
+            work_dir, os.path.basename(fits_path) + '.' + compression)
+        compress(fits_path, compressed_path)
+        nbytes += os.path.getsize(compressed_path)
+
+        start = time.time()
+        read_header(compressed_path)
+        header_time += time.time() - start
+
+        start = time.time()
+        decompress(compressed_path, compressed_path + '.fits')
+        decompress_time += time.time() - start
+        os.remove(compressed_path + '.fits')
+    return nbytes, decompress_time, header_time
+
+
+def main():
+    num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    bandwidth = float(sys.argv[2]) if len(sys.argv) > 2 else 50.
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        fits_paths = []
+        for i in range(num_frames):
+            fits_path = os.path.join(work_dir, 'frame_{}.fit'.format(i))
+            fake_frame(fits_path, i)
+            fits_paths.append(fits_path)
+        raw_bytes = sum(os.path.getsize(p) for p in fits_paths)
+        raw_time = raw_bytes / 1024. ** 2 / bandwidth
+
+        print("{} frames of {}x{}, {:.1f} MB, at {:.0f} MB/s".format(
+            num_frames, SIDE, SIDE, raw_bytes / 1024. ** 2, bandwidth))
+        print("{:<6} {:>7} {:>12} {:>12} {:>11} {:>9}".format(
+            'format', 'ratio', 'decompress', 'header', 'total', 'speedup'))
+        print("{:<6} {:>7.2f} {:>12} {:>12} {:>9.2f} s {:>8.2f}x".format(
+            'none', 1., '-', '-', raw_time, 1.))
+
+        compressions = [GZIP, ZIP]
+        if find_executable('fpack') and find_executable('funpack'):
+            compressions.insert(0, FPACK)
+        for compression in compressions:
+            nbytes, decompress_time, header_time = \
+                bench(compression, fits_paths, work_dir)
+            total = nbytes / 1024. ** 2 / bandwidth + decompress_time
+            print("{:<6} {:>7.2f} {:>7.0f} MB/s {:>9.2f} ms {:>9.2f} s "
+                  "{:>8.2f}x".format(
+                      compression, raw_bytes / float(nbytes),
+                      raw_bytes / 1024. ** 2 / decompress_time
+                      if decompress_time else 0,
+                      header_time * 1000 / num_frames, total,
+                      raw_time / total if total else 0))
+    finally:
+        shutil.rmtree(work_dir)
+
+    return None
+
+
+if __name__=="__main__":
+    main()
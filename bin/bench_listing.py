@@ -0,0 +1,97 @@
+#!/usr/bin/python
+#
+# bench_listing.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Compares the time to the first data object of a large collection when it is
+listed whole before use (as coll.data_objects does) and when it is listed
+lazily, a page at a time, against a (made up) iRODS server that takes the
+given time to answer each page of 500 rows.
+
+Usage: python bench_listing.py [num_objects [page_latency_ms]]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'astrogen'))
+from irods.models import Collection, DataObject
+from irods_listing import PAGE_SIZE, list_data_objects, name_patterns
+from irods_pool import SessionPool
+
+
+class SimulatedQuery(object):
+    """Answers any listing query with num_objects rows, a page at a time."""
+    def __init__(self, num_objects, page_latency):
+        self.num_objects = num_objects
+        self.page_latency = page_latency
+        self._offset = 0
+
+    def filter(self, *criteria):
+        return self
+
+    def all(self):
+        time.sleep(self.page_latency)
+        return [{Collection.name: '/iplant/home/test/frames',
+                 DataObject.name: 'frame_{:07d}.fit'.format(i),
+                 DataObject.size: 8 * 1024 ** 2}
+                for i in range(self._offset,
+                               min(self._offset + PAGE_SIZE,
+                                   self.num_objects))]
+
+
+class SimulatedSession(object):
+    def __init__(self, num_objects, page_latency):
+        self.num_objects = num_objects
+        self.page_latency = page_latency
+
+    def query(self, *columns):
+        return SimulatedQuery(self.num_objects, self.page_latency)
+
+    def cleanup(self):
+        pass
+
+
+def bench(listing):
+    """Seconds to the first object, and to the last."""
+    start = time.time()
+    first = None
+    for _ in listing():
+        if first is None:
+            first = time.time() - start
+    return first, time.time() - start
+
+
+def main():
+    num_objects = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    page_latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.2
+
+    pool = SessionPool(lambda: SimulatedSession(num_objects, page_latency), 1)
+
+    def lazy():
+        return list_data_objects(pool, '/iplant/home/test/frames',
+                                 name_patterns())
+
+    def eager():
+        return list(lazy())
+
+    print("{} data objects, {:.0f} ms per page of {}".format(
+        num_objects, page_latency * 1000, PAGE_SIZE))
+    print("{:<8} {:>14} {:>10}".format('listing', 'first object', 'all'))
+    for label, listing in (('whole', eager), ('paged', lazy)):
+        first, total = bench(listing)
+        print("{:<8} {:>12.2f} s {:>8.2f} s".format(label, first, total))
+    pool.cleanup()
+
+    return None
+
+
+if __name__=="__main__":
+    main()
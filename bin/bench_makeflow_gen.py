@@ -0,0 +1,86 @@
+#!/usr/bin/python
+#
+# bench_makeflow_gen.py
+#
+# Authors:
+#   Philipp v. Bieberstein (pbieberstein@email.arizona.edu)
+#   Matt Madrid (matthewmadrid@email.arizona.edu)
+#   David Sidi (dsidi@email.arizona.edu)
+#   Adam Soll (adamsoll@email.arizona.edu)
+#   Matthew Shanks (mcshanks@email.arizona.edu)
+"""
+Times makeflow generation for a large number of (made up) frames, writing one
+makeflow as makeflow_gen does and writing shards as sharded_makeflow_gen does.
+
+Usage: python bench_makeflow_gen.py [num_frames [shard_size]]
+"""
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'astrogen'))
+import makeflow_gen
+
+PATH_TO_SOLVE_FIELD = \
+    '/gsfs1/xdisk/dsidi/midterm/astrometry.net-0.50/blind/solve-field'
+PATH_TO_NETPBM = '/home/u12/ericlyons/bin/newnetpbm/bin'
+
+
+def fake_filenames(num_frames):
+    """Filenames like ours, generated one at a time."""
+    for i in range(num_frames):
+        yield 'Briol_1197Rhodesia_20140630_{:06d}_flatfield_TA_FITS.fit'.\
+            format(i)
+
+
+def max_rss_mb():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def bench_single(num_frames, out_dir):
+    makeflow_path = os.path.join(out_dir, 'output.mf')
+    start = time.time()
+    makeflow_gen.makeflow_gen(fake_filenames(num_frames), PATH_TO_SOLVE_FIELD,
+                              PATH_TO_NETPBM, input_dir='/batch',
+                              makeflow_path=makeflow_path)
+    return time.time() - start, 1, os.path.getsize(makeflow_path)
+
+
+def bench_sharded(num_frames, shard_size, out_dir):
+    start = time.time()
+    shards = list(makeflow_gen.sharded_makeflow_gen(
+        fake_filenames(num_frames), PATH_TO_SOLVE_FIELD, PATH_TO_NETPBM,
+        '/batch', out_dir, shard_size=shard_size))
+    elapsed = time.time() - start
+    return elapsed, len(shards), sum(os.path.getsize(p) for p in shards)
+
+
+def main():
+    num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    shard_size = int(sys.argv[2]) if len(sys.argv) > 2 \
+        else makeflow_gen.DEFAULT_SHARD_SIZE
+
+    print("{} frames, shards of {}".format(num_frames, shard_size))
+    for name, bench in (
+            ('single', lambda d: bench_single(num_frames, d)),
+            ('sharded', lambda d: bench_sharded(num_frames, shard_size, d))):
+        out_dir = tempfile.mkdtemp()
+        try:
+            elapsed, num_files, nbytes = bench(out_dir)
+        finally:
+            shutil.rmtree(out_dir)
+        print("{:<8} {:8.2f} s {:>8} files {:10.2f} MB "
+              "{:10.0f} rules/s  max RSS {:.1f} MB".
+              format(name, elapsed, num_files, nbytes / 1024. ** 2,
+                     num_frames / elapsed if elapsed else 0, max_rss_mb()))
+
+    return None
+
+
+if __name__=="__main__":
+    main()
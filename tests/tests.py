@@ -1,12 +1,55 @@
 from glob import glob
+import base64
 import unittest
 import shutil
 from irods.exception import CollectionDoesNotExist, DataObjectDoesNotExist
+from irods.models import Collection, DataObject
 import astrogen
 import os
 import config
+import gzip
+import hashlib
 import makeflow_gen
+import math
 import pdb
+import re
+import tarfile
+import tempfile
+import zipfile
+from io import BytesIO
+from autoscaler import PbsWorkerPool, WorkerAutoscaler
+from batching import BatchBuilder, plan_batches
+from catalog import Catalog, angular_distance, parse_date_obs
+from compression import FPACK, GZIP, ZIP, compress, compression_of, \
+    decompress, frame_base, is_fits_filename, read_header, \
+    read_image_header, uncompressed_name
+from downloader import ParallelDownloader
+from executors import LocalExecutor, MakeflowExecutor, SolveJob
+from extraction import BatchExtractor, SolutionTable, OK, UNSOLVED, WCS, \
+    parse_solve_output, parse_wcs_header
+from fits_header import FitsHeaderError, format_card, read_primary_header, \
+    update_primary_header
+from fits_hints import HintReport, SolveHints, hints_from_header, \
+    hints_from_solution, parse_angle, solution_from_stdout
+from index_bundle import field_width, find_index_files, index_scale, \
+    scales_for_fields, select_index_files, write_bundle_config
+from irods_listing import list_data_objects, name_patterns, unique_names
+from irods_pool import SessionPool
+from makeflow_monitor import MakeflowLogWatcher, makeflow_log_path, \
+    COMPLETE, FAILED as \
+    NODE_FAILED
+from journal import Journal, LISTED, DOWNLOADED, UPLOADED, FAILED
+from leases import LeaseStore, FREE, LEASED, DONE, node_path, slice_of
+from pipeline import Batch, Pipeline
+from retention import ARCHIVE_SUFFIX, DROP, KEEP, PACK, RetentionPolicy, \
+    pack
+from sequence_planner import plan_sequences
+from solve_cache import SolveCache, cache_key
+from streaming import stream_copy
+from triage import Triage, triage_data_objects, BAD_EXTENSION, BAD_HEADER, \
+    CALIBRATION, NOT_AN_IMAGE, NOT_FITS, SHUTTER_CLOSED, TRUNCATED
+from upload_planner import UploadPlanner, file_digest, source_key
+from uploader import BulkUploader, UploadResult
 from os import path
 from textwrap import dedent
 from irods.session import iRODSSession
@@ -128,8 +171,8 @@ class TestAstrogen(unittest.TestCase):
             try:
                os.mknod(filepath)
             except OSError as e :  # if file exists
-               print "problem creating filename: {}. Continuing, hoping for the
-               best...".format(e)
+               print "problem creating filename: {}. Continuing, hoping for " \
+                     "the best...".format(e)
                continue
 
         # try movin' 'em
@@ -291,6 +334,1772 @@ class TestMakeflowGen(unittest.TestCase):
 
         self.assertEqual(actual_output, correct_output)
 
+    def test_sharded_makeflow_gen(self):
+        makeflows_dir = tempfile.mkdtemp()
+        try:
+            fits_filenames = ('frame_{}.fit'.format(i) for i in range(5))
+            shards = list(makeflow_gen.sharded_makeflow_gen(
+                fits_filenames, '/bin/solve-field', '/netpbm', '/batch',
+                makeflows_dir, shard_size=2))
+            self.assertEqual(len(shards), 3)
+            self.assertEqual(len(set(shards)), 3)
+            self.assertListEqual(sorted(os.listdir(makeflows_dir)),
+                                 sorted(os.path.basename(p) for p in shards))
+
+            with open(shards[2]) as f:
+                last_shard = f.read()
+            # shared values are defined once, and rules refer to them
+            self.assertEqual(last_shard.count('/bin/solve-field'), 1)
+            self.assertIn('SOLVE_OPTIONS=-p --wcs none', last_shard)
+            self.assertIn('frame_4.out : $(INPUT_DIR)/frame_4.fit '
+                          '$(SOLVE_FIELD)\n', last_shard)
+            self.assertIn('--cpulimit 600 $(SOLVE_OPTIONS) -H 3.0 '
+                          '--backend-config '
+                          '$(BACKEND_CONFIG) --overwrite '
+                          '$(INPUT_DIR)/frame_4.fit > frame_4.out',
+                          last_shard)
+
+            # the same frames give the same shard
+            again = list(makeflow_gen.sharded_makeflow_gen(
+                ['frame_4.fit'], '/bin/solve-field', '/netpbm', '/batch',
+                makeflows_dir, shard_size=2))
+            self.assertListEqual(again, shards[2:])
+        finally:
+            shutil.rmtree(makeflows_dir)
+
+    def test_categories_and_retry_tiers(self):
+        makeflows_dir = tempfile.mkdtemp()
+        try:
+            hints = {'b.fit': SolveHints(187.5, -10.5, 0.5, 1.8, 1.9)}
+            resources = {
+                makeflow_gen.HINTED: makeflow_gen.Resources(1, 1024, 512),
+                makeflow_gen.BLIND: makeflow_gen.Resources(2, 2048, 512),
+            }
+            shard, = makeflow_gen.sharded_makeflow_gen(
+                ['a.fit', 'b.fit'], '/bin/solve-field', '/netpbm', '/batch',
+                makeflows_dir, hints=hints, resources=resources,
+                quick_cpulimit=60, cpulimit=900)
+            with open(shard) as f:
+                makeflow = f.read()
+
+            self.assertIn('CATEGORY=blind\nCORES=2\nMEMORY=2048\nDISK=512\n',
+                          makeflow)
+            a_rule = makeflow.index('a.out :')
+            b_rule = makeflow.index('b.out :')
+            self.assertEqual(makeflow.rfind('CATEGORY=', 0, a_rule),
+                             makeflow.rfind('CATEGORY=blind', 0, a_rule))
+            self.assertEqual(makeflow.rfind('CATEGORY=', 0, b_rule),
+                             makeflow.rfind('CATEGORY=hinted', 0, b_rule))
+
+            # the blind frame gets the larger limit; the hinted one is tried
+            # quickly, leaving a blind retry to the executor
+            a_cmd = makeflow[a_rule:b_rule]
+            self.assertIn('--cpulimit 900', a_cmd)
+            self.assertNotIn('||', a_cmd)
+            b_cmd = makeflow[b_rule:]
+            self.assertIn('--cpulimit 60 ', b_cmd)
+            self.assertIn('--ra 187.500000', b_cmd)
+            self.assertNotIn('||', b_cmd)
+            self.assertNotIn('--cpulimit 900', b_cmd)
+        finally:
+            shutil.rmtree(makeflows_dir)
+
+class FakeDataObject(object):
+    """Stands in for an iRODSDataObject, holding its contents in memory."""
+    def __init__(self, path, contents):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.contents = contents
+        self.size = len(contents)
+
+    def open(self, mode):
+        if 'w' in mode:
+            return FakeDataObjectWriter(self)
+        return BytesIO(self.contents)
+
+
+class FakeDataObjectWriter(BytesIO):
+    """Writes over the start of a FakeDataObject when closed."""
+    def __init__(self, data_object):
+        BytesIO.__init__(self)
+        self.data_object = data_object
+
+    def close(self):
+        if not self.closed:
+            written = self.getvalue()
+            self.data_object.contents = \
+                written + self.data_object.contents[len(written):]
+            self.data_object.size = len(self.data_object.contents)
+        BytesIO.close(self)
+
+
+class FakeDataObjectManager(object):
+    def __init__(self, data_objects):
+        self.by_path = dict((obj.path, obj) for obj in data_objects)
+        # the offset of each query run against these objects
+        self.queries = []
+
+    def get(self, path):
+        try:
+            return self.by_path[path]
+        except KeyError:
+            raise DataObjectDoesNotExist()
+
+    def create(self, path):
+        if path in self.by_path:
+            raise ValueError("{} exists".format(path))
+        self.by_path[path] = FakeDataObject(path, b'')
+        return self.by_path[path]
+
+    def unlink(self, path):
+        del self.by_path[path]
+
+
+class FakeCollectionManager(object):
+    def __init__(self):
+        self.created = []
+
+    def create(self, path):
+        self.created.append(path)
+
+
+class FakeQuery(object):
+    """Stands in for an irods.query.Query over a FakeDataObjectManager,
+    answering at most page_size rows at a time like GenQuery.
+    """
+    page_size = 500
+
+    def __init__(self, manager, columns, criteria=(), offset=0):
+        self.manager = manager
+        self.columns = columns
+        self.criteria = list(criteria)
+        self._offset = offset
+        self.pages = []
+
+    def filter(self, *criteria):
+        return FakeQuery(self.manager, self.columns,
+                         self.criteria + list(criteria), self._offset)
+
+    def offset(self, offset):
+        return FakeQuery(self.manager, self.columns, self.criteria, offset)
+
+    @staticmethod
+    def _matches(value, criterion):
+        """Whether a value meets a criterion, which may have several
+        alternatives joined by '||'.
+        """
+        ops = {'=': lambda a, b: a == b, '<>': lambda a, b: a != b,
+               '<': lambda a, b: a < b, '>': lambda a, b: a > b,
+               'like': lambda a, b: re.match('^{}$'.format(
+                   re.escape(b).replace('\\%', '.*').replace('\\_', '.')),
+                   a) is not None}
+        return any(ops[criterion.op](value, alternative.strip("'"))
+                   for alternative in criterion.value.split(
+                       ' || {} '.format(criterion.op)))
+
+    def all(self):
+        rows = []
+        for path, obj in sorted(self.manager.by_path.items()):
+            row = {Collection.name: os.path.dirname(path),
+                   Collection.parent_name:
+                       os.path.dirname(os.path.dirname(path)),
+                   DataObject.name: obj.name,
+                   DataObject.size: obj.size,
+                   DataObject.checksum: getattr(obj, 'checksum', None)}
+            if all(self._matches(row[c.query_key], c)
+                   for c in self.criteria):
+                rows.append(dict((column, row[column])
+                                 for column in self.columns))
+        self.manager.queries.append(self._offset)
+        return rows[self._offset:self._offset + self.page_size]
+
+
+class FakeSession(object):
+    """Stands in for an iRODSSession, exposing only `data_objects`,
+    `collections` and `query`.
+    """
+    def __init__(self, data_objects):
+        self.data_objects = FakeDataObjectManager(data_objects)
+        self.collections = FakeCollectionManager()
+        self.cleaned_up = False
+
+    def query(self, *columns):
+        return FakeQuery(self.data_objects, columns)
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+class TestParallelDownloader(unittest.TestCase):
+    def setUp(self):
+        self.dest_dir = tempfile.mkdtemp()
+        self.data_objects = [
+            FakeDataObject('/iplant/home/test/frame_{}.fit'.format(i),
+                           os.urandom(1000 + i))
+            for i in range(20)
+        ]
+        self.sessions = []
+
+        def session_factory():
+            sess = FakeSession(self.data_objects)
+            self.sessions.append(sess)
+            return sess
+
+        self.pool = SessionPool(session_factory, 3)
+
+    def test_download(self):
+        downloader = ParallelDownloader(self.pool, 5)
+        downloaded = downloader.download(self.data_objects, self.dest_dir)
+
+        self.assertEqual(len(downloaded), len(self.data_objects))
+        for obj in self.data_objects:
+            with open(os.path.join(self.dest_dir, obj.name), 'rb') as f:
+                self.assertEqual(f.read(), obj.contents)
+
+        # sessions are reused, never more than the pool allows
+        self.assertLessEqual(len(self.sessions), 3)
+        self.assertEqual(len(downloader.meter.records), 20)
+        self.assertEqual(downloader.meter.total_bytes,
+                         sum(obj.size for obj in self.data_objects))
+
+    def test_missing_object_is_rejected(self):
+        missing = FakeDataObject('/iplant/home/test/missing.fit', b'')
+        downloader = ParallelDownloader(self.pool, 2)
+        downloaded = downloader.download(
+            self.data_objects[:2] + [missing], self.dest_dir)
+
+        self.assertEqual(len(downloaded), 2)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.dest_dir, 'missing.fit')))
+
+    def tearDown(self):
+        self.pool.cleanup()
+        shutil.rmtree(self.dest_dir)
+
+
+class TestBulkUploader(unittest.TestCase):
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(10):
+            path = os.path.join(self.src_dir, 'frame_{}.out'.format(i))
+            with open(path, 'wb') as f:
+                f.write(os.urandom(500 + i))
+            self.paths.append(path)
+        # one store, shared by every session of the pool
+        self.session = FakeSession([])
+        self.pool = SessionPool(lambda: self.session, 3)
+
+    def tearDown(self):
+        self.pool.cleanup()
+        shutil.rmtree(self.src_dir)
+
+    def test_upload(self):
+        contents = dict((os.path.basename(p), open(p, 'rb').read())
+                        for p in self.paths)
+        # an existing, longer object is replaced
+        self.session.data_objects.by_path['/out/a/frame_0.out'] = \
+            FakeDataObject('/out/a/frame_0.out', 'x' * 2000)
+        uploader = BulkUploader(self.pool, 4, chunk_size=64)
+        results = uploader.upload(
+            (path, '/out/a' if i % 2 == 0 else '/out/b')
+            for i, path in enumerate(self.paths))
+
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(result.succeeded for result in results))
+        self.assertListEqual(sorted(self.session.collections.created),
+                             ['/out/a', '/out/b'])
+        for name, data in contents.items():
+            i = int(name[len('frame_'):-len('.out')])
+            obj = self.session.data_objects.get(
+                '/out/{}/{}'.format('a' if i % 2 == 0 else 'b', name))
+            self.assertEqual(obj.contents, data)
+        for result in results:
+            self.assertEqual(result.digest, hashlib.md5(
+                contents[os.path.basename(result.local_path)]).hexdigest())
+        # verified uploads leave nothing behind
+        self.assertListEqual(os.listdir(self.src_dir), [])
+        self.assertEqual(len(uploader.meter.records), 10)
+
+        # collections are created once per uploader
+        uploader.upload([])
+        self.assertEqual(len(self.session.collections.created), 2)
+
+    def test_retries_and_keeps_failed_files(self):
+        manager = self.session.data_objects
+        create = manager.create
+        calls = []
+
+        def flaky_create(path):
+            calls.append(path)
+            if path.endswith('frame_9.out') or calls.count(path) == 1:
+                raise IOError('connection reset')
+            return create(path)
+        manager.create = flaky_create
+        # failed creates fall back to get, which fails for new objects too
+        uploader = BulkUploader(self.pool, 2, max_attempts=3, backoff=0.01)
+        results = uploader.upload((path, '/out') for path in self.paths)
+
+        failed = [result for result in results if not result.succeeded]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0].attempts, 3)
+        self.assertListEqual(os.listdir(self.src_dir), ['frame_9.out'])
+        self.assertTrue(all(result.attempts == 2 for result in results
+                            if result.succeeded))
+
+
+class TestIrodsListing(unittest.TestCase):
+    def setUp(self):
+        names = ['/in/a.fit', '/in/b.FITS', '/in/c.fits.fz', '/in/d.txt',
+                 '/in/sub/e.fit', '/in/sub/deeper/f.fts.gz', '/in2/g.fit',
+                 '/inX/h.fit', '/in/sub/flat_i.fit']
+        self.session = FakeSession(
+            [FakeDataObject(name, 'x' * 10) for name in names])
+        self.pool = SessionPool(lambda: self.session, 1)
+
+    def tearDown(self):
+        self.pool.cleanup()
+
+    def test_filters_and_recursion(self):
+        listed = list(list_data_objects(self.pool, '/in/', name_patterns()))
+        self.assertListEqual(
+            sorted(obj.path for obj in listed),
+            ['/in/a.fit', '/in/b.FITS', '/in/c.fits.fz',
+             '/in/sub/deeper/f.fts.gz', '/in/sub/e.fit',
+             '/in/sub/flat_i.fit'])
+        self.assertEqual(listed[0].size, 10)
+        self.assertEqual(listed[0].collection, '/in')
+
+        listed = list_data_objects(self.pool, '/in', name_patterns('flat_%'))
+        self.assertListEqual([obj.name for obj in listed], ['flat_i.fit'])
+
+        listed = list_data_objects(self.pool, '/in', recursive=False)
+        self.assertListEqual(sorted(obj.name for obj in listed),
+                             ['a.fit', 'b.FITS', 'c.fits.fz', 'd.txt'])
+
+    def test_unique_names(self):
+        for name in ['/in/sub/a.fit', '/in/sub/deeper/a.fit']:
+            self.session.data_objects.by_path[name] = \
+                FakeDataObject(name, 'y' * 10)
+        listed = list(unique_names(list_data_objects(self.pool, '/in')))
+        self.assertEqual(len(listed), 7)
+        self.assertEqual(len(set(obj.name for obj in listed)), 7)
+        self.assertListEqual([obj.path for obj in listed
+                              if obj.name == 'a.fit'], ['/in/a.fit'])
+
+    def test_pages_are_fetched_as_needed(self):
+        FakeQuery.page_size = 2
+        try:
+            listed = list_data_objects(self.pool, '/in')
+            self.assertEqual(next(listed).path, '/in/a.fit')
+            # only the first page is fetched
+            self.assertListEqual(self.session.data_objects.queries, [0])
+            self.assertEqual(len(list(listed)), 6)
+        finally:
+            FakeQuery.page_size = 500
+        # a short page is not the last; an empty one is
+        self.assertListEqual(self.session.data_objects.queries,
+                             [0, 2, 4, 6, 7])
+
+    def test_pages_shorter_than_genquery_default(self):
+        # a server returning fewer rows per page than GenQuery's 500
+        for i in range(600):
+            name = '/in/many/frame_{:03d}.fit'.format(i)
+            self.session.data_objects.by_path[name] = \
+                FakeDataObject(name, 'x')
+        FakeQuery.page_size = 256
+        try:
+            listed = list(list_data_objects(self.pool, '/in/many'))
+        finally:
+            FakeQuery.page_size = 500
+        self.assertEqual(len(listed), 600)
+        self.assertListEqual(self.session.data_objects.queries,
+                             [0, 256, 512, 600])
+
+
+class TestUploadPlanner(unittest.TestCase):
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+        self.contents = {}
+        for i in range(6):
+            name = 'frame_{}.out'.format(i)
+            self.contents[name] = os.urandom(100 + i)
+            with open(os.path.join(self.src_dir, name), 'wb') as f:
+                f.write(self.contents[name])
+        self.uploads = [(os.path.join(self.src_dir, name), '/out/other')
+                        for name in sorted(self.contents)]
+        self.session = FakeSession([])
+        self.pool = SessionPool(lambda: self.session, 1)
+        self.journal = Journal(os.path.join(self.src_dir, 'journal.sqlite'))
+
+    def tearDown(self):
+        self.journal.close()
+        self.pool.cleanup()
+        shutil.rmtree(self.src_dir)
+
+    def _remote(self, name, contents, checksum=None):
+        path = '/out/other/' + name
+        obj = FakeDataObject(path, contents)
+        obj.checksum = checksum
+        self.session.data_objects.by_path[path] = obj
+
+    def test_plan(self):
+        c = self.contents
+        # frame_0 is new; frame_1 differs in size
+        self._remote('frame_1.out', c['frame_1.out'] + 'x')
+        # frame_2 matches an MD5 checksum, frame_3 a SHA-256 one
+        self._remote('frame_2.out', c['frame_2.out'],
+                     hashlib.md5(c['frame_2.out']).hexdigest())
+        self._remote('frame_3.out', c['frame_3.out'], 'sha2:' + base64.
+                     b64encode(hashlib.sha256(c['frame_3.out']).digest()))
+        # frame_4 has no checksum, but the manifest knows it
+        self._remote('frame_4.out', c['frame_4.out'])
+        self.journal.record_uploads(
+            [('/out/other/frame_4.out', len(c['frame_4.out']),
+              hashlib.md5(c['frame_4.out']).hexdigest(), None)])
+        # frame_5 is the same size, with an unknown checksum of other bytes
+        self._remote('frame_5.out', os.urandom(len(c['frame_5.out'])))
+        # objects in other collections under the same parent are ignored
+        self._remote('../modified_fits/frame_0.out', c['frame_0.out'])
+
+        plan = UploadPlanner(self.pool, self.journal).plan(self.uploads)
+        names = lambda uploads: [os.path.basename(p) for p, _ in uploads]
+        self.assertListEqual(names(plan.uploads['new']), ['frame_0.out'])
+        self.assertListEqual(names(plan.uploads['changed']),
+                             ['frame_1.out', 'frame_5.out'])
+        self.assertListEqual(names(plan.unchanged),
+                             ['frame_2.out', 'frame_3.out', 'frame_4.out'])
+        self.assertEqual(plan.nbytes['unchanged'], 102 + 103 + 104)
+        self.assertIn('unchanged', plan.report(dry_run=True))
+
+    def test_skips_and_records_uploads(self):
+        planner = UploadPlanner(self.pool, self.journal)
+        uploader = BulkUploader(self.pool, 2, chunk_size=64)
+        plan = planner.plan(self.uploads)
+        self.assertEqual(len(plan.to_upload), 6)
+        planner.record(uploader.upload(plan.to_upload))
+
+        # a later run, with fresh copies of the same files
+        for name, data in self.contents.items():
+            with open(os.path.join(self.src_dir, name), 'wb') as f:
+                f.write(data)
+        planner = UploadPlanner(self.pool, self.journal)
+        plan = planner.plan(self.uploads)
+        self.assertEqual(len(plan.unchanged), 6)
+        results = uploader.skip(plan.unchanged)
+        self.assertTrue(all(result.succeeded and result.attempts == 0
+                            for result in results))
+        self.assertListEqual(glob(os.path.join(self.src_dir, '*.out')), [])
+
+    def test_source_keys_spare_reads(self):
+        keys = dict((path, source_key(os.path.basename(path), None))
+                    for path, _ in self.uploads)
+        planner = UploadPlanner(self.pool, self.journal)
+        uploader = BulkUploader(self.pool, 2, chunk_size=64)
+        planner.record(uploader.upload(planner.plan(self.uploads).to_upload),
+                       keys)
+
+        # a later run, making the same files from the same sources: their
+        # bytes are not compared (these differ), just their keys
+        for name, data in self.contents.items():
+            with open(os.path.join(self.src_dir, name), 'wb') as f:
+                f.write(os.urandom(len(data)))
+        keys[self.uploads[0][0]] = source_key('frame_0.out', [('A', 1)])
+        plan = UploadPlanner(self.pool, self.journal).plan(self.uploads, keys)
+        self.assertListEqual([p for p, _ in plan.uploads['changed']],
+                             [self.uploads[0][0]])
+        self.assertEqual(len(plan.unchanged), 5)
+
+    def test_listing_is_paged(self):
+        FakeQuery.page_size = 4
+        try:
+            for i in range(10):
+                self._remote('old_{}.out'.format(i), 'x')
+            UploadPlanner(self.pool).plan(self.uploads)
+        finally:
+            FakeQuery.page_size = 500
+        self.assertListEqual(self.session.data_objects.queries,
+                             [0, 4, 8, 10])
+
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _touch(self, *names):
+        paths = []
+        for name in names:
+            paths.append(os.path.join(self.work_dir, name))
+            with open(paths[-1], 'wb') as f:
+                f.write(name * 10)
+        return paths
+
+    def test_sort(self):
+        policy = RetentionPolicy({'axy': DROP, 'wcs': PACK, 'out': PACK,
+                                  'new': DROP})
+        sorted_files = policy.sort(['a.fit', 'a.fit.gz', 'a.cfg', 'a.wcs',
+                                    'a.out', 'a.axy', 'a.new.gz', 'a.match',
+                                    'a.solutions.tar.gz', 'notes.txt'])
+        self.assertListEqual(sorted_files[KEEP],
+                             ['a.fit', 'a.fit.gz', 'a.cfg', 'a.match'])
+        self.assertListEqual(sorted_files[PACK], ['a.wcs', 'a.out'])
+        self.assertListEqual(sorted_files[DROP], ['a.axy', 'a.new.gz'])
+
+        # frames are kept whatever their FITS extension
+        self.assertListEqual(
+            policy.sort(['b.fits', 'b.fts', 'b.FIT', 'b.fits.fz'])[KEEP],
+            ['b.fits', 'b.fts', 'b.FIT', 'b.fits.fz'])
+
+        with self.assertRaises(ValueError):
+            RetentionPolicy({'wcs': 'archive'})
+        with self.assertRaises(ValueError):
+            RetentionPolicy({'tiff': KEEP})
+
+    def test_pack_is_reproducible(self):
+        paths = self._touch('b.wcs', 'a.out')
+        archive_path = os.path.join(self.work_dir, 'a' + ARCHIVE_SUFFIX)
+        with open(pack(paths, archive_path), 'rb') as f:
+            first = f.read()
+        os.utime(paths[0], (0, 12345))
+        with open(pack(paths, archive_path), 'rb') as f:
+            self.assertEqual(f.read(), first)
+
+        tar = tarfile.open(archive_path)
+        self.assertListEqual(tar.getnames(), ['a.out', 'b.wcs'])
+        self.assertEqual(tar.extractfile('b.wcs').read(), 'b.wcs' * 10)
+        tar.close()
+
+    def test_failed_archive_keeps_its_files(self):
+        paths = self._touch('a.wcs', 'a.out', 'a.fit')
+        archive_path = pack(paths[:2], os.path.join(self.work_dir,
+                                                    'a' + ARCHIVE_SUFFIX))
+        results = [UploadResult(paths[2], '/out/a.fit', 1, 0., 1, None, 'x'),
+                   UploadResult(archive_path, '/out/a' + ARCHIVE_SUFFIX, 0,
+                                0., 3, IOError('reset'), None)]
+        results = astrogen.Astrogen._unpack_result(results, archive_path,
+                                                   paths[:2])
+        self.assertListEqual(
+            sorted(result.local_path for result in results
+                   if not result.succeeded), sorted(paths[:2]))
+        self.assertFalse(os.path.exists(archive_path))
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+
+
+class TestStreamCopy(unittest.TestCase):
+    def test_stream_copy(self):
+        contents = os.urandom(10 * 1024 + 7)
+        src, dst = BytesIO(contents), BytesIO()
+        nbytes = stream_copy(src, dst, chunk_size=1024)
+
+        self.assertEqual(nbytes, len(contents))
+        self.assertEqual(dst.getvalue(), contents)
+
+    def test_stream_copy_without_readinto(self):
+        class ReadOnly(object):
+            def __init__(self, contents):
+                self.f = BytesIO(contents)
+
+            def read(self, size):
+                return self.f.read(size)
+
+        contents = os.urandom(3000)
+        dst = BytesIO()
+        nbytes = stream_copy(ReadOnly(contents), dst, buf=bytearray(256))
+
+        self.assertEqual(nbytes, len(contents))
+        self.assertEqual(dst.getvalue(), contents)
+
+
+class TestPipeline(unittest.TestCase):
+    def test_items_pass_through_all_stages(self):
+        pipeline = Pipeline(queue_size=1)
+        pipeline.add_stage('double', lambda x: 2 * x, num_workers=3)
+        pipeline.add_stage('increment', lambda x: x + 1)
+        results = pipeline.run(iter(range(10)))
+
+        self.assertListEqual(sorted(results), [2 * x + 1 for x in range(10)])
+
+    def test_failed_items_are_dropped(self):
+        def solve(x):
+            if x == 3:
+                raise ValueError('unsolvable')
+            return x
+
+        pipeline = Pipeline()
+        pipeline.add_stage('solve', solve)
+        pipeline.add_stage('filter', lambda x: x if x % 2 else None)
+        results = pipeline.run(range(6))
+
+        self.assertListEqual(sorted(results), [1, 5])
+
+    def test_batches_get_their_own_directories(self):
+        parent_dir = tempfile.mkdtemp()
+        try:
+            batches = [Batch(i, parent_dir) for i in range(3)]
+            self.assertEqual(len(set(b.work_dir for b in batches)), 3)
+            self.assertTrue(all(b.is_empty() for b in batches))
+
+            batches[0].remove()
+            self.assertFalse(os.path.exists(batches[0].work_dir))
+        finally:
+            shutil.rmtree(parent_dir)
+
+
+class TestBatching(unittest.TestCase):
+    def setUp(self):
+        self.data_objects = [
+            FakeDataObject('/iplant/home/test/frame_{}.fit'.format(i),
+                           b'x' * 100)
+            for i in range(10)
+        ]
+
+    def test_byte_limit(self):
+        batches = list(plan_batches(self.data_objects, max_bytes=250))
+
+        self.assertListEqual([len(b) for b in batches], [2, 2, 2, 2, 2])
+
+    def test_count_limit(self):
+        batches = list(plan_batches(self.data_objects, max_files=4))
+
+        self.assertListEqual([len(b) for b in batches], [4, 4, 2])
+        self.assertListEqual(sum(batches, []), self.data_objects)
+
+    def test_oversized_file_gets_its_own_batch(self):
+        builder = BatchBuilder(max_bytes=50)
+
+        self.assertTrue(builder.accepts(100))
+        builder.add('big.fit', 100)
+        self.assertTrue(builder.is_full())
+        self.assertFalse(builder.accepts(1))
+        self.assertListEqual(builder.take(), ['big.fit'])
+        self.assertEqual(builder.num_bytes, 0)
+
+
+class TestSolveCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.work_dir = tempfile.mkdtemp()
+
+    def _write_results(self, basename, size):
+        base_path = os.path.join(self.work_dir, basename)
+        for ext in ('.out', '.cfg'):
+            with open(base_path + ext, 'w') as f:
+                f.write('x' * size)
+        return base_path + '.out', base_path + '.cfg'
+
+    def test_hit_and_miss(self):
+        cache = SolveCache(self.cache_dir, 10 ** 6)
+        key = cache_key(local_digest='abc123')
+        out_path, cfg_path = self._write_results('frame', 10)
+
+        self.assertFalse(cache.get(key, self.work_dir, 'other_frame'))
+        cache.put(key, out_path, cfg_path)
+        self.assertTrue(cache.get(key, self.work_dir, 'other_frame'))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.work_dir, 'other_frame.cfg')))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.close()
+
+    def test_irods_checksum_preferred(self):
+        self.assertEqual(cache_key('sha2:xyz', 'abc123'), cache_key('sha2:xyz'))
+        self.assertNotEqual(cache_key('abc123'), cache_key(None, 'abc123'))
+        self.assertIsNone(cache_key())
+
+    def test_least_recently_used_evicted(self):
+        cache = SolveCache(self.cache_dir, 50)
+        for i in range(3):
+            out_path, cfg_path = self._write_results('frame_{}'.format(i), 10)
+            cache.put(cache_key(str(i)), out_path, cfg_path)
+            # entry 0 is used again, so entry 1 is the oldest
+            if i == 1:
+                cache.get(cache_key('0'), self.work_dir, 'restored')
+
+        self.assertIn(cache_key('0'), cache)
+        self.assertNotIn(cache_key('1'), cache)
+        self.assertIn(cache_key('2'), cache)
+        self.assertLessEqual(cache.total_bytes, 50)
+        cache.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.work_dir)
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.journal_dir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.journal_dir, 'journal.sqlite')
+        self.data_objects = [
+            FakeDataObject('/iplant/home/test/frame_{}.fit'.format(i),
+                           b'x' * 100)
+            for i in range(5)
+        ]
+
+    def test_journal_mode(self):
+        journal = Journal(self.journal_path)
+        mode = lambda j: j._db.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode(journal), 'wal')
+        journal.close()
+        # on shared disk, an existing journal leaves write-ahead logging
+        journal = Journal(self.journal_path, shared_disk=True)
+        self.assertEqual(mode(journal), 'delete')
+        journal.close()
+
+    def test_states_survive_reopening(self):
+        journal = Journal(self.journal_path)
+        listed = list(journal.listed(self.data_objects))
+        self.assertListEqual(listed, self.data_objects)
+
+        paths = [obj.path for obj in self.data_objects]
+        journal.mark(paths[:3], DOWNLOADED, local_paths=['a', 'b', 'c'])
+        journal.mark(paths[:2], UPLOADED)
+        journal.mark(paths[4:], FAILED, detail='download')
+        journal.close()
+
+        journal = Journal(self.journal_path)
+        summary = journal.summary()
+        self.assertEqual(summary[UPLOADED], (2, 200))
+        self.assertEqual(summary[DOWNLOADED], (1, 100))
+        self.assertEqual(summary[LISTED], (1, 100))
+        self.assertEqual(summary[FAILED], (1, 100))
+        self.assertEqual(tuple(journal.remaining()), (3, 300))
+        self.assertListEqual(journal.in_progress(),
+                             [(paths[2], 'frame_2.fit', DOWNLOADED, 'c')])
+        journal.close()
+
+    def test_triage_rejects_are_not_remaining(self):
+        journal = Journal(self.journal_path)
+        list(journal.listed(self.data_objects))
+        paths = [obj.path for obj in self.data_objects]
+        journal.mark(paths[:2], FAILED, detail='triage (dark)')
+        journal.mark(paths[2:3], FAILED, detail='download')
+        journal.mark(paths[3:4], UPLOADED)
+        self.assertEqual(tuple(journal.rejected()), (2, 200))
+        self.assertEqual(tuple(journal.remaining()), (2, 200))
+        journal.close()
+
+    def test_relisting_keeps_state(self):
+        journal = Journal(self.journal_path)
+        list(journal.listed(self.data_objects))
+        journal.mark([self.data_objects[0].path], UPLOADED)
+        list(journal.listed(self.data_objects))
+
+        self.assertEqual(journal.state_of(self.data_objects[0].path), UPLOADED)
+        self.assertSetEqual(journal.paths_in_state(UPLOADED),
+                            set([self.data_objects[0].path]))
+        journal.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.journal_dir)
+
+
+class TestLeases(unittest.TestCase):
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.store_dir, 'leases.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_nodes_lease_disjoint_slices(self):
+        a = LeaseStore(self.store_path, 'a', 3, 600)
+        b = LeaseStore(self.store_path, 'b', 3, 600)
+        self.assertEqual(a.acquire(), 0)
+        self.assertEqual(b.acquire(), 1)
+        self.assertEqual(a.acquire(), 2)
+        self.assertIsNone(b.acquire())
+        self.assertFalse(b.others_stalled(60))
+        self.assertDictEqual(a.holders(), {'a': [0, 2], 'b': [1]})
+
+        a.complete(0)
+        a.release(2)
+        # only the holder can settle a slice
+        b.complete(2)
+        self.assertEqual(b.acquire(), 2)
+        self.assertSetEqual(b.renew(), set([1, 2]))
+        self.assertDictEqual(b.summary(), {FREE: 0, LEASED: 2, DONE: 1})
+        a.close()
+        b.close()
+
+    def test_expired_lease_is_stolen(self):
+        # leases that lapse as soon as they are taken
+        dead = LeaseStore(self.store_path, 'dead', 2, -1)
+        self.assertEqual(dead.acquire(), 0)
+        self.assertEqual(dead.acquire(), 1)
+
+        alive = LeaseStore(self.store_path, 'alive', 2, 600)
+        self.assertTrue(alive.others_stalled(0))
+        self.assertEqual(alive.acquire(), 0)
+        self.assertEqual(alive.acquire(), 1)
+
+        # the first node comes back, to find its slices gone
+        self.assertSetEqual(dead.renew(), set())
+        self.assertSetEqual(dead.lost, set([0, 1]))
+        dead.close()
+        alive.close()
+
+    def test_nodes_must_agree_on_slices(self):
+        LeaseStore(self.store_path, 'a', 4, 600).close()
+        with self.assertRaises(ValueError):
+            LeaseStore(self.store_path, 'b', 8, 600)
+
+    def test_slices_and_node_paths(self):
+        names = ['frame_{}.fit'.format(i) for i in range(200)]
+        slices = [slice_of(name, 4) for name in names]
+        self.assertSetEqual(set(slices), set(range(4)))
+        self.assertListEqual(slices, [slice_of(name, 4) for name in names])
+        self.assertEqual(node_path('/r/journal.sqlite', 'n1'),
+                         '/r/journal.n1.sqlite')
+        self.assertEqual(node_path('/r/solve_cache', 'n1'),
+                         '/r/solve_cache.n1')
+
+
+class TestExecutors(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def _jobs(self, num_jobs):
+        return [
+            SolveJob('frame_{}.fit'.format(i),
+                     os.path.join(self.work_dir, 'frame_{}.fit'.format(i)),
+                     os.path.join(self.work_dir, 'frame_{}.out'.format(i)))
+            for i in range(num_jobs)
+        ]
+
+    def test_local_executor(self):
+        # 'echo' stands in for solve-field, echoing its arguments to the .out
+        executor = LocalExecutor('echo', '/usr/bin', num_workers=2)
+        results = list(executor.run(self._jobs(4), self.work_dir))
+
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result.succeeded for result in results))
+        with open(os.path.join(self.work_dir, 'frame_0.out')) as f:
+            self.assertIn('frame_0.fit', f.read())
+
+    def test_local_executor_quick_then_blind(self):
+        # a stand-in solve-field, echoing its arguments, that solves only
+        # 'easy' frames, and only with hints
+        solve_field = os.path.join(self.work_dir, 'solve-field')
+        with open(solve_field, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'echo "$@"\n'
+                    'for last; do :; done\n'
+                    'case "$*" in *--ra*easy*) touch "${last%.*}.solved";; '
+                    'esac\n')
+        os.chmod(solve_field, 0o755)
+        hints = SolveHints(187.5, -10.5, 0.5, 1.8, 1.9)
+        jobs = [SolveJob(name + '.fit',
+                         os.path.join(self.work_dir, name + '.fit'),
+                         os.path.join(self.work_dir, name + '.out'), hints)
+                for name in ('easy', 'hard')]
+        executor = LocalExecutor(solve_field, '/usr/bin', num_workers=2,
+                                 quick_cpulimit=60, cpulimit=900)
+        self.assertEqual(len(list(executor.run(jobs, self.work_dir))), 2)
+
+        with open(os.path.join(self.work_dir, 'easy.out')) as f:
+            easy = f.read()
+        self.assertIn('--cpulimit 60 ', easy)
+        self.assertIn('--ra 187.500000', easy)
+        # the hard frame was tried quickly, then solved blind
+        with open(os.path.join(self.work_dir, 'hard.out')) as f:
+            hard = f.read()
+        self.assertIn('--cpulimit 900 ', hard)
+        self.assertNotIn('--ra', hard)
+
+    def test_local_executor_timeout(self):
+        executor = LocalExecutor('sleep 10 #', '/usr/bin', num_workers=1,
+                                 job_timeout=0.5)
+        result, = executor.run(self._jobs(1), self.work_dir)
+
+        self.assertIsNone(result.exit_status)
+        self.assertFalse(result.succeeded)
+        self.assertLess(result.runtime, 5)
+
+    def test_pbs_submit_command(self):
+        pbs_params = {
+            'group_list': 'nirav',
+            'queue': 'standard',
+            'select': 'select=1:ncpus=3:mem=4gb',
+            'walltime': '01:00:00',
+            'cput': '01:00:00',
+        }
+        executor = MakeflowExecutor('solve-field', '/usr/bin', self.work_dir,
+                                    'SONORAN', pbs_params, 3)
+        correct_cmd = 'pbs_submit_workers -d all -N SONORAN ' \
+                      '-p "-N SONORAN -W group_list=nirav -q standard ' \
+                      '-l jobtype=serial -l select=1:ncpus=3:mem=4gb ' \
+                      '-l place=pack:shared -l walltime=01:00:00 ' \
+                      '-l cput=01:00:00" 3'
+
+        self.assertEqual(executor.pbs_submit_command(3), correct_cmd)
+
+    def test_workers_are_submitted_once(self):
+        executor = MakeflowExecutor('solve-field', '/usr/bin', self.work_dir,
+                                    'SONORAN', {}, 3)
+        submissions = os.path.join(self.work_dir, 'submissions')
+        executor.pbs_submit_command = lambda num_workers: \
+            'echo {} >> {}; exit 3'.format(num_workers, submissions)
+
+        self.assertEqual(executor._submit_workers(), 3)
+        self.assertIsNone(executor._submit_workers())
+        with open(submissions) as f:
+            self.assertListEqual(f.read().split(), ['3'])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.work_dir, 'pbs_output')))
+
+    def test_makeflow_executor_runs_shards(self):
+        executor = MakeflowExecutor('solve-field', '/usr/bin', self.work_dir,
+                                    'SONORAN', {}, 3, poll_interval=0,
+                                    shard_size=2)
+        started = []
+
+        class FinishedProcess(object):
+            def poll(self):
+                return 0
+
+            def wait(self):
+                return 0
+
+        def start_makeflow(makeflow_path, work_dir, submit_workers=True):
+            # every rule of the shard completes
+            with open(makeflow_path) as f:
+                targets = [line.split(' :')[0] for line in f
+                           if line.endswith('$(SOLVE_FIELD)\n')]
+            started.append(targets)
+            with open(makeflow_log_path(makeflow_path), 'w') as log:
+                for node_id, target in enumerate(targets):
+                    log.write('1000000 {} 1 0 0 1 0 0 0 1\n'.format(node_id))
+                    log.write('3000000 {} 2 0 0 0 1 0 0 1\n'.format(node_id))
+                    with open(os.path.join(work_dir, target), 'w') as out:
+                        out.write('solved')
+            return FinishedProcess()
+
+        executor.start_makeflow = start_makeflow
+        jobs = [SolveJob('f{}.fit'.format(i),
+                         os.path.join(self.work_dir, 'f{}.fit'.format(i)),
+                         os.path.join(self.work_dir, 'f{}.out'.format(i)))
+                for i in range(3)]
+        results = list(executor.run(jobs, self.work_dir))
+
+        self.assertListEqual(started, [['f0.out', 'f1.out'], ['f2.out']])
+        self.assertListEqual(sorted(r.name for r in results),
+                             ['f0.fit', 'f1.fit', 'f2.fit'])
+        self.assertTrue(all(r.succeeded for r in results))
+        self.assertAlmostEqual(results[0].runtime, 2.)
+
+    def test_makeflow_executor_retries_hinted_frames_blind(self):
+        resources = {
+            makeflow_gen.HINTED: makeflow_gen.Resources(1, 1024, 512),
+            makeflow_gen.BLIND: makeflow_gen.Resources(2, 2048, 512),
+        }
+        executor = MakeflowExecutor('solve-field', '/usr/bin', self.work_dir,
+                                    'SONORAN', {}, 3, poll_interval=0,
+                                    shard_size=10, resources=resources,
+                                    quick_cpulimit=60, cpulimit=900)
+        started = []
+
+        class FinishedProcess(object):
+            def poll(self):
+                return 0
+
+            def wait(self):
+                return 0
+
+        def start_makeflow(makeflow_path, work_dir, submit_workers=True):
+            # each rule's target, CPU limit and category; only f0 is solved
+            # by its quick try
+            with open(makeflow_path) as f:
+                makeflow = f.read()
+            rules = [(m.group(1), int(m.group(2)),
+                      makeflow[makeflow.rfind('CATEGORY=', 0, m.start()):].
+                      split('\n')[0])
+                     for m in re.finditer(r'^(\S+) : .*\n\t.*--cpulimit (\d+)',
+                                          makeflow, re.M)]
+            started.append(rules)
+            with open(makeflow_log_path(makeflow_path), 'w') as log:
+                for node_id, (target, _, _) in enumerate(rules):
+                    log.write('1000000 {} 1 0 0 1 0 0 0 1\n'.format(node_id))
+                    log.write('3000000 {} 2 0 0 0 1 0 0 1\n'.format(node_id))
+                    with open(os.path.join(work_dir, target), 'w') as out:
+                        out.write('solved')
+                    if target == 'f0.out' or len(started) > 1:
+                        open(os.path.join(work_dir, target[:-4] + '.solved'),
+                             'w').close()
+            return FinishedProcess()
+
+        executor.start_makeflow = start_makeflow
+        hints = SolveHints(187.5, -10.5, 0.5, 1.8, 1.9)
+        jobs = [SolveJob('f{}.fit'.format(i),
+                         os.path.join(self.work_dir, 'f{}.fit'.format(i)),
+                         os.path.join(self.work_dir, 'f{}.out'.format(i)),
+                         hints if i < 2 else None)
+                for i in range(3)]
+        results = list(executor.run(jobs, self.work_dir))
+
+        # the hinted frame left unsolved is solved blind, on its own, in the
+        # blind category
+        self.assertListEqual(started, [
+            [('f0.out', 60, 'CATEGORY=hinted'),
+             ('f1.out', 60, 'CATEGORY=hinted'),
+             ('f2.out', 900, 'CATEGORY=blind')],
+            [('f1.out', 900, 'CATEGORY=blind')]])
+        self.assertListEqual([r.name for r in results],
+                             ['f0.fit', 'f2.fit', 'f1.fit'])
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+class TestMakeflowLogWatcher(unittest.TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.log_dir, 'batch.mf.makeflowlog')
+
+    def _append(self, text):
+        with open(self.log_path, 'a') as f:
+            f.write(text)
+
+    def test_completions_reported_as_log_grows(self):
+        watcher = MakeflowLogWatcher(self.log_path, ['a.out', 'b.out'])
+        self.assertListEqual(watcher.poll(), [])
+
+        self._append('# STARTED 1000000000\n'
+                     '1000000000 0 1 1 1 1 0 0 0 2\n'
+                     '1000000000 1 1 2 0 2 0 0 0 2\n'
+                     '1003500000 0 2 1 0 1 1 0 0 2\n'
+                     '1004000000 1 3 ')
+        completion, = watcher.poll()
+        self.assertEqual(completion.target, 'a.out')
+        self.assertEqual(completion.state, COMPLETE)
+        self.assertEqual(completion.exit_status, 0)
+        self.assertAlmostEqual(completion.runtime, 3.5)
+        self.assertEqual(watcher.nodes_running, 1)
+
+        # the rest of a line that was only half written
+        self._append('2 0 0 1 1 0 2\n# FAILED 1004000000\n')
+        completions = list(watcher.follow(lambda: True, poll_interval=0))
+        self.assertEqual(len(completions), 1)
+        self.assertEqual(completions[0].target, 'b.out')
+        self.assertEqual(completions[0].state, NODE_FAILED)
+        self.assertEqual(completions[0].exit_status, 1)
+        self.assertTrue(watcher.workflow_finished)
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+
+class TestWorkerAutoscaler(unittest.TestCase):
+    def setUp(self):
+        # a stub submit command that prints a PBS job id per worker
+        self.commands = []
+        self.next_id = [100]
+
+        def run_command(command):
+            self.commands.append(command)
+            if command.startswith('submit'):
+                n = int(command.split()[1])
+                ids = range(self.next_id[0], self.next_id[0] + n)
+                self.next_id[0] += n
+                return ''.join('{}.head1\n'.format(i) for i in ids)
+            return ''
+
+        self.pool = PbsWorkerPool(lambda n: 'submit {}'.format(n),
+                                  run_command=run_command)
+
+    def test_pool_parses_job_ids(self):
+        self.assertListEqual(self.pool.submit(2), ['100.head1', '101.head1'])
+        self.pool.release(['100.head1', None])
+        self.assertEqual(self.commands[-1], 'qdel 100.head1')
+
+    def test_scales_with_simulated_queue(self):
+        now = [0.]
+        scaler = WorkerAutoscaler(self.pool, min_workers=1, max_workers=5,
+                                  target_drain_time=600, jobs_per_worker=2,
+                                  initial_solve_time=120,
+                                  clock=lambda: now[0])
+        # 40 jobs at 120 s, 2 per worker, in 600 s -> 4 workers
+        self.assertEqual(scaler.update(40), 4)
+        # never more than max_workers
+        self.assertEqual(scaler.update(400), 5)
+
+        # solves turn out quicker than assumed, so fewer workers will do,
+        # but only once the cooldown (3 solves of 30 s) has passed
+        for _ in range(10):
+            scaler.observe_solve_time(30)
+        self.assertEqual(scaler.update(40), 5)
+        now[0] = 60.
+        self.assertEqual(scaler.update(40), 5)
+        now[0] = 90.
+        self.assertEqual(scaler.update(40), 1)
+        self.assertEqual(self.commands[-1],
+                         'qdel 101.head1 102.head1 103.head1 104.head1')
+        self.assertListEqual(scaler.handles, ['100.head1'])
+
+        # a small backlog cannot keep more workers busy than it has jobs
+        for _ in range(10):
+            scaler.observe_solve_time(10000)
+        self.assertEqual(scaler.update(3), 2)
+
+        # drained: back to the minimum after the cooldown, then none at
+        # shutdown
+        self.assertEqual(scaler.update(0), 2)
+        now[0] += scaler.cooldown
+        self.assertEqual(scaler.update(0), 1)
+        scaler.shutdown()
+        self.assertEqual(scaler.num_workers, 0)
+        self.assertEqual(self.commands[-1], 'qdel 100.head1')
+
+    def test_lull_keeps_workers(self):
+        now = [0.]
+        scaler = WorkerAutoscaler(self.pool, min_workers=1, max_workers=5,
+                                  target_drain_time=600, jobs_per_worker=2,
+                                  initial_solve_time=120,
+                                  clock=lambda: now[0])
+        self.assertEqual(scaler.update(40), 4)
+        # the tail of a shard, shorter than the cooldown (3 x 120 s)
+        for depth in (2, 0, 0):
+            now[0] += 100
+            self.assertEqual(scaler.update(depth), 4)
+        # the next batch arrives to find its workers waiting
+        self.assertEqual(scaler.update(40), 4)
+        self.assertListEqual(self.commands, ['submit 4'])
+
+        # a long lull releases down to the most workers it called for
+        self.assertEqual(scaler.update(12), 4)
+        now[0] += 200
+        self.assertEqual(scaler.update(0), 4)
+        now[0] += 200
+        self.assertEqual(scaler.update(0), 2)
+        self.assertEqual(self.commands[-1], 'qdel 102.head1 103.head1')
+
+
+def make_fits_header(cards):
+    """A FITS primary header block holding the given cards."""
+    cards = ['SIMPLE  =                    T'] + cards + ['END']
+    header = ''.join(card.ljust(80) for card in cards)
+    return header.ljust(2880 * ((len(header) + 2879) // 2880))
+
+
+class TestFitsHints(unittest.TestCase):
+    def setUp(self):
+        self.header_bytes = make_fits_header([
+            "OBJCTRA = '12 30 00.0'         / Nominal RA",
+            "OBJCTDEC= '-10 30 00'          / Nominal Dec",
+            "XPIXSZ  =                  9.0 / Pixel width in microns",
+            "XBINNING=                    2",
+            "FOCALLEN=               1000.0",
+            "OBSERVER= 'O''Brien'",
+        ])
+
+    def test_read_primary_header(self):
+        # the header is read without touching the data after it
+        f = BytesIO(self.header_bytes + 'data')
+        header = read_primary_header(f)
+        self.assertEqual(header['OBJCTRA'], '12 30 00.0')
+        self.assertEqual(header['XBINNING'], 2)
+        self.assertEqual(header['OBSERVER'], "O'Brien")
+        self.assertIs(header['SIMPLE'], True)
+        self.assertEqual(f.tell(), len(self.header_bytes))
+
+        self.assertRaises(FitsHeaderError, read_primary_header,
+                          BytesIO('not a fits file'.ljust(2880)))
+
+    def test_hints_from_header(self):
+        header = read_primary_header(BytesIO(self.header_bytes))
+        hints = hints_from_header(header, search_radius=1.0,
+                                  scale_tolerance=0.1)
+        self.assertAlmostEqual(hints.ra, 187.5)
+        self.assertAlmostEqual(hints.dec, -10.5)
+        self.assertEqual(hints.radius, 1.0)
+        # 206.265 * 9 um / 1000 mm
+        self.assertAlmostEqual(hints.scale_low, 1.856385 * 0.9)
+        self.assertAlmostEqual(hints.scale_high, 1.856385 * 1.1)
+
+        binned = hints_from_header(header, search_radius=1.0,
+                                   scale_tolerance=0.1,
+                                   pixel_size_includes_binning=False)
+        self.assertAlmostEqual(binned.scale_low, 2 * hints.scale_low)
+
+        self.assertFalse(hints_from_header({}, 1.0, 0.1))
+        self.assertAlmostEqual(parse_angle(45.25), 45.25)
+        self.assertIsNone(parse_angle('north'))
+
+    def test_hinted_command(self):
+        header = read_primary_header(BytesIO(self.header_bytes))
+        hints = hints_from_header(header, search_radius=1.0,
+                                  scale_tolerance=0.1)
+        command = makeflow_gen.solve_field_command('solve', 'a.fit', 'a.cfg',
+                                                   hints)
+        self.assertIn('-u arcsecperpix -L 1.6707 ', command)
+        self.assertIn('-H 2.0420 ', command)
+        self.assertIn('--ra 187.500000 --dec -10.500000 --radius 1.000 ',
+                      command)
+        self.assertNotIn('-u app', command)
+        # without hints, the frame is solved blind
+        self.assertIn('-u app -L 0.3 ',
+                      makeflow_gen.solve_field_command('solve', 'a.fit',
+                                                       'a.cfg'))
+
+    def test_hint_report(self):
+        report = HintReport()
+        report.record(True, 10.)
+        report.record(True, 20.)
+        report.record(False, 100.)
+        self.assertAlmostEqual(report.time_saved(), 170.)
+
+
+class TestFitsHeaderUpdate(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.fits_path = os.path.join(self.work_dir, 'frame.fit')
+        self.data = ''.join(chr(i % 256) for i in range(2880 * 2))
+        with open(self.fits_path, 'wb') as f:
+            f.write(make_fits_header(["OBJCTRA = '12 30 00.0'",
+                                      "FOCALLEN=               1000.0"]))
+            f.write(self.data)
+
+    def read_data(self, header_size):
+        with open(self.fits_path, 'rb') as f:
+            f.seek(header_size)
+            return f.read()
+
+    def test_update_in_place(self):
+        for use_mmap in (False, True):
+            self.assertTrue(update_primary_header(
+                self.fits_path,
+                [('OBJCTRA', '12 31 00.000'), ('objctdec', '-10 30 00.00'),
+                 ('EXPTIME', 30.0, 'seconds'), ('SOLVED', use_mmap)],
+                use_mmap=use_mmap))
+            header = read_primary_header(self.fits_path)
+            self.assertEqual(header['OBJCTRA'], '12 31 00.000')
+            self.assertEqual(header['OBJCTDEC'], '-10 30 00.00')
+            self.assertEqual(header['EXPTIME'], 30.0)
+            self.assertIs(header['SOLVED'], use_mmap)
+            self.assertEqual(header['FOCALLEN'], 1000.0)
+            self.assertEqual(os.path.getsize(self.fits_path), 2880 * 3)
+            self.assertEqual(self.read_data(2880), self.data)
+
+    def test_update_past_padding(self):
+        # more cards than the first block has room for
+        cards = [('KEY{}'.format(i), i) for i in range(40)]
+        self.assertFalse(update_primary_header(self.fits_path, cards))
+        header = read_primary_header(self.fits_path)
+        self.assertEqual(header['KEY39'], 39)
+        self.assertEqual(header['OBJCTRA'], '12 30 00.0')
+        self.assertEqual(os.path.getsize(self.fits_path), 2880 * 4)
+        self.assertEqual(self.read_data(2880 * 2), self.data)
+
+    def test_format_card(self):
+        self.assertEqual(format_card('observer', "O'Brien").rstrip(),
+                         "OBSERVER= 'O''Brien'")
+        self.assertEqual(format_card('SCALE', 1e-05).rstrip(),
+                         'SCALE   =               1.E-05')
+        self.assertRaises(FitsHeaderError, format_card, 'NOT A KEY', 1)
+        self.assertRaises(FitsHeaderError, format_card, 'LONG', 'x' * 80)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+class TestTriage(unittest.TestCase):
+    IMAGE_CARDS = ['BITPIX  =                   16',
+                   'NAXIS   =                    2',
+                   'NAXIS1  =                 1000',
+                   'NAXIS2  =                 1000']
+
+    def frame(self, cards=(), data_size=695 * 2880):
+        return make_fits_header(self.IMAGE_CARDS + list(cards)) + \
+            '\0' * data_size
+
+    def check(self, contents, name='frame.fit', size=None):
+        if size is None:
+            size = len(contents)
+        return Triage().check_file(BytesIO(contents), name, size)
+
+    def test_accepts_light_frames(self):
+        light = self.frame(["IMAGETYP= 'Light Frame'",
+                            "VSHUTTER= 'Open'"])
+        self.assertIsNone(self.check(light))
+        self.assertIsNone(self.check(light, 'FRAME.FITS'))
+        # the size is only checked when known
+        self.assertIsNone(self.check(light[:5000], size=0))
+
+    def test_rejections(self):
+        self.assertEqual(self.check(self.frame(), 'frame.fit.txt'),
+                         BAD_EXTENSION)
+        self.assertEqual(self.check('<html>' * 1000), NOT_FITS)
+        self.assertEqual(self.check(self.frame()[:5000]), TRUNCATED)
+        self.assertEqual(self.check(self.frame(["IMAGETYP= 'Flat Field'"])),
+                         CALIBRATION)
+        self.assertEqual(self.check(self.frame(["VIMTYPE = 'DARK'"])),
+                         CALIBRATION)
+        self.assertEqual(self.check(self.frame(["VSHUTTER= 'Closed'"])),
+                         SHUTTER_CLOSED)
+        self.assertEqual(self.check(make_fits_header(['NAXIS   =        0'])),
+                         BAD_HEADER)
+        self.assertEqual(
+            self.check(make_fits_header(['BITPIX  =        8',
+                                         'NAXIS   =        0'])),
+            NOT_AN_IMAGE)
+        # no END card in the blocks read
+        self.assertEqual(self.check('SIMPLE  =    T'.ljust(2880 * 20)),
+                         BAD_HEADER)
+
+    def test_triage_data_objects(self):
+        objs = [FakeDataObject('/iplant/c/light.fit', self.frame()),
+                FakeDataObject('/iplant/c/dark.fit',
+                               self.frame(["IMAGETYP= 'Dark Frame'"])),
+                FakeDataObject('/iplant/c/notes.txt', 'notes')]
+        pool = SessionPool(lambda: FakeSession(objs), 2)
+        triage = Triage()
+        reasons = dict((obj.name, reason) for obj, reason in
+                       triage_data_objects(objs, pool, triage, 2))
+        self.assertDictEqual(reasons, {'light.fit': None,
+                                       'dark.fit': CALIBRATION,
+                                       'notes.txt': BAD_EXTENSION})
+        self.assertDictEqual(triage.counts(), {CALIBRATION: 1,
+                                               BAD_EXTENSION: 1})
+
+        report_dir = tempfile.mkdtemp()
+        try:
+            report_path = os.path.join(report_dir, 'rejections.csv')
+            triage.report(report_path)
+            with open(report_path) as f:
+                self.assertEqual(len(f.read().splitlines()), 3)
+        finally:
+            shutil.rmtree(report_dir)
+
+
+    def test_triage_keeps_listing_lazy(self):
+        session = FakeSession(
+            [FakeDataObject('/iplant/c/frame_{}.fit'.format(i), self.frame())
+             for i in range(20)])
+        pool = SessionPool(lambda: session, 2)
+        FakeQuery.page_size = 2
+        try:
+            triaged = triage_data_objects(
+                list_data_objects(pool, '/iplant/c'), pool, Triage(), 2)
+            next(triaged)
+            # one chunk (two per worker) is listed, two pages
+            self.assertListEqual(session.data_objects.queries, [0, 2])
+            self.assertEqual(len(list(triaged)), 19)
+        finally:
+            FakeQuery.page_size = 500
+            pool.cleanup()
+        self.assertEqual(len(session.data_objects.queries), 11)
+
+
+class TestCompression(unittest.TestCase):
+    FRAME = make_fits_header(['BITPIX  =                   16',
+                              'NAXIS   =                    2',
+                              'NAXIS1  =                   10',
+                              'NAXIS2  =                   10',
+                              "IMAGETYP= 'Light Frame'"]) + '\1' * 2880
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    @staticmethod
+    def gzipped(data):
+        buf = BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(data)
+        return buf.getvalue()
+
+    @staticmethod
+    def zipped(name, data):
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(name, data)
+        return buf.getvalue()
+
+    def test_names(self):
+        self.assertEqual(compression_of('a.fits.fz'), FPACK)
+        self.assertEqual(compression_of('a.fit.GZ'), GZIP)
+        self.assertEqual(compression_of('a.fit.zip'), ZIP)
+        self.assertIsNone(compression_of('a.fit'))
+        self.assertEqual(uncompressed_name('a.fits.fz'), 'a.fits')
+        self.assertEqual(uncompressed_name('a.fit'), 'a.fit')
+        self.assertEqual(frame_base('a.b.fits.gz'), 'a.b')
+        self.assertEqual(frame_base('a.b.fit'), 'a.b')
+        self.assertTrue(is_fits_filename('a.FIT.zip'))
+        self.assertFalse(is_fits_filename('a.new.gz'))
+        self.assertFalse(is_fits_filename('a.txt'))
+
+    def test_read_image_header(self):
+        for compression, data in (
+                (GZIP, self.gzipped(self.FRAME)),
+                (ZIP, self.zipped('a.fit', self.FRAME))):
+            header = read_image_header(BytesIO(data), compression)
+            self.assertEqual(header['NAXIS1'], 10)
+            self.assertEqual(header['IMAGETYP'], 'Light Frame')
+
+        # an fpacked image is described by its table's Z keywords
+        fpacked = make_fits_header(['BITPIX  =                    8',
+                                    'NAXIS   =                    0',
+                                    'EXTEND  =                    T']) + \
+            make_fits_header(['ZIMAGE  =                    T',
+                              'ZBITPIX =                   16',
+                              'ZNAXIS  =                    2',
+                              'ZNAXIS1 =                 4096',
+                              'ZNAXIS2 =                 4097',
+                              "IMAGETYP= 'Light Frame'"]).\
+            replace('SIMPLE  =                    T',
+                    "XTENSION= 'BINTABLE'          ", 1)
+        header = read_image_header(BytesIO(fpacked), FPACK)
+        self.assertTrue(header['SIMPLE'])
+        self.assertEqual(header['BITPIX'], 16)
+        self.assertEqual((header['NAXIS'], header['NAXIS1'],
+                          header['NAXIS2']), (2, 4096, 4097))
+        with self.assertRaises(FitsHeaderError):
+            read_image_header(BytesIO(self.FRAME), FPACK)
+
+    def test_compress_and_decompress(self):
+        fits_path = os.path.join(self.work_dir, 'a.fit')
+        with open(fits_path, 'wb') as f:
+            f.write(self.FRAME)
+        for compression in (GZIP, ZIP):
+            compressed_path = fits_path + '.' + compression
+            compress(fits_path, compressed_path)
+            self.assertLess(os.path.getsize(compressed_path), len(self.FRAME))
+            self.assertEqual(read_header(compressed_path)['NAXIS2'], 10)
+
+            copy_path = os.path.join(self.work_dir, 'copy.fit')
+            decompress(compressed_path, copy_path)
+            with open(copy_path, 'rb') as f:
+                self.assertEqual(f.read(), self.FRAME)
+
+    def test_makeflow_rule_decompresses(self):
+        shard, = makeflow_gen.sharded_makeflow_gen(
+            ['a.fit.gz', 'b.fit'], '/bin/solve-field', '/netpbm', '/batch',
+            self.work_dir)
+        with open(shard) as f:
+            makeflow = f.read()
+        self.assertIn('a.out : $(INPUT_DIR)/a.fit.gz $(SOLVE_FIELD)\n'
+                      '\tmodule load python && gzip -dc $(INPUT_DIR)/a.fit.gz '
+                      '> $(INPUT_DIR)/a.fit && $(SOLVE_FIELD) ', makeflow)
+        self.assertIn('--overwrite $(INPUT_DIR)/a.fit > a.out', makeflow)
+        self.assertIn('\tmodule load python && $(SOLVE_FIELD) ', makeflow)
+
+    def test_local_executor_decompresses(self):
+        compressed_path = os.path.join(self.work_dir, 'a.fit.gz')
+        with open(compressed_path, 'wb') as f:
+            f.write(self.gzipped(self.FRAME))
+        executor = LocalExecutor('echo', '/usr/bin', num_workers=1)
+        result, = executor.run(
+            [SolveJob('a.fit.gz', compressed_path,
+                      os.path.join(self.work_dir, 'a.out'))], self.work_dir)
+
+        self.assertTrue(result.succeeded)
+        with open(os.path.join(self.work_dir, 'a.out')) as f:
+            self.assertIn('--overwrite {}\n'.format(
+                os.path.join(self.work_dir, 'a.fit')), f.read())
+        with open(os.path.join(self.work_dir, 'a.fit'), 'rb') as f:
+            self.assertEqual(f.read(), self.FRAME)
+
+    def test_triage_reads_compressed_headers(self):
+        triage = Triage()
+        self.assertIsNone(triage.check_file(
+            BytesIO(self.gzipped(self.FRAME)), 'a.fit.gz'))
+        dark = self.FRAME.replace("'Light Frame'", "'Dark Frame' ")
+        self.assertEqual(triage.check_file(
+            BytesIO(self.zipped('a.fit', dark)), 'a.fit.zip'), CALIBRATION)
+        self.assertEqual(triage.check_file(BytesIO(self.FRAME), 'a.fit.gz'),
+                         NOT_FITS)
+
+
+class TestSequencePlanner(unittest.TestCase):
+    def test_groups_by_target_and_night(self):
+        filenames = [
+            'Briol_1197Rhodesia_20140630_044345_flatfield_TA_FITS.fit',
+            'Briol_1197Rhodesia_20140630_043345_flatfield_TA_FITS.fit',
+            'Briol_1197Rhodesia_20140630_045345_flatfield_TA_FITS.fit',
+            'Briol_1197Rhodesia_20140701_044345_flatfield_TA_FITS.fit',
+            'Briol_Vesta_20140630_044345_flatfield_TA_FITS.fit',
+            'noname.fit',
+        ]
+        plan = dict((s.key, s) for s in plan_sequences(filenames))
+        rhodesia = plan[('Briol', '1197Rhodesia', '20140630')]
+        # the middle frame in time leads the sequence
+        self.assertEqual(rhodesia.representative, filenames[0])
+        self.assertListEqual(rhodesia.followers, [filenames[1], filenames[2]])
+        self.assertListEqual(
+            plan[('Briol', '1197Rhodesia', '20140701')].followers, [])
+        self.assertEqual(plan[None].representative, 'noname.fit')
+
+    def test_groups_by_header(self):
+        headers = {
+            'a.fit': {'OBJECT': 'M51', 'DATE-OBS': '2014-06-30T04:43:45'},
+            'b.fit': {'OBJECT': 'M51', 'DATE-OBS': '2014-06-30T04:53:45'},
+        }
+        sequence, = plan_sequences(['b.fit', 'a.fit'], headers)
+        self.assertEqual(sequence.representative, 'b.fit')
+        self.assertListEqual(sequence.followers, ['a.fit'])
+
+    def test_seed_from_solution(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            out_path = os.path.join(out_dir, 'a.out')
+            with open(out_path, 'w') as f:
+                f.write('  RA,Dec = (187.5,-10.5), pixel scale 1.85 '
+                        'arcsec/pix.\n'
+                        'Field center: (RA,Dec) = (187.501, -10.499) deg.\n')
+            solution = solution_from_stdout(out_path)
+            self.assertEqual(solution, (187.501, -10.499, 1.85))
+            seed = hints_from_solution(solution, 0.5, 0.02)
+            self.assertEqual(seed.radius, 0.5)
+            self.assertAlmostEqual(seed.scale_low, 1.813)
+
+            with open(out_path, 'w') as f:
+                f.write('Did not solve.\n')
+            self.assertIsNone(solution_from_stdout(out_path))
+        finally:
+            shutil.rmtree(out_dir)
+
+
+class TestIndexBundle(unittest.TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        for name in ['index-203-00.fits', 'index-203-01.fits',
+                     'index-207.fits', 'index-4212.fits', 'README']:
+            open(os.path.join(self.index_dir, name), 'w').close()
+
+    def test_index_scale(self):
+        self.assertEqual(index_scale('index-203-05.fits'), 3)
+        self.assertEqual(index_scale('/data/index-4212.fits'), 12)
+        self.assertIsNone(index_scale('README'))
+
+    def test_select_by_field_width(self):
+        index_files = find_index_files(self.index_dir)
+        self.assertListEqual(sorted(index_files), [3, 7, 12])
+
+        # 1024 x 1024 pixels at 1.2 to 1.3 arcsec/pixel: about 21 arcmin
+        width = field_width({'NAXIS1': 1024, 'NAXIS2': 1024},
+                            SolveHints(None, None, None, 1.2, 1.3))
+        self.assertAlmostEqual(width[0], 20.48)
+        self.assertListEqual(scales_for_fields([width]),
+                             [0, 1, 2, 3, 4, 5, 6, 7])
+        selected = select_index_files(index_files, [width])
+        self.assertListEqual([os.path.basename(p) for p in selected],
+                             ['index-203-00.fits', 'index-203-01.fits',
+                              'index-207.fits'])
+
+        # a frame of unknown size needs them all
+        self.assertIsNone(field_width({}))
+        self.assertEqual(len(select_index_files(index_files, [width, None])),
+                         4)
+
+    def test_bundle_config_and_rules(self):
+        index_paths = [os.path.join(self.index_dir, 'index-207.fits')]
+        config_path = write_bundle_config(
+            os.path.join(astrogen.__resources_dir__, 'astrometry.cfg'),
+            index_paths, self.index_dir)
+        with open(config_path) as f:
+            config = f.read()
+        self.assertIn('cpulimit 300\n', config)
+        self.assertNotIn('add_path /gsfs1', config)
+        self.assertNotIn('\nautoindex', config)
+        self.assertIn('add_path .\nindex index-207.fits\n', config)
+
+        shard, = makeflow_gen.sharded_makeflow_gen(
+            ['a.fit'], '/astrometry/bin/solve-field', '/netpbm', '/batch',
+            self.index_dir, index_files=find_index_files(self.index_dir),
+            field_widths={'a.fit': (100., 130.)})
+        with open(shard) as f:
+            makeflow = f.read()
+        self.assertIn('SOLVE_FIELD_DIR=/astrometry/bin\n', makeflow)
+        self.assertIn('INDEX_FILES={0}/index-207.fits->index-207.fits '
+                      '{0}/index-4212.fits->index-4212.fits\n'.
+                      format(self.index_dir), makeflow)
+        self.assertIn('a.out : $(INPUT_DIR)/a.fit '
+                      '$(SOLVE_FIELD_DIR)->astrometry '
+                      '$(BUNDLE_CONFIG)->astrometry.cfg $(INDEX_FILES)\n',
+                      makeflow)
+        self.assertIn('astrometry/solve-field -g', makeflow)
+        self.assertIn('--backend-config astrometry.cfg ', makeflow)
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+
+class TestExtraction(unittest.TestCase):
+    SOLVED_OUTPUT = dedent('''\
+        Field: frame.fit
+        Field center: (RA,Dec) = (187.5, -10.5) deg.
+        Field center: (RA H:M:S, Dec D:M:S) = (12:30:00.000, -10:30:00.00).
+        Field size: 31.9 x 21.3 arcminutes
+        Field rotation angle: up is 2.5 degrees W of N
+          RA,Dec = (187.5,-10.5), pixel scale 1.5 arcsec/pix.
+        ''')
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.template_path = os.path.join(self.work_dir, 'template.txt')
+        with open(self.template_path, 'w') as f:
+            f.write('[Camera]\nPixelWide=0.009\nFocalLength=1\nPA=0\n'
+                    'VarPA=1\n')
+
+    def test_parse_solve_output(self):
+        solution = parse_solve_output(self.SOLVED_OUTPUT.splitlines())
+        self.assertEqual((solution['ra'], solution['dec']), (187.5, -10.5))
+        self.assertEqual(solution['ra_hms'], '12 30 00.000')
+        self.assertEqual(solution['dec_dms'], '-10 30 00.00')
+        self.assertEqual(solution['pixel_scale'], 1.5)
+        self.assertEqual(solution['rotation'], -2.5)
+
+    def test_extract_batch(self):
+        paths = []
+        for name, output in (('solved', self.SOLVED_OUTPUT),
+                             ('unsolved', 'Did not solve (or no WCS file)\n')):
+            paths.append(os.path.join(self.work_dir, name + '.out'))
+            with open(paths[-1], 'w') as f:
+                f.write(output)
+
+        extractor = BatchExtractor(self.template_path, num_workers=2)
+        table = extractor.extract(paths)
+        self.assertListEqual(table['name'], ['solved', 'unsolved'])
+        self.assertListEqual(table['status'], [OK, UNSOLVED])
+        self.assertAlmostEqual(table['focal_length'][0],
+                               206265 * 0.009 / 1.5)
+
+        cfg_path, = extractor.write_configs(table, self.work_dir)
+        self.assertEqual(cfg_path, os.path.join(self.work_dir, 'solved.cfg'))
+        with open(cfg_path) as f:
+            lines = f.read().splitlines()
+        self.assertIn('FocalLength=' + str(206265 * 0.009 / 1.5), lines)
+        self.assertIn('PA=-2.5', lines)
+        self.assertIn('VarPA=1', lines)
+
+        csv_file = BytesIO()
+        table.write_csv(csv_file)
+        self.assertEqual(len(csv_file.getvalue().splitlines()), 3)
+
+    def test_parse_wcs_header(self):
+        # 1.5 arcsec/pix, rotated 30 degrees, east left, reference pixel
+        # at the image center
+        scale = 1.5 / 3600.
+        angle = math.radians(30.)
+        header = {
+            'CRVAL1': 187.5, 'CRVAL2': -10.5,
+            'CRPIX1': 1024.5, 'CRPIX2': 768.5,
+            'IMAGEW': 2048, 'IMAGEH': 1536,
+            'CD1_1': -scale * math.cos(angle),
+            'CD1_2': -scale * math.sin(angle),
+            'CD2_1': -scale * math.sin(angle),
+            'CD2_2': scale * math.cos(angle),
+        }
+        solution = parse_wcs_header(header)
+        self.assertAlmostEqual(solution['ra'], 187.5)
+        self.assertAlmostEqual(solution['dec'], -10.5)
+        self.assertEqual(solution['ra_hms'], '12 30 00.000')
+        self.assertEqual(solution['dec_dms'], '-10 30 00.00')
+        self.assertAlmostEqual(solution['pixel_scale'], 1.5)
+        self.assertAlmostEqual(abs(solution['rotation']), 30.)
+
+        # off the reference pixel, the center moves along the projection
+        header['CRPIX2'] = 768.5 - 3600. / 1.5 * math.cos(angle)
+        header['CRPIX1'] = 1024.5 + 3600. / 1.5 * math.sin(angle)
+        self.assertAlmostEqual(parse_wcs_header(header)['dec'], -9.5,
+                               places=3)
+        self.assertEqual(parse_wcs_header({'CRVAL1': 1.}), {})
+
+    def test_extract_wcs_mode(self):
+        wcs_header = ''.join('{:<80}'.format(card) for card in (
+            'SIMPLE  =                    T',
+            "CTYPE1  = 'RA---TAN'",
+            'CRVAL1  =                 10.0',
+            'CRVAL2  =                 20.0',
+            'CD1_1   =       -0.00025000000',
+            'CD1_2   =                  0.0',
+            'CD2_1   =                  0.0',
+            'CD2_2   =        0.00025000000',
+            'END'))
+        with open(os.path.join(self.work_dir, 'solved.wcs'), 'w') as f:
+            f.write(wcs_header.ljust(2880))
+
+        extractor = BatchExtractor(self.template_path, mode=WCS)
+        table = extractor.extract(os.path.join(self.work_dir, name + '.out')
+                                  for name in ('solved', 'unsolved'))
+        self.assertListEqual(table['status'], [OK, UNSOLVED])
+        self.assertEqual(table['ra_hms'][0], '00 40 00.000')
+        self.assertEqual(table['dec_dms'][0], '+20 00 00.00')
+        self.assertAlmostEqual(table['pixel_scale'][0], 0.9)
+        self.assertAlmostEqual(table['rotation'][0], 0.)
+        self.assertRaises(ValueError, BatchExtractor, self.template_path,
+                          mode='fits')
+
+    def test_extend(self):
+        table = SolutionTable()
+        table.append(name='a', status=OK)
+        other = SolutionTable()
+        other.append(name='b', status=UNSOLVED)
+        table.extend(other)
+        self.assertEqual(len(table), 2)
+        self.assertListEqual(table.names_with_status(UNSOLVED), ['b'])
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.catalog_dir = tempfile.mkdtemp()
+        self.catalog = Catalog(os.path.join(self.catalog_dir,
+                                            'catalog.sqlite'))
+        table = SolutionTable()
+        # across RA 0, near the pole, and an unsolved frame
+        for name, ra, dec in (('a', 359.9, 10.), ('b', 0.2, 10.),
+                              ('c', 180., 89.9), ('d', 90., -30.)):
+            table.append(name=name, ra=ra, dec=dec, pixel_scale=1.8,
+                         rotation=0., status=OK)
+        table.append(name='e', status=UNSOLVED)
+        headers = {
+            'a': {'NAXIS1': 1000, 'NAXIS2': 1000,
+                  'DATE-OBS': '2014-06-30T04:43:45'},
+            'b': {'DATE-OBS': '2014-07-01'},
+            'c': {'DATE-OBS': '2014-06-30T05:00:00.5'},
+        }
+        self.assertEqual(self.catalog.add(table, headers, {'a': '/iplant/a'}),
+                         4)
+
+    def test_cone_search(self):
+        names = [e.name for e in self.catalog.search(0., 10., 0.25)]
+        self.assertListEqual(names, ['a', 'b'])
+        a, = self.catalog.search(359.9, 10., 0.)
+        self.assertEqual(a.path, '/iplant/a')
+        self.assertAlmostEqual(a.width, 30.)
+        # a's footprint reaches 0.35 degrees from its center, nearest first
+        self.assertListEqual(
+            [e.name for e in self.catalog.search(0.2, 10., 0.)], ['b', 'a'])
+        self.assertListEqual(self.catalog.search(0.5, 10., 0.), [])
+        self.assertListEqual(
+            [e.name for e in self.catalog.search(0., 89.95, 0.2)], ['c'])
+
+    def test_time_search(self):
+        names = [e.name for e in self.catalog.search(
+            start='2014-06-30', end='2014-06-30T23:59:59')]
+        self.assertListEqual(names, ['a', 'c'])
+        names = [e.name for e in self.catalog.search(
+            0., 10., 1., start='2014-06-30T12:00:00')]
+        self.assertListEqual(names, ['b'])
+        self.assertRaises(ValueError, self.catalog.search, start='June')
+
+    def test_helpers(self):
+        self.assertEqual(parse_date_obs('1970-01-02T00:00:01.5'), 86401.5)
+        self.assertIsNone(parse_date_obs('30/06/14'))
+        self.assertAlmostEqual(angular_distance(359.5, 0., 0.5, 0.), 1.)
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.catalog_dir)
+
+
 class TestConfig(unittest.TestCase):
 
     def test_config(self):